@@ -0,0 +1,127 @@
+"""AIMD control of how many probes the scheduler runs at once.
+
+Workers take a permit before probing; the number of permits (the limit)
+moves between min_limit and max_limit:
+
+- every ADJUST_INTERVAL, if event-loop lag exceeded LAG_LIMIT or probes got
+  slower than LATENCY_TOLERANCE times their target's usual latency (median
+  over the interval), the limit is cut by DECREASE;
+- otherwise, if work was waiting for a permit, it grows by one.
+
+Latency is judged per target against a slow moving average, so a mix of
+fast and slow targets does not look like congestion.
+"""
+
+import asyncio
+import statistics
+
+LAG_LIMIT = 0.1
+LAG_SAMPLE = 0.1
+LATENCY_TOLERANCE = 2.0
+ADJUST_INTERVAL = 2.0
+DECREASE = 0.75
+BASELINE_ALPHA = 0.05
+MAX_CONCURRENCY = 32
+
+
+class AdaptiveLimit:
+    def __init__(
+        self,
+        initial,
+        min_limit=1,
+        max_limit=MAX_CONCURRENCY,
+        lag_limit=LAG_LIMIT,
+        latency_tolerance=LATENCY_TOLERANCE,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = min(max(initial, min_limit), self.max_limit)
+        self.lag_limit = lag_limit
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = asyncio.Condition()
+        self._baseline = {}
+        self._ratios = []
+        self._lag = 0.0
+        self._saturated = False
+        self.metrics = {
+            "limit": self.limit,
+            "in_flight": 0,
+            "queued": 0,
+            "latency_ratio": None,
+            "loop_lag_ms": 0.0,
+            "increases": 0,
+            "decreases": 0,
+        }
+
+    async def __aenter__(self):
+        async with self._cond:
+            self.waiting += 1
+            try:
+                while self.in_flight >= self.limit:
+                    self._saturated = True
+                    await self._cond.wait()
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def record(self, cid, latency_ms):
+        base = self._baseline.get(cid)
+        if base:
+            self._ratios.append(latency_ms / base)
+            self._baseline[cid] = base + BASELINE_ALPHA * (latency_ms - base)
+        elif latency_ms > 0:
+            self._baseline[cid] = latency_ms
+
+    def record_lag(self, lag):
+        self._lag = max(self._lag, lag)
+
+    async def adjust(self, queued=0):
+        """Apply one AIMD step; queued is work not yet holding a permit."""
+        ratio = statistics.median(self._ratios) if self._ratios else None
+        old = self.limit
+        if self._lag > self.lag_limit or (
+            ratio is not None and ratio > self.latency_tolerance
+        ):
+            self.limit = max(self.min_limit, int(self.limit * DECREASE))
+        elif (queued or self.waiting) and (
+            self._saturated or self.in_flight >= self.limit
+        ):
+            self.limit = min(self.max_limit, self.limit + 1)
+        if self.limit > old:
+            self.metrics["increases"] += 1
+            async with self._cond:
+                self._cond.notify(self.limit - old)
+        elif self.limit < old:
+            self.metrics["decreases"] += 1
+        self.metrics.update(
+            limit=self.limit,
+            in_flight=self.in_flight,
+            queued=queued + self.waiting,
+            latency_ratio=None if ratio is None else round(ratio, 3),
+            loop_lag_ms=round(self._lag * 1000, 3),
+        )
+        self._ratios = []
+        self._lag = 0.0
+        self._saturated = False
+        return self.limit
+
+    async def run(self, queued=lambda: 0, on_adjust=None):
+        """Sample event-loop lag and adjust the limit every ADJUST_INTERVAL."""
+        loop = asyncio.get_running_loop()
+        last = loop.time()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(LAG_SAMPLE)
+            self.record_lag(loop.time() - t - LAG_SAMPLE)
+            if loop.time() - last >= ADJUST_INTERVAL:
+                last = loop.time()
+                await self.adjust(queued())
+                if on_adjust is not None:
+                    on_adjust(dict(self.metrics))
@@ -1,18 +1,35 @@
+import asyncio
+import csv
+import datetime
+import io
 import time
 import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
 
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, Response
 
+import asyncdb
 import db
+import queries
 
 APPDIR = Path("/home/ubuntu/agent-repo/monitor")
 LOG = Path("/home/ubuntu/opencode_actions.log")
 UI_DIR = APPDIR / "ui"
 
-app = FastAPI()
+# every route's SQLite work runs on DB's threads, never on the event loop
+DB = asyncdb.AsyncDB()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await asyncio.to_thread(DB.close)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 def log(action, details=""):
@@ -43,7 +60,7 @@ def normalize_url(u):
 
 @app.post("/init")
 async def init():
-    db.init_db()
+    await asyncio.to_thread(db.init_db)
     return {"status": "ok"}
 
 
@@ -55,33 +72,10 @@ async def topup(data: dict):
         raise HTTPException(status_code=400, detail="sats must be >0")
     token = data.get("token")
     ts = time.time()
-    with db.get_conn() as conn:
-        c = conn.cursor()
-        if not token:
-            token = str(uuid.uuid4())
-            c.execute(
-                "insert into sessions(token,credits,created,last_used) values(?,?,?,?)",
-                (token, sats, ts, ts),
-            )
-            balance = sats
-            action = "CREATE_SESSION_TOPUP"
-        else:
-            cur = c.execute(
-                "select credits from sessions where token=?", (token,)
-            ).fetchone()
-            if not cur:
-                raise HTTPException(status_code=404, detail="session not found")
-            balance = cur["credits"] + sats
-            c.execute(
-                "update sessions set credits=?, last_used=? where token=?",
-                (balance, ts, token),
-            )
-            action = "TOPUP"
-        c.execute(
-            "insert into ledger(ts,action,token,amount,balance,note) values(?,?,?,?,?,?)",
-            (ts, action, token, sats, balance, None),
-        )
-        conn.commit()
+    result = await DB.write(queries.topup, token, str(uuid.uuid4()), sats, ts)
+    if result is None:
+        raise HTTPException(status_code=404, detail="session not found")
+    token, balance = result.token, result.balance
     log("TOPUP", f"token={token} sats={sats} balance={balance}")
     # return a small HTML page that redirects to dashboard for friendliness
     html = f"<html><head><meta http-equiv='refresh' content='0; url=/d/{token}'></head><body>Topup successful. Redirecting to dashboard... If not redirected, <a href='/d/{token}'>click here</a>.</body></html>"
@@ -90,55 +84,31 @@ async def topup(data: dict):
 
 @app.post("/register")
 async def register(data: dict):
-    # expects {"token":..., "url":..., "interval":60}
+    # expects {"token":..., "url":..., "interval":60, "on_change": false}
     token = data.get("token")
     url = data.get("url")
     interval = int(data.get("interval", 60))
+    on_change = bool(data.get("on_change"))
     if not token or not url:
         raise HTTPException(status_code=400, detail="missing token or url")
     norm = normalize_url(url)
     cid = str(uuid.uuid5(uuid.NAMESPACE_URL, norm))
     ts = time.time()
-    with db.get_conn() as conn:
-        c = conn.cursor()
-        # ensure session exists
-        if not c.execute("select 1 from sessions where token=?", (token,)).fetchone():
-            raise HTTPException(status_code=404, detail="session not found")
-        # ensure canonical target exists
-        if not c.execute(
-            "select 1 from canonical_targets where cid=?", (cid,)
-        ).fetchone():
-            c.execute(
-                "insert into canonical_targets(cid,url,fingerprint,probe_type,last_probe,last_ok,next_run) values(?,?,?,?,?,?,?)",
-                (cid, norm, None, "http", None, 0, ts),
-            )
-        # create watcher
-        wid = str(int(time.time() * 1000))
-        c.execute(
-            "insert into watchers(wid,cid,token,interval,enabled,created) values(?,?,?,?,?,?)",
-            (wid, cid, token, interval, 1, ts),
-        )
-        conn.commit()
+    wid = str(int(time.time() * 1000))
+    if not await DB.write(
+        queries.register_watcher, token, cid, norm, wid, interval, on_change, ts
+    ):
+        raise HTTPException(status_code=404, detail="session not found")
     log("REGISTER", f"token={token} wid={wid} cid={cid} url={norm}")
     return {"wid": wid, "cid": cid, "url": norm}
 
 
 @app.get("/d/{token}")
 async def dashboard(token: str):
-    with db.get_conn() as conn:
-        c = conn.cursor()
-        session = c.execute(
-            "select token,credits,created,last_used from sessions where token=?",
-            (token,),
-        ).fetchone()
-        if not session:
-            raise HTTPException(status_code=404, detail="session not found")
-        watchers = c.execute(
-            "select w.wid,w.interval,w.enabled,w.created, t.url from watchers w join canonical_targets t on w.cid=t.cid where w.token=?",
-            (token,),
-        ).fetchall()
-        wlist = [dict(w) for w in watchers]
-        return {"session": dict(session), "watchers": wlist}
+    result = await DB.read(queries.dashboard, token)
+    if result is None:
+        raise HTTPException(status_code=404, detail="session not found")
+    return result
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -151,71 +121,156 @@ async def ui_index():
 
 @app.get("/targets")
 async def list_targets():
-    with db.get_conn() as conn:
-        c = conn.cursor()
-        rows = c.execute(
-            "select cid,url,last_probe,last_ok,next_run from canonical_targets"
-        ).fetchall()
-        return [dict(r) for r in rows]
+    return await DB.read(queries.list_targets)
 
 
 import reports
 
 
 @app.get("/reports/cid/{cid}")
-async def report_cid(cid: str, limit: int = 100):
-    return reports.reports_for_cid(cid)
+async def report_cid(
+    cid: str, limit: int = 100, since: float = None, until: float = None
+):
+    return reports.reports_for_cid(cid, limit=limit, since=since, until=until)
 
 
 @app.get("/reports/wid/{token}/{wid}")
-async def report_wid(token: str, wid: str, limit: int = 100):
-    return reports.timeseries_for_wid(token, wid, limit=limit)
+async def report_wid(
+    token: str, wid: str, limit: int = 100, since: float = None, until: float = None
+):
+    return reports.timeseries_for_wid(token, wid, limit=limit, since=since, until=until)
+
+
+@app.get("/analytics/cid/{cid}")
+async def analytics_cid(cid: str):
+    return reports.analytics_for_cid(cid)
+
+
+@app.get("/changes/cid/{cid}")
+async def changes_cid(cid: str, limit: int = 100, since: float = None):
+    # newest first; bodies are never stored, only their fingerprints
+    return await DB.read(queries.content_changes, cid, since, limit)
+
+
+@app.get("/metrics/scheduler")
+async def metrics_scheduler():
+    return reports.scheduler_metrics()
+
+
+# expired idempotency keys are deleted at most this often
+PURGE_INTERVAL = 600
+MAX_CONSUME_BATCH = 1000
+_last_purge = 0.0
+
+
+async def purge_idempotency_keys(now):
+    global _last_purge
+    if now - _last_purge >= PURGE_INTERVAL:
+        _last_purge = now
+        await DB.write(queries.purge_idempotency_keys, now)
 
 
 @app.post("/consume")
 async def consume(data: dict):
+    # optional "key": a retry with the same wid and key is not charged again
     wid = data.get("wid")
     cost = int(data.get("cost", 1))
+    key = data.get("key")
     ts = time.time()
     if not wid:
         raise HTTPException(status_code=400, detail="missing wid")
-    with db.get_conn() as conn:
-        c = conn.cursor()
-        row = c.execute("select token from watchers where wid=?", (wid,)).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="watcher not found")
-        token = row["token"]
-        cur = c.execute(
-            "select credits from sessions where token=?", (token,)
-        ).fetchone()
-        if cur["credits"] >= cost:
-            newbal = cur["credits"] - cost
-            c.execute(
-                "update sessions set credits=?, last_used=? where token=?",
-                (newbal, ts, token),
-            )
-            c.execute(
-                "insert into ledger(ts,action,token,wid,amount,balance) values(?,?,?,?,?,?)",
-                (ts, "CONSUME", token, wid, cost, newbal),
-            )
-            conn.commit()
-            log("CONSUME", f"wid={wid} token={token} cost={cost} credits_left={newbal}")
-            return {"status": "ok", "credits": newbal}
-        else:
-            c.execute(
-                "insert into ledger(ts,action,token,wid,amount,balance,note) values(?,?,?,?,?,?,?)",
-                (
-                    ts,
-                    "CHECK_FAILED_CHARGE",
-                    token,
-                    wid,
-                    cost,
-                    cur["credits"],
-                    "insufficient funds",
-                ),
-            )
-            conn.commit()
-            raise HTTPException(status_code=402, detail="insufficient funds")
+    charge = await DB.write(queries.consume, wid, cost, ts, key)
+    await purge_idempotency_keys(ts)
+    if charge is None:
+        raise HTTPException(status_code=404, detail="watcher not found")
+    if not charge.ok:
+        raise HTTPException(status_code=402, detail="insufficient funds")
+    if not charge.replayed:
+        log(
+            "CONSUME",
+            f"wid={wid} token={charge.token} cost={cost} credits_left={charge.balance}",
+        )
+    return {"status": "ok", "credits": charge.balance, "replayed": charge.replayed}
+
+
+@app.post("/consume/batch")
+async def consume_batch(data: dict):
+    # expects {"charges": [{"wid":..., "cost": 1, "key": null}, ...]}
+    items = data.get("charges") or []
+    if len(items) > MAX_CONSUME_BATCH:
+        raise HTTPException(status_code=400, detail="too many charges")
+    charges = []
+    for item in items:
+        if not item.get("wid"):
+            raise HTTPException(status_code=400, detail="missing wid")
+        charges.append((item["wid"], int(item.get("cost", 1)), item.get("key")))
+    ts = time.time()
+    # one transaction for the whole batch, applied in order
+    results = await DB.write(queries.consume_batch, charges, ts)
+    await purge_idempotency_keys(ts)
+    out = []
+    for (wid, cost, _), charge in zip(charges, results):
+        if charge is None:
+            out.append({"wid": wid, "status": "not_found"})
+            continue
+        out.append(
+            {
+                "wid": wid,
+                "status": "ok" if charge.ok else "insufficient_funds",
+                "credits": charge.balance,
+                "replayed": charge.replayed,
+            }
+        )
+    charged = sum(1 for r in out if r["status"] == "ok" and not r["replayed"])
+    log("CONSUME_BATCH", f"charges={len(charges)} charged={charged}")
+    return {"results": out}
+
+
+def parse_day(value, name):
+    # rollups are keyed by UTC day, YYYY-MM-DD
+    if value is None:
+        return None
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be YYYY-MM-DD")
+
+
+@app.get("/admin/earnings")
+async def admin_earnings(
+    request: Request,
+    since: str = None,
+    until: str = None,
+    by: str = "token",
+    format: str = "json",
+):
+    # daily totals from the rollups; by=token or by=watcher, format=json or csv
+    if not check_admin_key(request.headers):
+        raise HTTPException(status_code=403, detail="forbidden")
+    if by not in queries.EARNINGS:
+        raise HTTPException(status_code=400, detail="by must be token or watcher")
+    if format not in ("json", "csv"):
+        raise HTTPException(status_code=400, detail="format must be json or csv")
+    rows = await DB.read(
+        queries.earnings, parse_day(since, "since"), parse_day(until, "until"), by
+    )
+    if format == "json":
+        return {"by": by, "rows": rows}
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(queries.EARNINGS[by][1].split(","))
+    writer.writerows(r.values() for r in rows)
+    return Response(out.getvalue(), media_type="text/csv")
+
+
+@app.get("/receipts/{token}")
+async def receipts(token: str, since: str = None, until: str = None):
+    result = await DB.read(
+        queries.receipt, token, parse_day(since, "since"), parse_day(until, "until")
+    )
+    if result is None:
+        raise HTTPException(status_code=404, detail="session not found")
+    return result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+"""Move old ledger months out of the live database into compressed files.
+
+The ledger table only holds recent months. Each older calendar month (UTC)
+is copied, by id, into its own SQLite file with the ledger's schema,
+gzipped to ARCHIVE_DIR/ledger-YYYY-MM-<first id>.db.gz, recorded in
+ledger_partitions with its id range, row count and sha256, and only then
+deleted from the ledger, in chunks so writers are never held up for long.
+Reports do not need the archived rows: earnings_daily and
+watcher_earnings_daily are kept by a trigger on insert and are not touched
+by deletes.
+
+A run that dies part way is safe to repeat: a month's file is rewritten
+until its partition row is committed, and rows already covered by a
+partition row are deleted before anything new is archived.
+
+To read a partition: gunzip -k ledger-2026-01-1.db.gz; sqlite3 ledger-2026-01-1.db
+"""
+
+import datetime
+import gzip
+import hashlib
+import logging
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+
+try:
+    from monitor import db
+except ImportError:
+    import db
+
+ARCHIVE_DIR = db.DB_PATH.parent / "archive"
+# the current month and this many before it stay in the ledger
+KEEP_MONTHS = 3
+DELETE_CHUNK = 50_000
+
+logger = logging.getLogger(__name__)
+
+
+def month_start(year, month):
+    return datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
+
+
+def next_month(start):
+    return month_start(start.year + start.month // 12, start.month % 12 + 1)
+
+
+def cutoff(now, keep=KEEP_MONTHS):
+    """Start of the oldest month kept in the ledger."""
+    d = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+    months = d.year * 12 + d.month - 1 - keep
+    return month_start(months // 12, months % 12 + 1)
+
+
+def _delete_ids(conn, first_id, last_id, start, end):
+    """Delete archived rows in chunks, each in its own transaction."""
+    deleted = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        n = conn.execute(
+            "delete from ledger where id in (select id from ledger "
+            "where id between ? and ? and ts>=? and ts<? limit ?)",
+            (first_id, last_id, start, end, DELETE_CHUNK),
+        ).rowcount
+        conn.commit()
+        deleted += n
+        if n < DELETE_CHUNK:
+            return deleted
+
+
+def _write_partition(conn, path, start, end, last_id):
+    """Copy one month's rows up to last_id into a new database at path."""
+    path.unlink(missing_ok=True)
+    schema = conn.execute(
+        "select sql from sqlite_master where type='table' and name='ledger'"
+    ).fetchone()[0]
+    out = sqlite3.connect(path)
+    try:
+        out.execute(schema)
+        cur = conn.execute(
+            "select * from ledger where ts>=? and ts<? and id<=? order by id",
+            (start, end, last_id),
+        )
+        marks = ",".join("?" * len(cur.description))
+        while True:
+            rows = cur.fetchmany(db.MAX_BATCH)
+            if not rows:
+                break
+            out.executemany(f"insert into ledger values({marks})", map(tuple, rows))
+        out.commit()
+    finally:
+        out.close()
+
+
+def _compress(path):
+    """Gzip path next to itself, remove it, and return (gz path, sha256)."""
+    gz = path.with_name(path.name + ".gz")
+    with path.open("rb") as src, gzip.open(gz, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    path.unlink()
+    digest = hashlib.sha256()
+    with gz.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return gz, digest.hexdigest()
+
+
+def archive_month(conn, start, directory=None, now=None):
+    """Archive the ledger rows of the month starting at start.
+
+    Returns the ledger_partitions row as a dict, or None if the month had no
+    rows left in the ledger.
+    """
+    directory = directory or ARCHIVE_DIR
+    end = next_month(start)
+    month = start.strftime("%Y-%m")
+    lo, hi = start.timestamp(), end.timestamp()
+    # finish the deletes of any earlier run first
+    for first_id, last_id in conn.execute(
+        "select first_id, last_id from ledger_partitions where month=?", (month,)
+    ).fetchall():
+        _delete_ids(conn, first_id, last_id, lo, hi)
+    first_id, last_id, rows = conn.execute(
+        "select min(id), max(id), count(*) from ledger where ts>=? and ts<?",
+        (lo, hi),
+    ).fetchone()
+    if not rows:
+        return None
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"ledger-{month}-{first_id}.db"
+    _write_partition(conn, path, lo, hi, last_id)
+    gz, sha256 = _compress(path)
+    part = {
+        "month": month,
+        "first_id": first_id,
+        "last_id": last_id,
+        "rows": rows,
+        "path": str(gz),
+        "sha256": sha256,
+        "archived": now or time.time(),
+    }
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(
+        "insert into ledger_partitions"
+        "(month,first_id,last_id,rows,path,sha256,archived) "
+        "values(:month,:first_id,:last_id,:rows,:path,:sha256,:archived)",
+        part,
+    )
+    conn.commit()
+    deleted = _delete_ids(conn, first_id, last_id, lo, hi)
+    logger.info("archived %d ledger rows of %s to %s", deleted, month, gz)
+    return part
+
+
+def archive(conn, now=None, keep=KEEP_MONTHS, directory=None):
+    """Archive every month older than keep months; returns the new partitions."""
+    now = now or time.time()
+    stop = cutoff(now, keep)
+    oldest = conn.execute(
+        "select min(ts) from ledger where ts<?", (stop.timestamp(),)
+    ).fetchone()[0]
+    parts = []
+    if oldest is None:
+        return parts
+    d = datetime.datetime.fromtimestamp(oldest, datetime.timezone.utc)
+    start = month_start(d.year, d.month)
+    while start < stop:
+        part = archive_month(conn, start, directory, now)
+        if part:
+            parts.append(part)
+        start = next_month(start)
+    return parts
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument(
+        "--keep-months",
+        type=int,
+        default=KEEP_MONTHS,
+        help="full months to keep in the ledger besides the current one",
+    )
+    p.add_argument("--dir", default=str(ARCHIVE_DIR), help="where partitions go")
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    db.init_db()
+    with db.get_conn() as conn:
+        for part in archive(conn, keep=args.keep_months, directory=Path(args.dir)):
+            print(f"{part['month']}: {part['rows']} rows -> {part['path']}")
@@ -0,0 +1,78 @@
+"""Run the API's SQLite work off the event loop.
+
+Handlers await AsyncDB.read() or AsyncDB.write() with a query function
+fn(conn, *args) from queries.py. Reads run on a small pool of threads, each
+with its own pooled connection (WAL lets them proceed while a write is in
+progress). Writes run one at a time on a single writer thread, so
+concurrent requests queue for the writer instead of spinning on
+SQLITE_BUSY, and a slow commit only delays other writes.
+
+The writer is a persist.Persister with a group delay: writes that arrive
+within GROUP_DELAY of the first (up to GROUP_MAX) share one BEGIN IMMEDIATE
+transaction, each under its own savepoint so a write that raises only rolls
+back its own statements. A write's future resolves once the whole group is
+committed, so awaiting it means its ledger rows are durable, and a burst of
+charges costs one fsync instead of one each.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import persist
+
+READERS = 4
+# how long the writer waits for more writes to share a commit
+GROUP_DELAY = 0.002
+GROUP_MAX = 256
+
+
+def _read(fn, args):
+    with db.get_conn() as conn:
+        return fn(conn, *args)
+
+
+def _close(barrier):
+    barrier.wait()
+    db.close_conns()
+
+
+class AsyncDB:
+    def __init__(self, readers=READERS, delay=GROUP_DELAY, max_batch=GROUP_MAX):
+        self.readers = readers
+        self.delay = delay
+        self.max_batch = max_batch
+        self._read_pool = None
+        self._writer = None
+
+    def _pools(self):
+        # created on first use, and again after close()
+        if self._read_pool is None:
+            self._read_pool = ThreadPoolExecutor(
+                self.readers, thread_name_prefix="db-read"
+            )
+            self._writer = persist.Persister(
+                self.max_batch, self.delay, name="db-write", database=db
+            )
+        return self._read_pool, self._writer
+
+    async def read(self, fn, *args):
+        pool = self._pools()[0]
+        return await asyncio.get_running_loop().run_in_executor(pool, _read, fn, args)
+
+    async def write(self, fn, *args):
+        # the write is committed even if the awaiting request is cancelled
+        return await self._pools()[1].run(fn, *args)
+
+    def close(self):
+        """Stop the threads, closing their connections."""
+        if self._read_pool is None:
+            return
+        # the barrier makes every thread take exactly one close job
+        barrier = threading.Barrier(self.readers)
+        for _ in range(self.readers):
+            self._read_pool.submit(_close, barrier)
+        self._read_pool.shutdown()
+        self._writer.close()
+        self._read_pool = self._writer = None
@@ -0,0 +1,161 @@
+"""Session balances cached in memory for the scheduler's watcher charges.
+
+Charging a probe's due watchers is decided from the cache, so the common
+case (every session can pay) costs one conditional UPDATE ... RETURNING
+and the ledger inserts, with no read. The cache is only a hint and can
+never overdraw a session:
+
+- a token that is not cached, or whose cached balance is short of what it
+  owes, is read first, inside the write transaction (this is how top-ups
+  made through the API are picked up);
+- debits are written as credits=credits-spent WHERE credits>=spent; a
+  token the database refuses was spent by another process since it was
+  cached, and is settled by db.charge_watchers() and reloaded.
+
+Ledger rows are written in the caller's transaction, which the persister
+commits together with every other job in its batch. rebuild() seeds the
+cache from the last balance the ledger recorded for each token and then
+reconciles it against sessions.credits, as reconcile() does periodically.
+"""
+
+import logging
+import time
+
+try:
+    from monitor import db
+except ImportError:
+    import db
+
+RECONCILE_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+
+class BalanceService:
+    """Cached sessions.credits per token.
+
+    Lives on whichever thread records probes, like WatcherClock.
+    """
+
+    def __init__(self):
+        self._credits = {}
+        self.stats = {"charges": 0, "loads": 0, "stale": 0, "drift": 0}
+
+    def __len__(self):
+        return len(self._credits)
+
+    def balance(self, token):
+        return self._credits.get(token)
+
+    def load(self, conn, tokens):
+        """Read tokens from sessions into the cache; unknown ones are dropped."""
+        tokens = list(tokens)
+        for i in range(0, len(tokens), db.MAX_BATCH):
+            chunk = tokens[i : i + db.MAX_BATCH]
+            marks = ",".join("?" * len(chunk))
+            for token in chunk:
+                self._credits.pop(token, None)
+            self._credits.update(
+                conn.execute(
+                    f"select token, credits from sessions where token in ({marks})",
+                    chunk,
+                )
+            )
+        self.stats["loads"] += len(tokens)
+
+    def rebuild(self, conn):
+        """Seed the cache from the ledger; returns tokens that disagreed."""
+        self._credits = dict(
+            conn.execute(
+                "select token, balance from ledger where id in "
+                "(select max(id) from ledger where balance is not null group by token)"
+            )
+        )
+        drift = self.reconcile(conn)
+        if drift:
+            logger.warning("%d session balances differ from the ledger", drift)
+        return drift
+
+    def reconcile(self, conn):
+        """Replace the cache with sessions.credits; returns tokens that drifted.
+
+        Drift is expected when the API tops up or charges a cached token.
+        """
+        current = dict(conn.execute("select token, credits from sessions"))
+        drift = sum(1 for t, c in self._credits.items() if current.get(t) != c)
+        self._credits = current
+        self.stats["drift"] += drift
+        return drift
+
+    def charge(self, conn, charges, now=None, cid=None):
+        """Debit (wid, token, cost) charges, like db.charge_watchers().
+
+        Returns (charged, underfunded), lists of (wid, token, balance). The
+        caller commits.
+        """
+        charged, underfunded = [], []
+        if not charges:
+            return charged, underfunded
+        now = now or time.time()
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        self.stats["charges"] += len(charges)
+
+        by_token = {}
+        for wid, token, cost in charges:
+            by_token.setdefault(token, []).append((wid, cost))
+        owed = {t: sum(cost for _, cost in items) for t, items in by_token.items()}
+        self.load(conn, [t for t in by_token if self._credits.get(t, -1) < owed[t]])
+
+        # decide in order who can pay; spent is what each token is debited
+        paid, spent = {}, {}
+        for token, items in by_token.items():
+            bal = self._credits.get(token)
+            paid[token] = []
+            for wid, cost in items:
+                if bal is not None and bal >= cost:
+                    bal -= cost
+                    paid[token].append((wid, cost))
+                else:
+                    underfunded.append((wid, token, bal or 0))
+            if paid[token]:
+                spent[token] = sum(cost for _, cost in paid[token])
+
+        debits = list(spent.items())
+        applied = {}
+        for i in range(0, len(debits), db.MAX_BATCH):
+            chunk = debits[i : i + db.MAX_BATCH]
+            values = ",".join(["(?,?)"] * len(chunk))
+            params = [v for debit in chunk for v in debit]
+            applied.update(
+                conn.execute(
+                    f"with due(token,cost) as (values {values}) "
+                    "update sessions set credits=credits-due.cost, last_used=? "
+                    "from due where sessions.token=due.token "
+                    "and sessions.credits>=due.cost "
+                    "returning sessions.token, sessions.credits",
+                    params + [now],
+                )
+            )
+
+        # only tokens paid in full from the cache can be refused here;
+        # the others were read inside this transaction
+        stale = [t for t in spent if t not in applied]
+        for token, credits in applied.items():
+            self._credits[token] = credits
+            bal = credits + spent[token]
+            for wid, cost in paid[token]:
+                bal -= cost
+                charged.append((wid, token, bal))
+        fresh = [c for c in charges if c[1] not in stale]
+        db.write_charges(conn, fresh, charged, underfunded, now, cid)
+
+        if stale:
+            # another process spent these since they were cached
+            self.stats["stale"] += len(stale)
+            retry = [c for c in charges if c[1] in stale]
+            more, short = db.charge_watchers(conn, retry, now=now, cid=cid)
+            charged += more
+            underfunded += short
+            self.load(conn, stale)
+        return charged, underfunded
@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
-import json
-import subprocess
+import asyncio
+import socket
+import ssl
 import sys
 import time
 from pathlib import Path
+from urllib.parse import urlsplit
 
 sys.path.append("/home/ubuntu/agent-repo/monitor")
 import db
+import reports
 
 LOG = Path("/home/ubuntu/opencode_actions.log")
 EMER = Path("/home/ubuntu/monitor") / "EMERGENCY_PAUSE"
+CUSTOMERS = Path("/home/ubuntu/agent-repo/monitor/customers")
+
+CYCLE = 5
+CONCURRENCY = 200
+PROBE_TIMEOUT = 10
+PORT_TIMEOUT = 5
+READ_CHUNK = 65536
+USER_AGENT = "opencode-monitor/1.0"
+
+_ssl_context = None
 
 
 def log(action, details=""):
@@ -18,177 +31,272 @@ def log(action, details=""):
         f.write(f"{ts}\t{action}\t{details}\n")
 
 
-while True:
-    if EMER.exists():
-        log("CHECKER_PAUSED", "Emergency pause present")
-        time.sleep(30)
-        continue
+def ssl_context():
+    # building a context loads the CA bundle, so do it once per process
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+async def _read_exact(reader, n):
+    while n > 0:
+        chunk = await reader.read(min(n, READ_CHUNK))
+        if not chunk:
+            raise ConnectionError("connection closed mid-body")
+        n -= len(chunk)
+
+
+async def _read_body(reader, headers):
+    # counts decoded body bytes like curl's size_download; nothing is kept
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        size = 0
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("connection closed mid-body")
+            n = int(line.split(b";")[0].strip() or b"0", 16)
+            if n == 0:
+                while (await reader.readline()).strip():
+                    pass
+                return size
+            await _read_exact(reader, n)
+            await reader.readline()
+            size += n
+    if "content-length" in headers:
+        n = int(headers["content-length"])
+        await _read_exact(reader, n)
+        return n
+    size = 0
+    while chunk := await reader.read(READ_CHUNK):
+        size += len(chunk)
+    return size
+
+
+async def _http_exchange(url, timings, start):
+    parts = urlsplit(url)
+    host = parts.hostname
+    if not host:
+        raise ValueError(f"no host in url {url!r}")
+    tls = parts.scheme == "https"
+    port = parts.port or (443 if tls else 80)
+    loop = asyncio.get_running_loop()
+
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    t = time.perf_counter()
+    timings["dns_ms"] = (t - start) * 1000
+
+    error = None
+    for family, type_, proto, _, addr in infos:
+        try:
+            reader, writer = await asyncio.open_connection(
+                addr[0], addr[1], family=family, proto=proto
+            )
+            break
+        except OSError as e:
+            error = e
+    else:
+        raise error or ConnectionError(f"could not connect to {host}")
+    try:
+        t2 = time.perf_counter()
+        timings["connect_ms"] = (t2 - t) * 1000
+        if tls:
+            await writer.start_tls(ssl_context(), server_hostname=host)
+            timings["tls_ms"] = (time.perf_counter() - t2) * 1000
+
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        netloc = host if parts.port is None else f"{host}:{parts.port}"
+        writer.write(
+            (
+                f"GET {path} HTTP/1.1\r\nHost: {netloc}\r\n"
+                f"User-Agent: {USER_AGENT}\r\nAccept: */*\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+        )
+        await writer.drain()
+
+        status_line = await reader.readline()
+        timings["ttfb_ms"] = (time.perf_counter() - start) * 1000
+        fields = status_line.split(None, 2)
+        if len(fields) < 2 or not fields[0].startswith(b"HTTP/"):
+            raise ValueError(f"bad status line {status_line[:64]!r}")
+        status = int(fields[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        size = 0
+        if status >= 200 and status not in (204, 304):
+            size = await _read_body(reader, headers)
+        return status, size
+    finally:
+        writer.close()
+
+
+async def probe_http(url, timeout=PROBE_TIMEOUT):
+    """Probe an HTTP(S) url in-process.
 
-    # Sleep at the beginning of each cycle to prevent excessive CPU usage
-    time.sleep(5)
+    Phase timings mirror curl's -w variables: dns_ms, connect_ms and tls_ms
+    are the durations of each phase, ttfb_ms and latency_ms are measured from
+    the start of the probe (time_starttransfer and time_total). size is the
+    decoded body length (size_download); the body itself is discarded.
+    """
+    timings = {"dns_ms": None, "connect_ms": None, "tls_ms": None, "ttfb_ms": None}
+    start = time.perf_counter()
+    result = {"ok": False, "http_status": 0, "size": 0, "error": None}
     try:
-        with db.get_conn() as conn:
-            c = conn.cursor()
-            # Get watchers with their target information
-            data = c.execute(
-                """
-                SELECT w.wid, w.interval, w.enabled, t.url, t.probe_type
-                FROM watchers w
-                JOIN canonical_targets t ON w.cid = t.cid
-                WHERE w.enabled = 1
-            """
-            ).fetchall()
-            data = [dict(row) for row in data]
+        async with asyncio.timeout(timeout):
+            status, size = await _http_exchange(url, timings, start)
+        result.update(ok=True, http_status=status, size=size)
+    except TimeoutError:
+        result["error"] = f"timed out after {timeout}s"
     except Exception as e:
-        log("CHECKER_DB_ERROR", str(e))
-        data = []
-    for entry in data:
+        result["error"] = str(e) or type(e).__name__
+    result["latency_ms"] = (time.perf_counter() - start) * 1000
+    result.update(timings)
+    return result
 
-        url = entry.get("url")
-        probe_type = entry.get("probe_type", "http")
-        import json
 
-        cfg = json.loads(
-            Path("/home/ubuntu/agent-repo/monitor/config.json").read_text()
-        )
-        interval = max(entry.get("interval", 60), cfg.get("min_interval", 60))
+async def probe_port(url, timeout=PORT_TIMEOUT):
+    parts = urlsplit(url if "//" in url else f"//{url}")
+    start = time.perf_counter()
+    result = {"ok": False, "http_status": 0, "size": 0, "error": None}
+    try:
+        async with asyncio.timeout(timeout):
+            _, writer = await asyncio.open_connection(parts.hostname, parts.port)
+        writer.close()
+        result["ok"] = True
+    except TimeoutError:
+        result["error"] = f"timed out after {timeout}s"
+    except Exception as e:
+        result["error"] = str(e) or type(e).__name__
+    result["latency_ms"] = (time.perf_counter() - start) * 1000
+    return result
 
-        # Get the original interval from database for timing calculations
-        original_interval = entry.get("interval", 60)
 
-        # Check if we should run this check
-        # Use the watcher's specific interval instead of shared canonical target timing
+def load_due(conn, now, skip=()):
+    # a watcher is due once its own interval has passed since its last probe
+    rows = conn.execute(
+        """
+        SELECT w.wid, w.cid, w.token, w.interval, t.url, t.probe_type
+        FROM watchers w
+        JOIN canonical_targets t ON w.cid = t.cid
+        WHERE w.enabled = 1 AND coalesce(w.last_probe, 0) + w.interval <= ?
+        """,
+        (now,),
+    ).fetchall()
+    return [dict(r) for r in rows if r["wid"] not in skip]
+
+
+def write_history(entry, probe):
+    custdir = CUSTOMERS / entry["token"] / "watchers"
+    custdir.mkdir(parents=True, exist_ok=True)
+    history_entry = {
+        "ts": time.time(),
+        "wid": entry["wid"],
+        "cid": entry.get("cid", ""),
+        "probe": probe,
+    }
+    reports.append_record(custdir / f"{entry['wid']}.log", history_entry)
+
+
+class CheckerEngine:
+    """Runs due watcher probes concurrently, at most `concurrency` at a time.
+
+    Each cycle records the probes finished since the previous one, last_probe
+    times and credit charges together, in a single transaction before
+    selecting the next due watchers, so a watcher is never picked up again
+    while its probe is in flight or unrecorded.
+    """
+
+    def __init__(self, concurrency=CONCURRENCY, cost=1):
+        self.sem = asyncio.Semaphore(concurrency)
+        self.cost = cost
+        self.inflight = set()
+        self.probed = {}
+        self.tasks = set()
+
+    async def check(self, entry):
+        async with self.sem:
+            if entry.get("probe_type", "http") == "port":
+                result = await probe_port(entry["url"])
+            else:
+                result = await probe_http(entry["url"])
+        probe = {
+            "ts": time.time(),
+            "status": "ok" if result["ok"] else "fail",
+            "http_status": result["http_status"],
+            "latency_ms": result["latency_ms"],
+            "size": result["size"],
+        }
+        for key in ("dns_ms", "connect_ms", "tls_ms", "ttfb_ms", "error"):
+            if result.get(key) is not None:
+                probe[key] = result[key]
+        self.probed[entry["wid"]] = (time.time(), entry, probe)
+        return probe
+
+    def start(self, entry):
+        wid = entry["wid"]
+        self.inflight.add(wid)
+        task = asyncio.create_task(self.check(entry))
+        self.tasks.add(task)
+
+        def finished(t):
+            self.tasks.discard(t)
+            self.inflight.discard(wid)
+            if not t.cancelled() and t.exception():
+                log("CHECKER_PROBE_ERROR", f"wid={wid} {t.exception()}")
+
+        task.add_done_callback(finished)
+
+    def flush(self, conn):
+        if not self.probed:
+            return 0
+        probed, self.probed = self.probed, {}
+        conn.executemany(
+            "UPDATE watchers SET last_probe = ? WHERE wid = ?",
+            [(ts, wid) for wid, (ts, _, _) in probed.items()],
+        )
+        charged, underfunded = db.charge_watchers(
+            conn,
+            [(wid, entry["token"], self.cost) for wid, (_, entry, _) in probed.items()],
+        )
+        conn.commit()
+        for wid, _, balance in charged:
+            log("CONSUME", f"wid={wid} cost={self.cost} credits_left={balance}")
+            _, entry, probe = probed[wid]
+            write_history(entry, probe)
+        for wid, _, balance in underfunded:
+            log("CHECK_FAILED_CHARGE", f"wid={wid} status=402 credits={balance}")
+        return len(probed)
+
+    def cycle(self, now=None):
         with db.get_conn() as conn:
-            c = conn.cursor()
-            # Get the last probe time for this specific watcher
-            row = c.execute(
-                "SELECT last_probe FROM watchers WHERE wid = ?", (entry.get("wid"),)
-            ).fetchone()
-            last_probe = row["last_probe"] if row else 0
-            if time.time() < (last_probe + original_interval):
-                continue
-
-        # simple HTTP/port probe
-        ok = False
-        latency_ms = 0
-        size = 0
-        if url and probe_type == "http":
-            try:
-                import time
-
-                # Use curl to get timing info in a clean format
-                r = subprocess.run(
-                    [
-                        "curl",
-                        "-sS",
-                        "--max-time",
-                        "10",
-                        "-o",
-                        "/dev/null",
-                        "-w",
-                        "%{time_total}:%{size_download}",
-                        url,
-                    ],
-                    capture_output=True,
-                    text=True,
-                )
-                ok = r.returncode == 0
-                if ok and r.stdout:
-                    # Parse curl output: "time_total:size_download"
-                    parts = r.stdout.strip().split(":")
-                    if len(parts) == 2:
-                        try:
-                            latency_ms = (
-                                float(parts[0]) * 1000
-                            )  # Convert seconds to milliseconds
-                            size = int(parts[1])  # Response size in bytes
-                        except ValueError:
-                            pass
-            except Exception:
-                ok = False
-        elif probe_type == "port" and "host" in entry and "port" in entry:
-            import socket
-
-            s = socket.socket()
-            s.settimeout(5)
-            try:
-                s.connect((entry["host"], int(entry["port"])))
-                ok = True
-            except Exception:
-                ok = False
-            finally:
-                s.close()
-
-        # Update the database with results
+            self.flush(conn)
+            due = load_due(conn, now or time.time(), skip=self.inflight)
+        for entry in due:
+            self.start(entry)
+        return len(due)
+
+
+async def main():
+    engine = CheckerEngine()
+    while True:
+        if EMER.exists():
+            log("CHECKER_PAUSED", "Emergency pause present")
+            await asyncio.sleep(30)
+            continue
+        await asyncio.sleep(CYCLE)
         try:
-            with db.get_conn() as conn:
-                c = conn.cursor()
-                now = time.time()
-                # Only update the watcher's own last_probe time - don't affect other watchers
-                c.execute(
-                    "UPDATE watchers SET last_probe = ? WHERE wid = ?",
-                    (now, entry.get("wid")),
-                )
-                conn.commit()
+            engine.cycle()
         except Exception as e:
-            log("CHECKER_UPDATE_ERROR", str(e))
-        # attempt to consume credits via local API (always attempt)
-        try:
-            import requests
+            log("CHECKER_DB_ERROR", str(e))
 
-            resp = requests.post(
-                "http://127.0.0.1:8000/consume",
-                json={"wid": entry.get("wid"), "cost": 1},
-                timeout=5,
-            )
-            if resp.status_code == 200:
-                credits = resp.json().get("credits")
-                log("CONSUME", f"wid={entry.get('wid')} cost=1 credits_left={credits}")
-                # append to customer history
-                from pathlib import Path
-
-                wid = entry.get("wid")
-                if wid:
-                    # Get the token for this watcher to construct the correct path
-                    with db.get_conn() as conn:
-                        c = conn.cursor()
-                        token_row = c.execute(
-                            "SELECT token FROM watchers WHERE wid = ?", (wid,)
-                        ).fetchone()
-                        if token_row:
-                            token = token_row["token"]
-                            custdir = (
-                                Path("/home/ubuntu/agent-repo/monitor/customers")
-                                / token
-                                / "watchers"
-                            )
-                            custdir.mkdir(parents=True, exist_ok=True)
-                            hist = custdir / f"{wid}.log"
-                            # Write in JSON format for consistency with other history files
-                            import json
-
-                            history_entry = {
-                                "ts": time.time(),
-                                "wid": wid,
-                                "cid": entry.get("cid", ""),
-                                "probe": {
-                                    "ts": time.time(),
-                                    "status": "ok" if ok else "fail",
-                                    "http_status": 200 if ok else 0,
-                                    "latency_ms": latency_ms,
-                                    "size": size,
-                                },
-                            }
-                            with open(hist, "a") as hf:
-                                hf.write(json.dumps(history_entry) + "\n")
-            else:
-                try:
-                    detail = resp.text
-                except Exception:
-                    detail = "(no body)"
-                log(
-                    "CHECK_FAILED_CHARGE",
-                    f"wid={entry.get('wid')} status={resp.status_code} detail={detail}",
-                )
-        except Exception as e:
-            log("CHECK_CHARGE_ERR", str(e))
+
+if __name__ == "__main__":
+    asyncio.run(main())
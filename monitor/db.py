@@ -1,23 +1,33 @@
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
 from pathlib import Path
 
 DB_PATH = Path(__file__).parent / "monitor.db"
+# stay well under SQLite's bound-parameter limit
+MAX_BATCH = 500
 
+# per-connection tuning; journal_mode=WAL is persistent and set by init_db
+BUSY_TIMEOUT_MS = 5000
+MMAP_SIZE = 256 * 1024 * 1024
+STATEMENT_CACHE = 256
 
-def init_db():
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.executescript(
-        """
-    PRAGMA foreign_keys=ON;
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {"opened": 0, "reused": 0, "closed": 0, "checkouts": 0, "in_use": 0}
+_all_conns = {}
+
+
+BASE_SCHEMA = [
+    """
     create table if not exists sessions(
         token text primary key,
         credits integer not null default 0,
         created real not null,
         last_used real
-    );
+    )""",
+    """
     create table if not exists canonical_targets(
         cid text primary key,
         url text not null,
@@ -26,7 +36,8 @@ def init_db():
         last_probe real,
         last_ok integer default 0,
         next_run real
-    );
+    )""",
+    """
     create table if not exists watchers(
         wid text primary key,
         cid text not null references canonical_targets(cid) on delete cascade,
@@ -34,7 +45,8 @@ def init_db():
         interval integer not null,
         enabled integer default 1,
         created real
-    );
+    )""",
+    """
     create table if not exists ledger(
         id integer primary key autoincrement,
         ts real,
@@ -45,18 +57,341 @@ def init_db():
         amount integer,
         balance integer,
         note text
-    );
+    )""",
+]
+
+
+def _add_watcher_last_probe(c):
+    # older deployments added this column by hand
+    columns = [r[1] for r in c.execute("pragma table_info(watchers)")]
+    if "last_probe" not in columns:
+        c.execute("alter table watchers add column last_probe real")
+
+
+# (version, name, statements or callable(cursor)); append only, never edit
+MIGRATIONS = [
+    (1, "base schema", BASE_SCHEMA),
+    (2, "watchers.last_probe", _add_watcher_last_probe),
+    (
+        3,
+        "hot query indexes",
+        [
+            # watchers.wid and canonical_targets.cid are primary keys
+            "create index if not exists idx_watchers_cid on watchers(cid, enabled)",
+            "create index if not exists idx_watchers_token on watchers(token)",
+            "create index if not exists idx_targets_next_run"
+            " on canonical_targets(next_run)",
+            "create index if not exists idx_ledger_token_ts on ledger(token, ts)",
+            "create index if not exists idx_ledger_ts on ledger(ts)",
+        ],
+    ),
+    (
+        4,
+        "scheduler shard leases",
+        [
+            "create table if not exists scheduler_members("
+            "member text primary key, heartbeat real not null)",
+            "create table if not exists shard_leases("
+            "shard integer primary key, owner text not null, expires real not null)",
+            "create index if not exists idx_shard_leases_owner on shard_leases(owner)",
+        ],
+    ),
+    (
+        5,
+        "content change detection",
+        [
+            # on_change watchers are charged only when the content changed
+            # since the fingerprint they last saw
+            "alter table watchers add column on_change integer not null default 0",
+            "alter table watchers add column fingerprint text",
+            "create table if not exists content_changes("
+            "cid text not null, ts real not null, fingerprint text not null, "
+            "size integer)",
+            "create index if not exists idx_content_changes_cid_ts"
+            " on content_changes(cid, ts)",
+        ],
+    ),
+    (
+        6,
+        "consume idempotency keys",
+        [
+            # outcome of a keyed /consume, replayed until expires
+            "create table if not exists idempotency_keys("
+            "wid text not null, key text not null, ok integer not null, "
+            "credits integer not null, expires real not null, "
+            "primary key(wid, key)) without rowid",
+            "create index if not exists idx_idempotency_keys_expires"
+            " on idempotency_keys(expires)",
+        ],
+    ),
+    (
+        7,
+        "ledger rollups and partitions",
+        [
+            # daily (UTC) totals per action, kept by the ledger_rollup trigger
+            # and never decremented, so they outlive archived ledger rows
+            "create table if not exists earnings_daily("
+            "day text not null, token text not null, action text not null, "
+            "events integer not null, amount integer not null, "
+            "primary key(day, token, action)) without rowid",
+            "create table if not exists watcher_earnings_daily("
+            "day text not null, wid text not null, token text not null, "
+            "action text not null, events integer not null, "
+            "amount integer not null, primary key(day, wid, action)) without rowid",
+            "create index if not exists idx_earnings_daily_token"
+            " on earnings_daily(token, day)",
+            "create index if not exists idx_watcher_earnings_daily_token"
+            " on watcher_earnings_daily(token, day)",
+            "insert into earnings_daily(day,token,action,events,amount) "
+            "select date(ts,'unixepoch'), token, action, count(*), "
+            "coalesce(sum(amount),0) from ledger where token is not null "
+            "group by 1, 2, 3",
+            "insert into watcher_earnings_daily(day,wid,token,action,events,amount) "
+            "select date(ts,'unixepoch'), wid, max(token), action, count(*), "
+            "coalesce(sum(amount),0) from ledger "
+            "where wid is not null and token is not null group by 1, 2, 4",
+            """
+            create trigger if not exists ledger_rollup after insert on ledger
+            when new.token is not null
+            begin
+                insert into earnings_daily(day,token,action,events,amount)
+                values(date(new.ts,'unixepoch'), new.token, new.action, 1,
+                       coalesce(new.amount,0))
+                on conflict(day,token,action) do update
+                set events=events+1, amount=amount+excluded.amount;
+                insert into watcher_earnings_daily
+                    (day,wid,token,action,events,amount)
+                select date(new.ts,'unixepoch'), new.wid, new.token, new.action,
+                       1, coalesce(new.amount,0)
+                where new.wid is not null
+                on conflict(day,wid,action) do update
+                set events=events+1, amount=amount+excluded.amount;
+            end""",
+            # ledger months moved out to compressed files by archive.py
+            "create table if not exists ledger_partitions("
+            "month text not null, first_id integer not null, "
+            "last_id integer not null, rows integer not null, "
+            "path text not null, sha256 text not null, archived real not null, "
+            "primary key(month, first_id))",
+        ],
+    ),
+]
+
+
+def schema_version(conn):
+    row = conn.execute(
+        "select name from sqlite_master where type='table' and name='schema_migrations'"
+    ).fetchone()
+    if not row:
+        return 0
+    return conn.execute("select max(version) from schema_migrations").fetchone()[0] or 0
+
+
+def migrate(conn):
+    """Apply pending MIGRATIONS in order, each in its own transaction.
+
+    Returns the list of versions applied.
     """
+    conn.execute(
+        "create table if not exists schema_migrations("
+        "version integer primary key, name text not null, applied real not null)"
     )
     conn.commit()
-    conn.close()
+    current = schema_version(conn)
+    applied = []
+    for version, name, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if callable(steps):
+                steps(c)
+            else:
+                for sql in steps:
+                    c.execute(sql)
+            c.execute(
+                "insert into schema_migrations(version,name,applied) values(?,?,?)",
+                (version, name, time.time()),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
 
 
-@contextmanager
-def get_conn():
+def init_db():
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
     conn = sqlite3.connect(DB_PATH)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        migrate(conn)
+    finally:
+        conn.close()
+
+
+def _connect(path):
+    conn = sqlite3.connect(
+        path, timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=STATEMENT_CACHE
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+@contextmanager
+def get_conn():
+    """Check out this thread's pooled connection to DB_PATH.
+
+    Each thread keeps one open connection per database file and reuses it,
+    so nested get_conn() calls share a connection. Any transaction still
+    open when the outermost block exits is rolled back; callers commit.
+    """
+    path = str(DB_PATH)
+    pool = getattr(_local, "conns", None)
+    if pool is None:
+        pool = _local.conns = {}
+    slot = pool.get(path)
+    with _stats_lock:
+        _stats["checkouts"] += 1
+        _stats["in_use"] += 1
+        if slot is None:
+            _stats["opened"] += 1
+        else:
+            _stats["reused"] += 1
+    if slot is None:
+        try:
+            slot = pool[path] = [_connect(path), 0]
+        except Exception:
+            with _stats_lock:
+                _stats["opened"] -= 1
+                _stats["in_use"] -= 1
+            raise
+        with _stats_lock:
+            _all_conns[(threading.get_ident(), path)] = slot[0]
+    slot[1] += 1
     try:
-        yield conn
+        yield slot[0]
     finally:
+        slot[1] -= 1
+        if slot[1] == 0 and slot[0].in_transaction:
+            slot[0].rollback()
+        with _stats_lock:
+            _stats["in_use"] -= 1
+
+
+def close_conns():
+    """Close this thread's pooled connections (call before a thread exits)."""
+    pool = getattr(_local, "conns", {})
+    closed = list(pool)
+    for path, (conn, _) in list(pool.items()):
         conn.close()
+        with _stats_lock:
+            _all_conns.pop((threading.get_ident(), path), None)
+            _stats["closed"] += 1
+    pool.clear()
+    return closed
+
+
+def pool_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+        stats["open"] = len(_all_conns)
+        stats["threads"] = len({tid for tid, _ in _all_conns})
+    return stats
+
+
+def charge_watchers(conn, charges, now=None, cid=None):
+    """Debit every watcher in `charges` within the current transaction.
+
+    `charges` is a sequence of (wid, token, cost). Sessions that can pay for
+    all of their watchers are debited with one set-based UPDATE ... RETURNING;
+    only sessions short of the total are settled watcher by watcher, in order.
+    Ledger rows are written with executemany. Returns (charged, underfunded),
+    two lists of (wid, token, balance). The caller commits.
+    """
+    charged, underfunded = [], []
+    if not charges:
+        return charged, underfunded
+    now = now or time.time()
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+    by_token = {}
+    for wid, token, cost in charges:
+        by_token.setdefault(token, []).append((wid, cost))
+    tokens = list(by_token)
+
+    balances = {}
+    for i in range(0, len(tokens), MAX_BATCH):
+        chunk = tokens[i : i + MAX_BATCH]
+        values = ",".join(["(?,?)"] * len(chunk))
+        params = []
+        for token in chunk:
+            params += [token, sum(cost for _, cost in by_token[token])]
+        rows = conn.execute(
+            f"with due(token,cost) as (values {values}) "
+            "update sessions set credits=credits-due.cost, last_used=? "
+            "from due where sessions.token=due.token and sessions.credits>=due.cost "
+            "returning sessions.token, sessions.credits",
+            params + [now],
+        ).fetchall()
+        for token, credits in rows:
+            balances[token] = credits
+
+    short = [t for t in tokens if t not in balances]
+    current = {}
+    for i in range(0, len(short), MAX_BATCH):
+        chunk = short[i : i + MAX_BATCH]
+        marks = ",".join("?" * len(chunk))
+        for token, credits in conn.execute(
+            f"select token, credits from sessions where token in ({marks})", chunk
+        ):
+            current[token] = credits
+
+    partial = []
+    for token in tokens:
+        if token in balances:
+            bal = balances[token] + sum(cost for _, cost in by_token[token])
+            for wid, cost in by_token[token]:
+                bal -= cost
+                charged.append((wid, token, bal))
+            continue
+        bal = current.get(token, 0)
+        spent = 0
+        for wid, cost in by_token[token]:
+            if token in current and bal >= cost:
+                bal -= cost
+                spent += cost
+                charged.append((wid, token, bal))
+            else:
+                underfunded.append((wid, token, bal))
+        if spent:
+            partial.append((spent, now, token))
+    if partial:
+        conn.executemany(
+            "update sessions set credits=credits-?, last_used=? where token=?",
+            partial,
+        )
+
+    write_charges(conn, charges, charged, underfunded, now, cid)
+    return charged, underfunded
+
+
+def write_charges(conn, charges, charged, underfunded, now, cid=None):
+    """Write the ledger rows for the outcome of charge_watchers()."""
+    costs = {wid: cost for wid, _, cost in charges}
+    conn.executemany(
+        "insert into ledger(ts,action,token,cid,wid,amount,balance,note) "
+        "values(?,?,?,?,?,?,?,?)",
+        [(now, "CONSUME", t, cid, w, costs[w], b, None) for w, t, b in charged]
+        + [
+            (now, "CHECK_FAILED_CHARGE", t, cid, w, costs[w], b, "insufficient funds")
+            for w, t, b in underfunded
+        ],
+    )
@@ -0,0 +1,45 @@
+"""Incremental content fingerprints of probed bodies.
+
+A Fingerprint hashes a body chunk by chunk as the probe streams it, so the
+body is never held in memory. Volatile regions (timestamps, CSRF tokens,
+ad slots) can be stripped first with regular expressions; they are applied
+line by line, so a pattern must not span a newline. A line longer than
+MAX_LINE is hashed in pieces and patterns may miss a match across a piece
+boundary.
+"""
+
+import hashlib
+import re
+
+MAX_LINE = 64 * 1024
+
+
+class Fingerprint:
+    def __init__(self, hash_name="sha256", strip=()):
+        self._hash = hashlib.new(hash_name)
+        self._strip = [
+            re.compile(p.encode() if isinstance(p, str) else p) for p in strip
+        ]
+        self._tail = b""
+
+    def update(self, chunk):
+        if not self._strip:
+            self._hash.update(chunk)
+            return
+        data = self._tail + chunk
+        cut = data.rfind(b"\n") + 1
+        if not cut and len(data) > MAX_LINE:
+            cut = len(data)
+        self._tail = data[cut:]
+        self._feed(data[:cut])
+
+    def _feed(self, data):
+        for pattern in self._strip:
+            data = pattern.sub(b"", data)
+        self._hash.update(data)
+
+    def hexdigest(self):
+        if self._tail:
+            self._feed(self._tail)
+            self._tail = b""
+        return self._hash.hexdigest()
@@ -0,0 +1,82 @@
+"""Per-host politeness for probes.
+
+Each host gets a token bucket (HOST_RATE probes per second, bursts of up to
+HOST_BURST) and a cap of HOST_CONCURRENCY probes in flight. The limiter
+never blocks: try_acquire() either takes a slot or says how long to wait,
+so the scheduler can put the target back in its queue instead of parking a
+worker on a busy host.
+"""
+
+import zlib
+from urllib.parse import urlsplit
+
+HOST_RATE = 1.0
+HOST_BURST = 5
+HOST_CONCURRENCY = 2
+# how long to wait for a host at its concurrency cap before trying again
+BUSY_RETRY = 1.0
+
+
+def host_of(url):
+    return (urlsplit(url).hostname or url).lower()
+
+
+def jitter(key, window):
+    """Stable offset in [0, window) for key, to spread starts."""
+    return zlib.crc32(key.encode()) / 2**32 * window
+
+
+class HostLimiter:
+    def __init__(self, rate=HOST_RATE, burst=HOST_BURST, concurrency=HOST_CONCURRENCY):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        # host -> [tokens, last refill, in flight]
+        self._hosts = {}
+        self.stats = {"acquired": 0, "rate_limited": 0, "busy": 0}
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            rate=cfg.get("host_rate", HOST_RATE),
+            burst=cfg.get("host_burst", HOST_BURST),
+            concurrency=cfg.get("host_concurrency", HOST_CONCURRENCY),
+        )
+
+    def try_acquire(self, host, now):
+        """Take a probe slot on host; returns 0, or seconds to wait first."""
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = [self.burst, now, 0]
+        tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+        state[0], state[1] = tokens, now
+        if state[2] >= self.concurrency:
+            self.stats["busy"] += 1
+            return BUSY_RETRY
+        if tokens < 1:
+            self.stats["rate_limited"] += 1
+            return (1 - tokens) / self.rate
+        state[0] -= 1
+        state[2] += 1
+        self.stats["acquired"] += 1
+        return 0
+
+    def release(self, host):
+        state = self._hosts.get(host)
+        if state is not None and state[2] > 0:
+            state[2] -= 1
+
+    def in_flight(self, host):
+        state = self._hosts.get(host)
+        return state[2] if state else 0
+
+    def prune(self, now):
+        """Forget idle hosts whose bucket has refilled."""
+        idle = [
+            host
+            for host, (tokens, last, active) in self._hosts.items()
+            if not active and tokens + (now - last) * self.rate >= self.burst
+        ]
+        for host in idle:
+            del self._hosts[host]
+        return len(idle)
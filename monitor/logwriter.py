@@ -0,0 +1,184 @@
+"""Write-behind appends for probe results and watcher histories.
+
+write() only buffers bytes per file, so it is cheap to call from the event
+loop. Buffers are written by a worker thread once FLUSH_INTERVAL has passed
+or MAX_BUFFER bytes are pending, one write() per file per flush, through a
+bounded LRU of append handles. fsync follows the configured policy:
+
+    always    fsync every file written by a flush
+    interval  fsync written files at most every FSYNC_INTERVAL seconds
+    never     leave it to the OS
+
+Data is lost only if the process dies with buffers pending, i.e. at most
+FLUSH_INTERVAL seconds' worth, plus whatever the fsync policy leaves in the
+page cache on a crash of the machine.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+MAX_OPEN = 256
+MAX_BUFFER = 1 << 20
+FLUSH_INTERVAL = 1.0
+FSYNC_INTERVAL = 5.0
+FSYNC_POLICIES = ("always", "interval", "never")
+
+logger = logging.getLogger(__name__)
+
+
+class LogWriter:
+    def __init__(
+        self,
+        max_open=MAX_OPEN,
+        max_buffer=MAX_BUFFER,
+        flush_interval=FLUSH_INTERVAL,
+        fsync="interval",
+        fsync_interval=FSYNC_INTERVAL,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync policy must be one of {FSYNC_POLICIES}")
+        self.max_open = max_open
+        self.max_buffer = max_buffer
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._pending = {}
+        self._sealed = []
+        self._size = 0
+        self._lock = threading.Lock()
+        # held while a batch is written; handles are only touched under it
+        self._io_lock = threading.Lock()
+        self._handles = OrderedDict()
+        self._unsynced = set()
+        self._last_fsync = time.monotonic()
+        self._loop = None
+        self._kick = None
+        self.stats = {"flushes": 0, "writes": 0, "bytes": 0, "opens": 0, "fsyncs": 0}
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            max_open=cfg.get("log_max_open", MAX_OPEN),
+            max_buffer=cfg.get("log_max_buffer", MAX_BUFFER),
+            flush_interval=cfg.get("log_flush_interval", FLUSH_INTERVAL),
+            fsync=cfg.get("log_fsync", "interval"),
+            fsync_interval=cfg.get("log_fsync_interval", FSYNC_INTERVAL),
+        )
+
+    def write(self, path, data):
+        with self._lock:
+            buf = self._pending.get(path)
+            if buf is None:
+                buf = self._pending[path] = bytearray()
+            buf += data
+            self._size += len(data)
+            full = self._size >= self.max_buffer
+        if full and self._kick is not None:
+            # write() may be called off the loop thread
+            self._loop.call_soon_threadsafe(self._kick.set)
+
+    def seal(self, path, fn):
+        """Run fn(path) on the flush thread once path's data is on disk.
+
+        Nothing may be written to path afterwards; its handle is closed
+        before fn runs.
+        """
+        with self._lock:
+            self._sealed.append((path, fn))
+
+    def flush(self):
+        """Write out everything buffered so far; blocks until done."""
+        # batches are swapped under the io lock so they land in order
+        with self._io_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                sealed, self._sealed = self._sealed, []
+                self._size = 0
+            if not batch and not sealed:
+                return 0
+            self._write_batch(batch)
+            for path, fn in sealed:
+                self._close(path)
+                try:
+                    fn(path)
+                except Exception:
+                    logger.exception("sealing %s failed", path)
+        return len(batch)
+
+    def _open(self, path):
+        f = self._handles.pop(path, None)
+        if f is None:
+            if len(self._handles) >= self.max_open:
+                self._close(next(iter(self._handles)))
+            try:
+                f = open(path, "ab", buffering=0)
+            except FileNotFoundError:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                f = open(path, "ab", buffering=0)
+            self.stats["opens"] += 1
+        self._handles[path] = f
+        return f
+
+    def _close(self, path):
+        f = self._handles.pop(path, None)
+        if f is None:
+            return
+        if path in self._unsynced:
+            self._unsynced.discard(path)
+            if self.fsync != "never":
+                self._fsync(f)
+        f.close()
+
+    def _fsync(self, f):
+        os.fsync(f.fileno())
+        self.stats["fsyncs"] += 1
+
+    def _write_batch(self, batch):
+        for path, data in batch.items():
+            try:
+                f = self._open(path)
+                view = memoryview(data)
+                while view:
+                    view = view[f.write(view) :]
+            except OSError:
+                logger.exception("dropping %d bytes for %s", len(data), path)
+                self._close(path)
+                continue
+            self.stats["writes"] += 1
+            self.stats["bytes"] += len(data)
+            if self.fsync == "always":
+                self._fsync(f)
+            else:
+                self._unsynced.add(path)
+        self.stats["flushes"] += 1
+        now = time.monotonic()
+        if self.fsync == "interval" and now - self._last_fsync >= self.fsync_interval:
+            for path in list(self._unsynced):
+                if path in self._handles:
+                    self._fsync(self._handles[path])
+            self._unsynced.clear()
+            self._last_fsync = now
+
+    async def run(self):
+        """Flush in a worker thread every flush_interval, or sooner when full."""
+        self._loop = asyncio.get_running_loop()
+        self._kick = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._kick.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._kick.clear()
+            await asyncio.to_thread(self.flush)
+
+    def close(self):
+        """Flush and close every handle; the writer stays usable."""
+        self.flush()
+        with self._io_lock:
+            for path in list(self._handles):
+                self._close(path)
@@ -0,0 +1,91 @@
+"""Schedule lag tracking and overload detection.
+
+Lag is how late a probe starts compared to its next_run. Every lag goes
+into a cumulative histogram (LAG_BUCKETS, in seconds, as exported in the
+scheduler metrics) and into a short window of recent lags. The scheduler is
+overloaded while the p95 of the recent window is above OVERLOAD_LAG and
+recovers once it falls below RECOVER_LAG; while overloaded, low-priority
+targets are pushed back by backoff() instead of being probed. That delay is
+deliberate, so their lag counts from the end of the backoff; a target held
+back by its host keeps counting from its next_run.
+"""
+
+import bisect
+import time
+from collections import deque
+
+LAG_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300)
+LAG_WINDOW = 60
+OVERLOAD_LAG = 10.0
+RECOVER_LAG = 2.0
+MIN_BACKOFF = 30
+MAX_BACKOFF = 600
+# targets whose watchers all use at least this interval are low priority
+LOW_PRIORITY_INTERVAL = 900
+MAX_EVENTS = 20
+
+
+class LagMonitor:
+    def __init__(self, overload_lag=OVERLOAD_LAG, recover_lag=RECOVER_LAG):
+        self.overload_lag = overload_lag
+        self.recover_lag = recover_lag
+        self.counts = [0] * (len(LAG_BUCKETS) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self._recent = deque(maxlen=4096)
+        self.overloaded = False
+        self.shed = 0
+        self.events = deque(maxlen=MAX_EVENTS)
+
+    def record(self, lag, now=None):
+        lag = max(lag, 0.0)
+        self.counts[bisect.bisect_left(LAG_BUCKETS, lag)] += 1
+        self.total += 1
+        self.sum += lag
+        self._recent.append((time.time() if now is None else now, lag))
+
+    def recent_quantile(self, q, now):
+        while self._recent and self._recent[0][0] < now - LAG_WINDOW:
+            self._recent.popleft()
+        if not self._recent:
+            return 0.0
+        lags = sorted(lag for _, lag in self._recent)
+        return lags[int(q * (len(lags) - 1))]
+
+    def update(self, now):
+        """Re-evaluate overload; returns an event dict when the state flips."""
+        p95 = self.recent_quantile(0.95, now)
+        if not self.overloaded and p95 > self.overload_lag:
+            self.overloaded = True
+            kind = "overload"
+        elif self.overloaded and p95 < self.recover_lag:
+            self.overloaded = False
+            kind = "recovered"
+        else:
+            return None
+        event = {"ts": now, "event": kind, "p95_lag": round(p95, 3), "shed": self.shed}
+        self.events.append(event)
+        return event
+
+    def backoff(self, now):
+        """How far to push back a low-priority target while overloaded."""
+        p95 = self.recent_quantile(0.95, now)
+        return min(max(2 * p95, MIN_BACKOFF), MAX_BACKOFF)
+
+    def metrics(self, now=None):
+        now = time.time() if now is None else now
+        cumulative = 0
+        histogram = {}
+        for le, n in zip([*LAG_BUCKETS, "+Inf"], self.counts):
+            cumulative += n
+            histogram[str(le)] = cumulative
+        return {
+            "histogram": histogram,
+            "count": self.total,
+            "sum": round(self.sum, 3),
+            "p50": round(self.recent_quantile(0.5, now), 3),
+            "p95": round(self.recent_quantile(0.95, now), 3),
+            "overloaded": self.overloaded,
+            "shed": self.shed,
+            "events": list(self.events),
+        }
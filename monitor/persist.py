@@ -0,0 +1,146 @@
+"""Single writer thread for the scheduler's database and file mutations.
+
+Probe coroutines hand their results to a Persister and never touch SQLite
+or the disk themselves, so a commit or a checkpoint no longer stalls the
+event loop (and the latency of every probe in flight).
+
+Jobs run in submission order on one thread. DB jobs are fn(conn, *args):
+whatever has queued up while the previous batch was being applied is run in
+one BEGIN IMMEDIATE transaction, each job under its own savepoint so a
+failing job only rolls back its own statements. Jobs must not commit.
+Futures resolve once the batch is committed. Plain jobs (call()) run
+outside any transaction.
+
+With a delay, the thread waits up to that long after the first job of a
+batch for more to arrive, so a burst of small writes shares one commit
+(group commit) at the cost of that much latency.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+try:
+    from monitor import db
+except ImportError:
+    import db
+
+MAX_BATCH = 500
+
+logger = logging.getLogger(__name__)
+
+
+class Persister:
+    def __init__(self, max_batch=MAX_BATCH, delay=0.0, name="persist", database=None):
+        # database: the db module to use, for callers that import it as plain db
+        self.max_batch = max_batch
+        self.delay = delay
+        self._db = database or db
+        self._jobs = queue.SimpleQueue()
+        self.stats = {"jobs": 0, "failed": 0, "transactions": 0}
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        """Queue fn(conn, *args); returns a concurrent.futures.Future."""
+        return self._put(fn, args, True)
+
+    def call(self, fn, *args):
+        """Queue fn(*args) to run on the writer thread outside a transaction."""
+        return self._put(fn, args, False)
+
+    def _put(self, fn, args, uses_db):
+        fut = Future()
+        self._jobs.put((fn, args, uses_db, fut))
+        return fut
+
+    async def run(self, fn, *args):
+        # handed-off work is applied even if the awaiting task is cancelled
+        return await asyncio.shield(asyncio.wrap_future(self.submit(fn, *args)))
+
+    def close(self):
+        """Apply everything queued so far and stop the thread."""
+        self._jobs.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self._jobs.get()]
+            deadline = time.monotonic() + self.delay
+            while batch[-1] is not None and len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        batch.append(self._jobs.get(timeout=timeout))
+                    else:
+                        batch.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            # consecutive DB jobs share a transaction
+            group = []
+            for job in batch:
+                if job[2]:
+                    group.append(job)
+                    continue
+                self._apply(group)
+                group = []
+                self._call(job)
+            self._apply(group)
+            if stop:
+                self._db.close_conns()
+                return
+
+    def _call(self, job):
+        fn, args, _, fut = job
+        if not fut.set_running_or_notify_cancel():
+            return
+        self.stats["jobs"] += 1
+        try:
+            fut.set_result(fn(*args))
+        except BaseException as e:
+            self.stats["failed"] += 1
+            fut.set_exception(e)
+
+    def _apply(self, jobs):
+        jobs = [job for job in jobs if job[3].set_running_or_notify_cancel()]
+        if not jobs:
+            return
+        outcomes = []
+        try:
+            with self._db.get_conn() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for fn, args, _, fut in jobs:
+                    conn.execute("SAVEPOINT job")
+                    try:
+                        outcomes.append((fut, fn(conn, *args), None))
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO job")
+                        outcomes.append((fut, None, e))
+                    conn.execute("RELEASE job")
+                conn.commit()
+        except Exception as e:
+            logger.exception("persist batch of %d jobs failed", len(jobs))
+            self.stats["failed"] += len(jobs)
+            for _, _, _, fut in jobs:
+                fut.set_exception(e)
+            return
+        self.stats["transactions"] += 1
+        for fut, result, error in outcomes:
+            self.stats["jobs"] += 1
+            if error is None:
+                fut.set_result(result)
+            else:
+                self.stats["failed"] += 1
+                fut.set_exception(error)
+
+
+def log_failure(fut):
+    """Done-callback for fire-and-forget jobs."""
+    if not fut.cancelled() and fut.exception() is not None:
+        logger.error("persist job failed: %s", fut.exception())
@@ -0,0 +1,183 @@
+"""Run probes in worker processes so HTTP handling can use several cores.
+
+The scheduler process keeps the queue, the limiters and the persister. A
+ProbePool starts K worker processes, each with its own event loop and HTTP
+session. Targets are handed to the least loaded worker over its task queue,
+batched per event-loop turn. Results come back on one shared queue in
+batches of up to RESULT_BATCH, or every RESULT_DELAY seconds. A reader
+thread resolves the matching futures in the scheduler's loop.
+
+A worker that dies has its pending probes failed with an error record and
+is replaced by check().
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import signal
+import threading
+
+RESULT_BATCH = 64
+RESULT_DELAY = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+def _worker_main(tasks, results, cfg):
+    # the scheduler shuts workers down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve(tasks, results, cfg))
+
+
+async def _serve(tasks, results, cfg):
+    from monitor import scheduler
+
+    loop = asyncio.get_running_loop()
+    session = scheduler.make_session(cfg)
+    options = scheduler.probe_options(cfg)
+    out = []
+
+    def send():
+        if out:
+            results.put(out[:])
+            out.clear()
+
+    async def probe(cid, url):
+        out.append(await scheduler.probe_target(session, cid, url, **options))
+        if len(out) >= RESULT_BATCH:
+            send()
+
+    async def sender():
+        while True:
+            await asyncio.sleep(RESULT_DELAY)
+            send()
+
+    flusher = asyncio.create_task(sender())
+    running = set()
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, tasks.get)
+            if batch is None:
+                break
+            for cid, url in batch:
+                task = asyncio.create_task(probe(cid, url))
+                running.add(task)
+                task.add_done_callback(running.discard)
+        await asyncio.gather(*running)
+    finally:
+        flusher.cancel()
+        send()
+        await session.close()
+
+
+class ProbePool:
+    def __init__(self, workers, cfg=None):
+        self.cfg = cfg or {}
+        self._ctx = multiprocessing.get_context("spawn")
+        self._results = self._ctx.Queue()
+        self._tasks = [None] * workers
+        self._procs = [None] * workers
+        self._outbox = [[] for _ in range(workers)]
+        self._load = [0] * workers
+        # cid -> (worker index, future)
+        self._pending = {}
+        self._send_scheduled = False
+        self._loop = None
+        self._reader = None
+        self.stats = {"sent": 0, "results": 0, "batches": 0, "restarts": 0}
+
+    def __len__(self):
+        return len(self._procs)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        for i in range(len(self._procs)):
+            self._spawn(i)
+        self._reader = threading.Thread(
+            target=self._read, name="probe-results", daemon=True
+        )
+        self._reader.start()
+
+    def _spawn(self, i):
+        self._tasks[i] = self._ctx.Queue()
+        self._procs[i] = self._ctx.Process(
+            target=_worker_main,
+            args=(self._tasks[i], self._results, self.cfg),
+            name=f"probe-worker-{i}",
+            daemon=True,
+        )
+        self._procs[i].start()
+
+    def probe(self, cid, url):
+        """Probe url in a worker; returns a future for its result record."""
+        fut = self._loop.create_future()
+        i = min(range(len(self._load)), key=self._load.__getitem__)
+        self._pending[cid] = (i, fut)
+        self._load[i] += 1
+        self._outbox[i].append((cid, url))
+        if not self._send_scheduled:
+            self._send_scheduled = True
+            self._loop.call_soon(self._send)
+        return fut
+
+    def _send(self):
+        self._send_scheduled = False
+        for i, box in enumerate(self._outbox):
+            if box:
+                self._tasks[i].put(box)
+                self.stats["sent"] += len(box)
+                self._outbox[i] = []
+
+    def _read(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+            self._loop.call_soon_threadsafe(self._resolve, item)
+
+    def _resolve(self, recs):
+        self.stats["batches"] += 1
+        for rec in recs:
+            self._finish(rec["cid"], rec)
+
+    def _finish(self, cid, rec):
+        entry = self._pending.pop(cid, None)
+        if entry is None:
+            return
+        i, fut = entry
+        self._load[i] -= 1
+        self.stats["results"] += 1
+        if not fut.done():
+            fut.set_result(rec)
+
+    def check(self, now):
+        """Replace dead workers, failing the probes they had taken."""
+        for i, proc in enumerate(self._procs):
+            if proc.is_alive():
+                continue
+            logger.warning("probe worker %d exited (%s)", i, proc.exitcode)
+            lost = [cid for cid, (w, _) in self._pending.items() if w == i]
+            for cid in lost:
+                rec = {
+                    "ts": now,
+                    "cid": cid,
+                    "status": "error",
+                    "error": "probe worker exited",
+                }
+                self._finish(cid, rec)
+            self._outbox[i] = []
+            self.stats["restarts"] += 1
+            self._spawn(i)
+
+    async def close(self):
+        """Let workers finish what they were sent, then stop them."""
+        self._send()
+        for tasks in self._tasks:
+            tasks.put(None)
+        await asyncio.to_thread(self._join)
+
+    def _join(self):
+        for proc in self._procs:
+            proc.join()
+        self._results.put(None)
+        self._reader.join()
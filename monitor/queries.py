@@ -0,0 +1,272 @@
+"""Query functions shared by the API routes.
+
+Each takes a connection first and is run through asyncdb.AsyncDB: read
+functions only select, write functions run inside the writer's transaction
+and never commit. They return plain values, dicts or the NamedTuples below
+and leave HTTP status codes to the handlers.
+"""
+
+import sqlite3
+from typing import NamedTuple
+
+# how long a /consume idempotency key replays its first outcome
+IDEMPOTENCY_TTL = 24 * 3600
+
+
+class Topup(NamedTuple):
+    token: str
+    balance: int
+    action: str
+
+
+class Charge(NamedTuple):
+    ok: bool
+    token: str
+    balance: int
+    replayed: bool = False
+
+
+def session_exists(conn: sqlite3.Connection, token: str) -> bool:
+    row = conn.execute("select 1 from sessions where token=?", (token,)).fetchone()
+    return row is not None
+
+
+def topup(
+    conn: sqlite3.Connection, token: str | None, new_token: str, sats: int, ts: float
+) -> Topup | None:
+    """Credit sats to token, or to a new session if token is None.
+
+    Returns None if token names no session.
+    """
+    if not token:
+        conn.execute(
+            "insert into sessions(token,credits,created,last_used) values(?,?,?,?)",
+            (new_token, sats, ts, ts),
+        )
+        result = Topup(new_token, sats, "CREATE_SESSION_TOPUP")
+    else:
+        row = conn.execute(
+            "update sessions set credits=credits+?, last_used=? where token=? "
+            "returning credits",
+            (sats, ts, token),
+        ).fetchone()
+        if row is None:
+            return None
+        result = Topup(token, row["credits"], "TOPUP")
+    conn.execute(
+        "insert into ledger(ts,action,token,amount,balance,note) values(?,?,?,?,?,?)",
+        (ts, result.action, result.token, sats, result.balance, None),
+    )
+    return result
+
+
+def register_watcher(
+    conn: sqlite3.Connection,
+    token: str,
+    cid: str,
+    url: str,
+    wid: str,
+    interval: int,
+    on_change: bool,
+    ts: float,
+) -> bool:
+    """Add a watcher, and its canonical target if new; False if no session."""
+    if not session_exists(conn, token):
+        return False
+    conn.execute(
+        "insert or ignore into canonical_targets"
+        "(cid,url,fingerprint,probe_type,last_probe,last_ok,next_run) "
+        "values(?,?,?,?,?,?,?)",
+        (cid, url, None, "http", None, 0, ts),
+    )
+    conn.execute(
+        "insert into watchers(wid,cid,token,interval,enabled,created,on_change) "
+        "values(?,?,?,?,?,?,?)",
+        (wid, cid, token, interval, 1, ts, 1 if on_change else 0),
+    )
+    return True
+
+
+def dashboard(conn: sqlite3.Connection, token: str) -> dict | None:
+    session = conn.execute(
+        "select token,credits,created,last_used from sessions where token=?",
+        (token,),
+    ).fetchone()
+    if session is None:
+        return None
+    watchers = conn.execute(
+        "select w.wid,w.interval,w.enabled,w.created,w.on_change, t.url "
+        "from watchers w join canonical_targets t on w.cid=t.cid where w.token=?",
+        (token,),
+    ).fetchall()
+    return {"session": dict(session), "watchers": [dict(w) for w in watchers]}
+
+
+def list_targets(conn: sqlite3.Connection) -> list[dict]:
+    rows = conn.execute(
+        "select cid,url,last_probe,last_ok,next_run from canonical_targets"
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def content_changes(
+    conn: sqlite3.Connection, cid: str, since: float | None, limit: int
+) -> list[dict]:
+    rows = conn.execute(
+        "select ts,fingerprint,size from content_changes "
+        "where cid=? and ts>=? order by ts desc limit ?",
+        (cid, since or 0, limit),
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def consume(
+    conn: sqlite3.Connection,
+    wid: str,
+    cost: int,
+    ts: float,
+    key: str | None = None,
+    ttl: float = IDEMPOTENCY_TTL,
+) -> Charge | None:
+    """Charge cost to the session owning wid; None if the watcher is unknown.
+
+    The balance check and debit are one conditional UPDATE ... RETURNING, so
+    concurrent charges can never overdraw a session. A charge that cannot be
+    paid is recorded as CHECK_FAILED_CHARGE. With a key, the outcome is kept
+    for ttl seconds and a retry with the same (wid, key) replays it instead
+    of charging again.
+    """
+    if key is not None:
+        row = conn.execute(
+            "select ok, credits from idempotency_keys "
+            "where wid=? and key=? and expires>?",
+            (wid, key, ts),
+        ).fetchone()
+        if row is not None:
+            token = conn.execute(
+                "select token from watchers where wid=?", (wid,)
+            ).fetchone()
+            return Charge(
+                bool(row["ok"]), token and token["token"], row["credits"], True
+            )
+    row = conn.execute(
+        "update sessions set credits=credits-?, last_used=? "
+        "where token=(select token from watchers where wid=?) and credits>=? "
+        "returning token, credits",
+        (cost, ts, wid, cost),
+    ).fetchone()
+    if row is not None:
+        charge = Charge(True, row["token"], row["credits"])
+        conn.execute(
+            "insert into ledger(ts,action,token,wid,amount,balance) "
+            "values(?,?,?,?,?,?)",
+            (ts, "CONSUME", charge.token, wid, cost, charge.balance),
+        )
+    else:
+        row = conn.execute(
+            "select s.token, s.credits from watchers w "
+            "join sessions s on s.token=w.token where w.wid=?",
+            (wid,),
+        ).fetchone()
+        if row is None:
+            return None
+        charge = Charge(False, row["token"], row["credits"])
+        conn.execute(
+            "insert into ledger(ts,action,token,wid,amount,balance,note) "
+            "values(?,?,?,?,?,?,?)",
+            (
+                ts,
+                "CHECK_FAILED_CHARGE",
+                charge.token,
+                wid,
+                cost,
+                charge.balance,
+                "insufficient funds",
+            ),
+        )
+    if key is not None:
+        # an expired row for the same key is overwritten
+        conn.execute(
+            "insert or replace into idempotency_keys(wid,key,ok,credits,expires) "
+            "values(?,?,?,?,?)",
+            (wid, key, int(charge.ok), charge.balance, ts + ttl),
+        )
+    return charge
+
+
+def consume_batch(
+    conn: sqlite3.Connection,
+    charges: list[tuple[str, int, str | None]],
+    ts: float,
+    ttl: float = IDEMPOTENCY_TTL,
+) -> list[Charge | None]:
+    """consume() every (wid, cost, key) in order, in the caller's transaction."""
+    return [consume(conn, wid, cost, ts, key, ttl) for wid, cost, key in charges]
+
+
+def purge_idempotency_keys(conn: sqlite3.Connection, now: float) -> int:
+    return conn.execute(
+        "delete from idempotency_keys where expires<=?", (now,)
+    ).rowcount
+
+
+# rollup table and columns behind each /admin/earnings grouping
+EARNINGS = {
+    "token": ("earnings_daily", "day,token,action,events,amount"),
+    "watcher": ("watcher_earnings_daily", "day,wid,token,action,events,amount"),
+}
+
+
+def earnings(
+    conn: sqlite3.Connection,
+    since: str | None,
+    until: str | None,
+    by: str = "token",
+) -> list[dict]:
+    """Daily totals per action between two UTC days (YYYY-MM-DD), inclusive.
+
+    Read from the rollups, so the cost does not depend on the ledger's size
+    and archived months are included.
+    """
+    table, columns = EARNINGS[by]
+    rows = conn.execute(
+        f"select {columns} from {table} where day>=? and day<=? order by {columns}",
+        (since or "", until or "9999-12-31"),
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def receipt(
+    conn: sqlite3.Connection, token: str, since: str | None, until: str | None
+) -> dict | None:
+    """A session's daily and per-watcher totals; None if no such session."""
+    session = conn.execute(
+        "select token,credits from sessions where token=?", (token,)
+    ).fetchone()
+    if session is None:
+        return None
+    bounds = (token, since or "", until or "9999-12-31")
+    days = conn.execute(
+        "select day,action,events,amount from earnings_daily "
+        "where token=? and day>=? and day<=? order by day, action",
+        bounds,
+    ).fetchall()
+    watchers = conn.execute(
+        "select wid,action,sum(events) as events,sum(amount) as amount "
+        "from watcher_earnings_daily where token=? and day>=? and day<=? "
+        "group by wid, action order by wid, action",
+        bounds,
+    ).fetchall()
+    totals = {}
+    for d in days:
+        total = totals.setdefault(d["action"], {"events": 0, "amount": 0})
+        total["events"] += d["events"]
+        total["amount"] += d["amount"]
+    return {
+        **dict(session),
+        "since": since,
+        "until": until,
+        "totals": totals,
+        "days": [dict(d) for d in days],
+        "watchers": [dict(w) for w in watchers],
+    }
@@ -1,31 +1,247 @@
 import json
+import os
+import struct
 from pathlib import Path
 
+# imported both as monitor.reports (scheduler) and as reports (API)
+try:
+    from monitor import stats, store
+except ImportError:
+    import stats
+    import store
+
 BASE = Path(__file__).parent
 RESULTS = BASE / "results"
 ANALYTICS = BASE / "analytics"
+METRICS = BASE / "scheduler_metrics.json"
+BLOCK_SIZE = 8192
+# sidecar index: one (bucket start, byte offset) entry per bucket of records
+INDEX_BUCKET = 3600
+INDEX_ENTRY = struct.Struct("<qQ")
+
+
+def reverse_lines(f, block_size=None, end=None):
+    # yields the lines of a binary file last to first, reading backwards in
+    # blocks; the first line yielded may be a partial, still-being-written one
+    block_size = block_size or BLOCK_SIZE
+    if end is None:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+    pos = end
+    head = b""
+    while pos > 0:
+        step = min(block_size, pos)
+        pos -= step
+        f.seek(pos)
+        lines = (f.read(step) + head).split(b"\n")
+        head = lines.pop(0)
+        yield from reversed(lines)
+    yield head
 
 
 def tail_lines(path, n=100):
-    if not path.exists():
+    """Return the last n JSON records of an append-only log.
+
+    Cost depends on n, not on the file size. Blank, partial and corrupt
+    lines are skipped.
+    """
+    if n <= 0 or not path.exists():
         return []
-    with path.open() as f:
-        lines = f.readlines()[-n:]
-    return [json.loads(line) for line in lines]
+    out = []
+    with path.open("rb") as f:
+        for line in reverse_lines(f):
+            if not line.strip():
+                continue
+            try:
+                out.append(json.loads(line))
+            except ValueError:
+                continue
+            if len(out) >= n:
+                break
+    out.reverse()
+    return out
+
+
+def index_path(path):
+    return path.with_name(path.name + ".idx")
+
+
+def _index_entry(f, i):
+    f.seek(i * INDEX_ENTRY.size)
+    return INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+
+
+def _index_count(idx):
+    # a torn trailing entry is ignored
+    return idx.stat().st_size // INDEX_ENTRY.size
+
+
+def note_offset(path, ts, offset):
+    """Record that the bucket holding ts starts at offset, if it is new."""
+    bucket = int(ts // INDEX_BUCKET) * INDEX_BUCKET
+    idx = index_path(path)
+    n = _index_count(idx) if idx.exists() else 0
+    if n:
+        with idx.open("rb") as f:
+            if _index_entry(f, n - 1)[0] >= bucket:
+                return
+    with idx.open("r+b" if n else "wb") as f:
+        f.seek(n * INDEX_ENTRY.size)
+        f.write(INDEX_ENTRY.pack(bucket, offset))
+        f.truncate()
+
+
+def append_record(path, rec):
+    """Append one JSON record to a log and keep its sidecar index current.
+
+    Records are expected in (roughly) increasing "ts" order, as probes are.
+    """
+    line = (json.dumps(rec) + "\n").encode()
+    with path.open("ab") as f:
+        offset = f.tell()
+        f.write(line)
+    note_offset(path, rec["ts"], offset)
+
+
+def build_index(path):
+    """(Re)build the sidecar index of an existing log with one full scan."""
+    entries = []
+    offset = 0
+    with path.open("rb") as f:
+        for line in f:
+            _, ts = _record_ts(line)
+            if ts is not None:
+                bucket = int(ts // INDEX_BUCKET) * INDEX_BUCKET
+                if not entries or bucket > entries[-1][0]:
+                    entries.append((bucket, offset))
+            offset += len(line)
+    index_path(path).write_bytes(b"".join(INDEX_ENTRY.pack(*e) for e in entries))
+
+
+def seek_offset(path, ts, after=False):
+    # byte offset of the last bucket starting at or before ts, or with
+    # after=True of the first bucket starting after ts (None at EOF)
+    idx = index_path(path)
+    if not idx.exists():
+        build_index(path)
+    bucket = int(ts // INDEX_BUCKET) * INDEX_BUCKET
+    with idx.open("rb") as f:
+        lo, hi = 0, _index_count(idx)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _index_entry(f, mid)[0] <= bucket:
+                lo = mid + 1
+            else:
+                hi = mid
+        if after:
+            return _index_entry(f, lo)[1] if lo < _index_count(idx) else None
+        return _index_entry(f, lo - 1)[1] if lo else 0
+
+
+def _record_ts(line):
+    try:
+        rec = json.loads(line)
+    except ValueError:
+        return None, None
+    ts = rec.get("ts") if isinstance(rec, dict) else None
+    return (rec, ts) if isinstance(ts, (int, float)) else (None, None)
+
+
+def read_range(path, since=None, until=None, limit=100):
+    """Return up to limit records with since <= ts <= until.
+
+    With since, records are returned oldest first starting at since, so a
+    caller can page forward from the last ts it saw. With only until, the
+    latest limit records at or before until are returned. The sidecar index
+    is used to seek straight to the window.
+    """
+    if limit <= 0 or not path.exists():
+        return []
+    out = []
+    with path.open("rb") as f:
+        if since is None:
+            end = None if until is None else seek_offset(path, until, after=True)
+            for line in reverse_lines(f, end=end):
+                rec, ts = _record_ts(line)
+                if rec is None or (until is not None and ts > until):
+                    continue
+                out.append(rec)
+                if len(out) >= limit:
+                    break
+            out.reverse()
+            return out
+        f.seek(seek_offset(path, since))
+        for line in f:
+            rec, ts = _record_ts(line)
+            if rec is None or ts < since:
+                continue
+            if until is not None and ts > until:
+                break
+            out.append(rec)
+            if len(out) >= limit:
+                break
+    return out
+
+
+def _merge(legacy, compact, limit, since):
+    # the JSON logs predate the compact store, so their records are older
+    if since is None:
+        recent = compact(limit)
+        return legacy(limit - len(recent)) + recent if len(recent) < limit else recent
+    old = legacy(limit)
+    return old + compact(limit - len(old)) if len(old) < limit else old
+
+
+def _json_log(path, since, until):
+    def read(n):
+        if n <= 0:
+            return []
+        if since is None and until is None:
+            return tail_lines(path, n=n)
+        return read_range(path, since, until, n)
+
+    return read
+
+
+def reports_for_cid(cid, limit=100, since=None, until=None):
+    def compact(n):
+        if n <= 0:
+            return []
+        if since is None and until is None:
+            return store.tail(RESULTS, cid, n)
+        return store.read_range(RESULTS, cid, since, until, n)
+
+    legacy = _json_log(RESULTS / f"{cid}.log", since, until)
+    return _merge(legacy, compact, limit, since)
+
+
+def timeseries_for_wid(token, wid, limit=100, since=None, until=None):
+    base = BASE / f"customers/{token}/watchers/{wid}"
+    refs_path = base.with_name(wid + ".ref")
 
+    def compact(n):
+        if n <= 0 or not refs_path.exists():
+            return []
+        if since is None and until is None:
+            cid, refs = store.tail_refs(refs_path, n)
+        else:
+            cid, refs = store.range_refs(refs_path, since, until, n)
+        probes = store.lookup(RESULTS, cid, [probe_ts for _, probe_ts in refs])
+        return [
+            {"ts": entry_ts, "wid": wid, "cid": cid, "probe": probes[probe_ts]}
+            for entry_ts, probe_ts in refs
+            if probe_ts in probes
+        ]
 
-def reports_for_cid(cid, limit=100):
-    p = RESULTS / f"{cid}.log"
-    return tail_lines(p, n=limit)
+    legacy = _json_log(base.with_name(wid + ".log"), since, until)
+    return _merge(legacy, compact, limit, since)
 
 
-def timeseries_for_wid(token, wid, limit=100):
-    p = BASE / f"customers/{token}/watchers/{wid}.log"
-    return tail_lines(p, n=limit)
+def analytics_for_cid(cid, now=None):
+    return stats.read_summary(ANALYTICS / f"{cid}.json", now)
 
 
-def analytics_for_cid(cid):
-    p = ANALYTICS / f"{cid}.json"
-    if p.exists():
-        return json.loads(p.read_text())
+def scheduler_metrics():
+    if METRICS.exists():
+        return json.loads(METRICS.read_text())
     return {}
@@ -1,30 +1,333 @@
 import asyncio
+import contextlib
+import heapq
 import json
+import logging
 import time
 from pathlib import Path
 
 import aiohttp
 
-from monitor import db
+from monitor import (
+    adaptive,
+    balances,
+    db,
+    fingerprint,
+    hostlimit,
+    logwriter,
+    overload,
+    persist,
+    procpool,
+    sharding,
+    stats,
+    store,
+)
 
 BASE = Path(__file__).parent
 RESULTS = BASE / "results"
 ANALYTICS = BASE / "analytics"
 PAUSE = BASE / "EMERGENCY_PAUSE"
+CONFIG = BASE / "config.json"
+METRICS = BASE / "scheduler_metrics.json"
 RESULTS.mkdir(exist_ok=True)
 ANALYTICS.mkdir(exist_ok=True)
+STORE = store.ProbeStore(RESULTS)
+STATS = stats.AnalyticsStore(ANALYTICS)
 
+# initial probe concurrency; adapts up to config.json's max_concurrency
 CONCURRENCY = 4
 PROBE_TIMEOUT = 10
 MIN_INTERVAL = 30
+# how often new watchers are picked up and next_run is written back
+SYNC_INTERVAL = 5
+FLUSH_INTERVAL = 5
+CHECKPOINT_INTERVAL = 60
+# targets already due at startup, or new, are spread over this many seconds
+START_JITTER = 30
 
+# probe connection pool; any key can be overridden in config.json
+HTTP_DEFAULTS = {
+    "http_connection_limit": 100,
+    "http_connections_per_host": 4,
+    "http_keepalive_timeout": 75,
+    "dns_cache_ttl": 300,
+}
 
-async def probe_target(session, cid, url):
+# how probes read response bodies; any key can be overridden in config.json
+PROBE_DEFAULTS = {
+    # bytes read before the rest of the body is dropped (None: no cap)
+    "probe_max_bytes": 1024 * 1024,
+    # return once headers arrive; size is then the Content-Length, if any
+    "probe_headers_only": False,
+    # hashlib algorithm for the body fingerprint (None: no fingerprint)
+    "probe_hash": "sha256",
+    # regexes of volatile content removed, line by line, before hashing
+    "probe_strip": [],
+}
+READ_CHUNK = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def load_config():
+    cfg = {}
+    if CONFIG.exists():
+        try:
+            cfg = json.loads(CONFIG.read_text())
+        except ValueError:
+            logger.warning("ignoring unreadable %s", CONFIG)
+    return cfg
+
+
+def make_session(cfg=None):
+    cfg = {**HTTP_DEFAULTS, **(cfg or {})}
+    # keep-alive must outlast the probe interval for connections to be reused
+    connector = aiohttp.TCPConnector(
+        limit=cfg["http_connection_limit"],
+        limit_per_host=cfg["http_connections_per_host"],
+        keepalive_timeout=cfg["http_keepalive_timeout"],
+        use_dns_cache=True,
+        ttl_dns_cache=cfg["dns_cache_ttl"],
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT),
+    )
+
+
+def probe_options(cfg=None):
+    cfg = {**PROBE_DEFAULTS, **(cfg or {})}
+    return {
+        "max_bytes": cfg["probe_max_bytes"],
+        "headers_only": cfg["probe_headers_only"],
+        "hash_name": cfg["probe_hash"],
+        "strip": cfg["probe_strip"],
+    }
+
+
+class TargetQueue:
+    """Min-heap of canonical targets keyed on next_run.
+
+    Entries are invalidated in place when a target is rescheduled or removed,
+    so the heap never has to be rebuilt. Targets handed to a worker are
+    tracked as in flight until the worker calls done(). An entry also keeps
+    the time it first fell due, which defer() preserves, so schedule lag is
+    measured from there. With owns, only the targets it accepts are loaded.
+    """
+
+    def __init__(self, owns=None):
+        self.owns = owns
+        self._heap = []
+        self._entries = {}
+        # cid -> the time it first fell due
+        self._inflight = {}
+        # in-flight cid -> the earliest time a new watcher wants it back
+        self._sooner = {}
+        self._dirty = {}
+        self._low = set()
+        self._watcher_rowid = 0
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, cid):
+        return cid in self._entries or cid in self._inflight
+
+    def schedule(self, cid, url, next_run, persist=True, due=None):
+        old = self._entries.pop(cid, None)
+        if old is not None:
+            old[-1] = False
+        entry = [next_run, cid, url, next_run if due is None else due, True]
+        self._entries[cid] = entry
+        heapq.heappush(self._heap, entry)
+        if persist:
+            self._dirty[cid] = next_run
+        self._wakeup.set()
+
+    def unschedule(self, cid):
+        entry = self._entries.pop(cid, None)
+        if entry is not None:
+            entry[-1] = False
+        self._inflight.pop(cid, None)
+        self._sooner.pop(cid, None)
+        self._dirty.pop(cid, None)
+        self._low.discard(cid)
+
+    def next_run(self):
+        while self._heap and not self._heap[0][-1]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        due = []
+        while self._heap and (not self._heap[0][-1] or self._heap[0][0] <= now):
+            _, cid, url, first_due, valid = heapq.heappop(self._heap)
+            if not valid:
+                continue
+            del self._entries[cid]
+            self._inflight[cid] = first_due
+            due.append((cid, url, first_due))
+        return due
+
+    def done(self, cid, url, next_run, low_priority=False):
+        # a target removed while in flight is not put back
+        if cid not in self._inflight:
+            return
+        del self._inflight[cid]
+        if cid in self._sooner:
+            # a watcher added during the probe, still no sooner than MIN_INTERVAL
+            sooner = max(self._sooner.pop(cid), time.time() + MIN_INTERVAL)
+            next_run = min(next_run, sooner)
+        if low_priority:
+            self._low.add(cid)
+        else:
+            self._low.discard(cid)
+        self.schedule(cid, url, next_run)
+
+    def is_low_priority(self, cid):
+        return cid in self._low
+
+    def load(self, conn):
+        added = self.add_targets(watched_targets(conn))
+        row = conn.execute("select max(rowid) from watchers").fetchone()
+        self._watcher_rowid = row[0] or 0
+        return added
+
+    def add_targets(self, rows):
+        added = 0
+        now = time.time()
+        for r in rows:
+            if r["cid"] in self or (self.owns and not self.owns(r["cid"])):
+                continue
+            self.schedule(r["cid"], r["url"], start_at(r, now), persist=False)
+            added += 1
+        return added
+
+    def add_watchers(self, rows):
+        added = 0
+        now = time.time()
+        for r in rows:
+            self._watcher_rowid = max(self._watcher_rowid, r["rid"])
+            if self.owns and not self.owns(r["cid"]):
+                continue
+            if r["cid"] in self:
+                # next_run follows the target's other watchers, but a new
+                # watcher has never been probed and is due now
+                start = now + hostlimit.jitter(r["cid"], START_JITTER)
+                self.bring_forward(r["cid"], start)
+                continue
+            self.schedule(r["cid"], r["url"], start_at(r, now), False)
+            added += 1
+        return added
+
+    def bring_forward(self, cid, at):
+        """Run cid no later than at, or on its return if it is in flight."""
+        if cid in self._inflight:
+            self._sooner[cid] = min(at, self._sooner.get(cid, at))
+            return
+        entry = self._entries.get(cid)
+        if entry is not None and at < entry[0]:
+            self.schedule(cid, entry[2], at, persist=False, due=min(at, entry[3]))
+
+    def defer(self, cid, url, until, keep_due=True):
+        # hand a popped target back without recording a new next_run; unless
+        # keep_due is false, its lag still counts from when it first fell due
+        if cid in self._inflight:
+            due = self._inflight.pop(cid) if keep_due else None
+            self.schedule(cid, url, until, persist=False, due=due)
+
+    def drop(self, keep):
+        """Forget targets keep(cid) rejects; their pending next_run stays dirty."""
+        dropped = [cid for cid in self._entries if not keep(cid)]
+        for cid in dropped:
+            self._entries.pop(cid)[-1] = False
+            self._low.discard(cid)
+        inflight = [cid for cid in self._inflight if not keep(cid)]
+        for cid in inflight:
+            del self._inflight[cid]
+            self._sooner.pop(cid, None)
+        return len(dropped) + len(inflight)
+
+    def take_dirty(self):
+        batch = [(next_run, cid) for cid, next_run in self._dirty.items()]
+        self._dirty.clear()
+        return batch
+
+    @property
+    def watcher_rowid(self):
+        return self._watcher_rowid
+
+    async def wait(self, timeout):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_at(row, now):
+    if row["next_run"] and row["next_run"] > now:
+        return row["next_run"]
+    return now + hostlimit.jitter(row["cid"], START_JITTER)
+
+
+def watched_targets(conn):
+    return conn.execute(
+        "select cid,url,next_run from canonical_targets where cid in "
+        "(select cid from watchers where enabled=1)"
+    ).fetchall()
+
+
+def new_watchers(conn, after_rowid):
+    # only watchers created since the last sync are read
+    return conn.execute(
+        "select w.rowid as rid, w.cid, t.url, t.next_run from watchers w "
+        "join canonical_targets t on w.cid=t.cid "
+        "where w.rowid>? and w.enabled=1 order by w.rowid",
+        (after_rowid,),
+    ).fetchall()
+
+
+def write_next_run(conn, batch):
+    conn.executemany("update canonical_targets set next_run=? where cid=?", batch)
+    return len(batch)
+
+
+async def read_body(resp, max_bytes=None, hash_name=None, strip=()):
+    """Stream a response body without keeping it.
+
+    Returns (size, digest, truncated); reading stops after max_bytes.
+    """
+    digest = fingerprint.Fingerprint(hash_name, strip) if hash_name else None
+    size = 0
+    truncated = False
+    async for chunk in resp.content.iter_chunked(READ_CHUNK):
+        if max_bytes is not None and size + len(chunk) > max_bytes:
+            chunk = chunk[: max_bytes - size]
+            truncated = True
+        size += len(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        if truncated:
+            break
+    return size, digest and digest.hexdigest(), truncated
+
+
+async def probe_target(
+    session, cid, url, max_bytes=None, headers_only=False, hash_name=None, strip=()
+):
     ts = time.time()
     try:
         start = time.time()
         async with session.get(url, timeout=PROBE_TIMEOUT) as resp:
-            body = await resp.read()
+            digest, truncated = None, False
+            if headers_only:
+                size = resp.content_length
+            else:
+                size, digest, truncated = await read_body(
+                    resp, max_bytes, hash_name, strip
+                )
             latency = (time.time() - start) * 1000
             rec = {
                 "ts": ts,
@@ -32,126 +335,444 @@ async def probe_target(session, cid, url):
                 "status": "ok",
                 "http_status": resp.status,
                 "latency_ms": latency,
-                "size": len(body),
+                "size": size,
             }
+            if digest is not None:
+                rec["hash"] = digest
+            if truncated:
+                rec["truncated"] = True
     except Exception as e:
         rec = {"ts": ts, "cid": cid, "status": "error", "error": str(e)}
-    # append to results log
-    p = RESULTS / f"{cid}.log"
-    with p.open("a") as f:
-        f.write(json.dumps(rec) + "\n")
     return rec
 
 
-async def handle_canonical(cid, url, simulate=False):
-    async with aiohttp.ClientSession() as session:
-        rec = await probe_target(session, cid, url)
-    # update DB
+class WatcherClock:
+    """Last probe time of every watcher, kept ahead of watchers.last_probe.
+
+    Lives on whichever thread records probes; the times are written back in
+    batches by flush().
+    """
+
+    def __init__(self):
+        self._last = {}
+        self._dirty = {}
+
+    def due(self, rows, now):
+        """Split rows into watchers due at now, and the next time one is due.
+
+        Due watchers are marked as probed at now.
+        """
+        due = []
+        next_due = None
+        for w in rows:
+            # the row wins when another scheduler probed it more recently
+            last = max(
+                (t for t in (self._last.get(w["wid"]), w["last_probe"]) if t),
+                default=None,
+            )
+            if last is None or last + w["interval"] <= now:
+                due.append(w)
+                last = self._last[w["wid"]] = self._dirty[w["wid"]] = now
+            t = last + w["interval"]
+            next_due = t if next_due is None else min(next_due, t)
+        return due, next_due
+
+    def flush(self, conn):
+        batch = [(ts, wid) for wid, ts in self._dirty.items()]
+        self._dirty.clear()
+        conn.executemany("update watchers set last_probe=? where wid=?", batch)
+        return len(batch)
+
+
+WATCHERS = WatcherClock()
+BALANCES = balances.BalanceService()
+
+
+def record_change(conn, cid, digest, now, size=None):
+    """Store the fingerprint of cid; returns whether its content changed.
+
+    The first fingerprint of a target is a baseline, not a change.
+    """
+    row = conn.execute(
+        "select fingerprint from canonical_targets where cid=?", (cid,)
+    ).fetchone()
+    old = row["fingerprint"] if row else None
+    if old == digest:
+        return False
+    conn.execute(
+        "update canonical_targets set fingerprint=? where cid=?", (digest, cid)
+    )
+    if old is None:
+        return False
+    conn.execute(
+        "insert into content_changes(cid, ts, fingerprint, size) values(?,?,?,?)",
+        (cid, now, digest, size),
+    )
+    logger.info("content changed: %s %s", cid, digest[:12])
+    return True
+
+
+def record_probe(conn, cid, rec, now, simulate=False):
+    """Store a probe result and charge the watchers that are due.
+
+    Watchers asking for changes only are charged, and get a history entry,
+    when the fingerprint differs from the one they last saw.
+
+    Returns (next_due, low_priority): when the next watcher of cid is due
+    (None if it has none), and whether the target may be pushed back under
+    overload because all its watchers use long intervals or could not pay.
+    The caller commits.
+    """
+    STORE.append(cid, rec)
+    last_ok = 1 if rec.get("status") == "ok" else 0
+    conn.execute(
+        "update canonical_targets set last_probe=?, last_ok=? where cid=?",
+        (now, last_ok, cid),
+    )
+    digest = rec.get("hash")
+    if digest is not None:
+        record_change(conn, cid, digest, now, rec.get("size"))
+    rows = conn.execute(
+        "select wid,token,interval,last_probe,on_change,fingerprint from watchers "
+        "where cid=? and enabled=1",
+        (cid,),
+    ).fetchall()
+    # only watchers whose own interval has elapsed see (and pay for) the probe
+    due, next_due = WATCHERS.due(rows, now)
+    due, seen = changed_for(due, digest)
+    conn.executemany("update watchers set fingerprint=? where wid=?", seen)
+    for w in due:
+        # per-watcher history references the canonical record
+        hist = BASE / f"customers/{w['token']}/watchers/{w['wid']}.ref"
+        STORE.append_ref(hist, cid, now, rec["ts"])
+    # charge every due watcher in one transaction
+    unfunded = False
+    if due and not simulate:
+        charged, _ = BALANCES.charge(
+            conn, [(w["wid"], w["token"], 1) for w in due], now=now, cid=cid
+        )
+        unfunded = not charged
+    # analytics are kept in memory and checkpointed by scheduler_loop
+    STATS.record(cid, rec)
+    long_only = bool(rows) and all(
+        w["interval"] >= overload.LOW_PRIORITY_INTERVAL for w in rows
+    )
+    return next_due, unfunded or long_only
+
+
+def changed_for(due, digest):
+    """Drop on_change watchers that already saw digest.
+
+    Returns (due, seen): the watchers to notify, and (digest, wid) pairs
+    for on_change watchers whose last seen fingerprint moves to digest.
+    A watcher's first fingerprint is recorded without notifying it.
+    """
+    notify, seen = [], []
+    for w in due:
+        if not w["on_change"]:
+            notify.append(w)
+        elif digest is not None and w["fingerprint"] != digest:
+            if w["fingerprint"] is not None:
+                notify.append(w)
+            seen.append((digest, w["wid"]))
+    return notify, seen
+
+
+def forget_targets(shards, moved):
+    """Drop cached store and stats state of targets in the moved shards."""
+    for cid in STORE.cids() | STATS.cids():
+        if sharding.shard_of(cid, shards.num_shards) in moved:
+            STORE.forget(cid)
+            STATS.forget(cid)
+
+
+def hand_over(conn, shards, lost, next_runs, now=None):
+    """Write out and forget what is held for lost shards, then release them.
+
+    Runs on the persister after every record_probe() submitted while the
+    shards were still owned, so their next owner starts from what is on
+    disk: segment counts, error ids, watcher clocks and analytics.
+    """
+    write_next_run(conn, next_runs)
+    WATCHERS.flush(conn)
+    STATS.checkpoint(now)
+    STORE.writer.flush()
+    forget_targets(shards, lost)
+    shards.release(conn, lost)
+
+
+def take_over(conn, shards, gained):
+    """Forget stale state for gained shards; returns the watched targets."""
+    forget_targets(shards, gained)
+    return watched_targets(conn)
+
+
+def write_metrics(path, metrics):
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(metrics))
+    tmp.replace(path)
+
+
+async def handle_canonical(
+    cid,
+    url,
+    simulate=False,
+    session=None,
+    persister=None,
+    limiter=None,
+    pool=None,
+    probe=None,
+    owns=None,
+):
+    if pool is not None:
+        rec = await pool.probe(cid, url)
+    elif session is None:
+        async with aiohttp.ClientSession() as own:
+            rec = await probe_target(own, cid, url, **(probe or {}))
+    else:
+        rec = await probe_target(session, cid, url, **(probe or {}))
+    if limiter is not None and rec["status"] == "ok":
+        limiter.record(cid, rec["latency_ms"])
+    # the shard moved while probing: its state was handed over, so the
+    # result is not recorded
+    if owns is not None and not owns(cid):
+        return None, False
+    # next_run is owned by the TargetQueue and flushed in batches
     now = time.time()
+    if persister is not None:
+        return await persister.run(record_probe, cid, rec, now, simulate)
     with db.get_conn() as conn:
-        c = conn.cursor()
-        last_ok = 1 if rec.get("status") == "ok" else 0
-        c.execute(
-            "update canonical_targets set last_probe=?, last_ok=?, next_run=? where cid=?",
-            (now, last_ok, now + MIN_INTERVAL, cid),
-        )
-        # get watchers
-        rows = c.execute(
-            "select wid,token,interval from watchers where cid=? and enabled=1", (cid,)
-        ).fetchall()
-        for w in rows:
-            wid = w["wid"]
-            token = w["token"]
-            # write per-watcher history
-            cust_watchers_dir = BASE / f"customers/{token}/watchers"
-            cust_watchers_dir.mkdir(parents=True, exist_ok=True)
-            hist = cust_watchers_dir / f"{wid}.log"
-            entry = {"ts": now, "wid": wid, "cid": cid, "probe": rec}
-            with hist.open("a") as hf:
-                hf.write(json.dumps(entry) + "\n")
-            # attempt consume
-            if simulate:
-                continue
-            cur = c.execute(
-                "select credits from sessions where token=?", (token,)
-            ).fetchone()
-            cost = 1
-            if cur and cur["credits"] >= cost:
-                newbal = cur["credits"] - cost
-                c.execute(
-                    "update sessions set credits=?, last_used=? where token=?",
-                    (newbal, now, token),
-                )
-                c.execute(
-                    "insert into ledger(ts,action,token,wid,amount,balance) values(?,?,?,?,?,?)",
-                    (now, "CONSUME", token, wid, cost, newbal),
-                )
-            else:
-                c.execute(
-                    "insert into ledger(ts,action,token,wid,amount,balance,note) values(?,?,?,?,?,?,?)",
-                    (
-                        now,
-                        "CHECK_FAILED_CHARGE",
-                        token,
-                        wid,
-                        cost,
-                        cur["credits"] if cur else 0,
-                        "insufficient funds",
-                    ),
-                )
+        result = record_probe(conn, cid, rec, now, simulate)
+        WATCHERS.flush(conn)
         conn.commit()
-    # update analytics (simple rolling counters)
-    a_file = ANALYTICS / f"{cid}.json"
-    agg = {"checks_total": 0, "checks_ok": 0, "avg_latency_ms": None}
-    if a_file.exists():
+    return result
+
+
+async def probe_worker(
+    queue,
+    work,
+    session,
+    simulate,
+    persister=None,
+    hosts=None,
+    limiter=None,
+    lags=None,
+    pool=None,
+    probe=None,
+):
+    while True:
+        cid, url, due_at = await work.get()
+        next_due, low_priority = time.time() + MIN_INTERVAL, False
         try:
-            agg = json.loads(a_file.read_text())
+            async with limiter or contextlib.nullcontext():
+                if lags is not None:
+                    lags.record(time.time() - due_at)
+                next_due, low_priority = await handle_canonical(
+                    cid,
+                    url,
+                    simulate=simulate,
+                    session=session,
+                    persister=persister,
+                    limiter=limiter,
+                    pool=pool,
+                    probe=probe,
+                    owns=queue.owns,
+                )
         except Exception:
-            agg = {"checks_total": 0, "checks_ok": 0, "avg_latency_ms": None}
-    agg["checks_total"] = agg.get("checks_total", 0) + 1
-    if rec.get("status") == "ok":
-        agg["checks_ok"] = agg.get("checks_ok", 0) + 1
-        lat = rec.get("latency_ms", 0)
-        if agg.get("avg_latency_ms") is None:
-            agg["avg_latency_ms"] = lat
-        else:
-            agg["avg_latency_ms"] = (
-                agg["avg_latency_ms"] * (agg["checks_ok"] - 1) + lat
-            ) / agg["checks_ok"]
-    a_file.write_text(json.dumps(agg))
+            logger.exception("probe of %s failed", cid)
+        finally:
+            if next_due is None:
+                # nobody watches this target any more; sync() re-adds it
+                queue.unschedule(cid)
+            else:
+                # the next watcher due, but never more often than MIN_INTERVAL
+                next_due = max(next_due, time.time() + MIN_INTERVAL)
+                queue.done(cid, url, next_due, low_priority)
+            if hosts is not None:
+                hosts.release(hostlimit.host_of(url))
+            work.task_done()
 
 
-async def scheduler_loop(simulate=False):
-    sem = asyncio.Semaphore(CONCURRENCY)
-    while True:
-        if PAUSE.exists():
-            await asyncio.sleep(5)
+def dispatch(queue, due, work, hosts, lags, now):
+    """Hand due targets to the workers, pushing back those that must wait."""
+    for cid, url, due_at in due:
+        # under overload, low-priority targets back off; the backoff is on
+        # purpose, so their lag counts from when it ends
+        if lags.overloaded and queue.is_low_priority(cid):
+            queue.defer(cid, url, now + lags.backoff(now), keep_due=False)
+            lags.shed += 1
             continue
-        # load due canonical targets
-        now = time.time()
-        tasks = []
+        # a host that is busy or out of tokens pushes its target back
+        wait = hosts.try_acquire(hostlimit.host_of(url), now)
+        if wait:
+            queue.defer(cid, url, now + wait)
+        else:
+            work.put_nowait((cid, url, due_at))
+
+
+async def scheduler_loop(simulate=False, member=None, processes=0):
+    cfg = load_config()
+    # with a member name, only the shards leased to this process are probed
+    shards = None
+    if member is not None:
+        shards = sharding.ShardManager(
+            member, cfg.get("shards", sharding.NUM_SHARDS), sharding.LEASE_TTL
+        )
         with db.get_conn() as conn:
-            c = conn.cursor()
-            rows = c.execute(
-                "select cid,url,next_run from canonical_targets where next_run is null or next_run<=? order by next_run asc",
-                (now,),
-            ).fetchall()
-            for r in rows:
-                cid = r["cid"]
-                url = r["url"]
-                await sem.acquire()
-                t = asyncio.create_task(run_with_sem(sem, cid, url, simulate))
-                tasks.append(t)
-        if tasks:
-            await asyncio.gather(*tasks)
-        await asyncio.sleep(1)
-
-
-async def run_with_sem(sem, cid, url, simulate):
+            shards.heartbeat(conn, time.time())
+            conn.commit()
+    queue = TargetQueue(shards.owns if shards else None)
+    with db.get_conn() as conn:
+        queue.load(conn)
+        BALANCES.rebuild(conn)
+    work = asyncio.Queue()
+    # with worker processes, probes and their HTTP sessions live there
+    pool = session = None
+    if processes:
+        pool = procpool.ProbePool(processes, cfg)
+        await pool.start()
+    else:
+        session = make_session(cfg)
+    # results and watcher histories are buffered while the loop runs
+    writer = STORE.writer = logwriter.LogWriter.from_config(cfg)
+    flusher = asyncio.create_task(writer.run())
+    # every DB and file mutation below happens on the persister's thread
+    persister = persist.Persister()
+    hosts = hostlimit.HostLimiter.from_config(cfg)
+    # one worker per possible permit; the limiter decides how many may probe
+    limiter = adaptive.AdaptiveLimit(
+        CONCURRENCY, max_limit=cfg.get("max_concurrency", adaptive.MAX_CONCURRENCY)
+    )
+    lags = overload.LagMonitor(
+        cfg.get("overload_lag", overload.OVERLOAD_LAG),
+        cfg.get("recover_lag", overload.RECOVER_LAG),
+    )
+    workers = [
+        asyncio.create_task(
+            probe_worker(
+                queue,
+                work,
+                session,
+                simulate,
+                persister,
+                hosts,
+                limiter,
+                lags,
+                pool,
+                probe_options(cfg),
+            )
+        )
+        for _ in range(limiter.max_limit)
+    ]
+
+    def publish(metrics):
+        metrics = {
+            "concurrency": metrics,
+            "lag": lags.metrics(),
+            "updated": time.time(),
+        }
+        persister.call(write_metrics, METRICS, metrics).add_done_callback(
+            persist.log_failure
+        )
+
+    control = asyncio.create_task(limiter.run(work.qsize, publish))
+    last_sync = last_flush = last_checkpoint = last_lag_check = time.time()
+    last_heartbeat = last_reconcile = time.time()
     try:
-        await handle_canonical(cid, url, simulate=simulate)
+        while True:
+            if PAUSE.exists():
+                await asyncio.sleep(5)
+                continue
+            now = time.time()
+            if shards and (
+                now - last_heartbeat >= sharding.HEARTBEAT or not shards.valid(now)
+            ):
+                gained, lost = await persister.run(shards.heartbeat, now)
+                if lost:
+                    queue.drop(shards.owns)
+                    # the leases are only released once this is on disk
+                    persister.submit(
+                        hand_over, shards, lost, queue.take_dirty(), now
+                    ).add_done_callback(persist.log_failure)
+                if gained:
+                    rows = await persister.run(take_over, shards, gained)
+                    queue.add_targets(rows)
+                if gained or lost:
+                    logger.info(
+                        "shards: +%d -%d, %d owned",
+                        len(gained),
+                        len(lost),
+                        len(shards.owned),
+                    )
+                last_heartbeat = now
+            if now - last_sync >= SYNC_INTERVAL:
+                rows = await persister.run(new_watchers, queue.watcher_rowid)
+                queue.add_watchers(rows)
+                hosts.prune(now)
+                if pool is not None:
+                    pool.check(now)
+                last_sync = now
+            if now - last_flush >= FLUSH_INTERVAL:
+                batch = queue.take_dirty()
+                if batch:
+                    persister.submit(write_next_run, batch).add_done_callback(
+                        persist.log_failure
+                    )
+                persister.submit(WATCHERS.flush).add_done_callback(persist.log_failure)
+                last_flush = now
+            if now - last_checkpoint >= CHECKPOINT_INTERVAL:
+                persister.call(STATS.checkpoint, now).add_done_callback(
+                    persist.log_failure
+                )
+                last_checkpoint = now
+            if now - last_reconcile >= balances.RECONCILE_INTERVAL:
+                persister.submit(BALANCES.reconcile).add_done_callback(
+                    persist.log_failure
+                )
+                last_reconcile = now
+            if now - last_lag_check >= 1:
+                event = lags.update(now)
+                if event:
+                    logger.warning(
+                        "%s: p95 schedule lag %.1fs, %d probes deferred",
+                        event["event"].upper(),
+                        event["p95_lag"],
+                        event["shed"],
+                    )
+                last_lag_check = now
+            # a late heartbeat may have let another member take our shards
+            if not shards or shards.valid(now):
+                dispatch(queue, queue.pop_due(now), work, hosts, lags, now)
+            # sleep until the next target is due, a sync or heartbeat is
+            # due, or a target is rescheduled
+            next_run = queue.next_run()
+            timeout = SYNC_INTERVAL
+            if shards:
+                timeout = min(timeout, sharding.HEARTBEAT)
+            if next_run is not None:
+                timeout = min(timeout, max(next_run - time.time(), 0))
+            await queue.wait(timeout)
     finally:
-        sem.release()
+        control.cancel()
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(control, *workers, return_exceptions=True)
+        if pool is not None:
+            await pool.close()
+        else:
+            await session.close()
+        persister.submit(write_next_run, queue.take_dirty())
+        persister.submit(WATCHERS.flush)
+        persister.call(STATS.checkpoint)
+        if shards:
+            # leases go only once everything recorded for them is on disk
+            persister.call(writer.flush)
+            persister.submit(shards.leave)
+        await asyncio.to_thread(persister.close)
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+        await asyncio.to_thread(writer.close)
+        STORE.writer = store.FileWriter()
 
 
 if __name__ == "__main__":
@@ -159,6 +780,24 @@ if __name__ == "__main__":
 
     p = argparse.ArgumentParser()
     p.add_argument("--simulate", action="store_true")
+    p.add_argument(
+        "--sharded",
+        action="store_true",
+        help="share targets with other schedulers on the same database",
+    )
+    p.add_argument("--member", help="member name when sharded (default host:pid)")
+    p.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="run probes in this many worker processes",
+    )
     args = p.parse_args()
+    logging.basicConfig(level=logging.INFO)
     db.init_db()
-    asyncio.run(scheduler_loop(simulate=args.simulate))
+    member = args.member
+    if args.sharded and member is None:
+        member = sharding.default_member()
+    asyncio.run(
+        scheduler_loop(simulate=args.simulate, member=member, processes=args.processes)
+    )
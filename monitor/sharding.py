@@ -0,0 +1,138 @@
+"""Split canonical targets between several scheduler processes.
+
+Every cid hashes to one of NUM_SHARDS fixed shards. Shards are spread over
+the live scheduler members with a consistent-hash ring, so a member joining
+or leaving only moves the shards next to it on the ring. A member probes a
+shard only while it holds that shard's lease in SQLite:
+
+- each member heartbeats every HEARTBEAT seconds into scheduler_members;
+  members without a heartbeat for LEASE_TTL seconds are considered dead;
+- on each heartbeat a member releases leases the ring no longer gives it,
+  renews the ones it keeps, and takes the ones it should own once their
+  previous owner's lease has expired or been released.
+
+A shard is therefore never leased to two members at once, at the cost of a
+pause of up to LEASE_TTL when its owner dies. A probe already in flight
+when a shard moves is finished by its old owner.
+"""
+
+import bisect
+import os
+import socket
+import zlib
+
+NUM_SHARDS = 256
+VNODES = 64
+LEASE_TTL = 30
+HEARTBEAT = 10
+
+
+def _hash(key):
+    return zlib.crc32(key.encode())
+
+
+def shard_of(cid, num_shards=NUM_SHARDS):
+    return _hash(cid) % num_shards
+
+
+def default_member():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class HashRing:
+    """Consistent-hash ring with VNODES points per member."""
+
+    def __init__(self, members, vnodes=VNODES):
+        points = sorted(
+            (_hash(f"{m}#{i}"), m) for m in set(members) for i in range(vnodes)
+        )
+        self._keys = [h for h, _ in points]
+        self._members = [m for _, m in points]
+
+    def owner(self, key):
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._members[i]
+
+
+class ShardManager:
+    def __init__(self, member=None, num_shards=NUM_SHARDS, ttl=LEASE_TTL):
+        self.member = member or default_member()
+        self.num_shards = num_shards
+        self.ttl = ttl
+        self.owned = set()
+        self.expires = 0.0
+
+    def owns(self, cid):
+        return shard_of(cid, self.num_shards) in self.owned
+
+    def valid(self, now):
+        """Whether the leases are still ours; false once a heartbeat is late."""
+        return now < self.expires
+
+    def assignment(self, members):
+        ring = HashRing(members)
+        return {
+            s for s in range(self.num_shards) if ring.owner(f"shard-{s}") == self.member
+        }
+
+    def heartbeat(self, conn, now):
+        """Renew membership and leases; returns (gained, lost) shard sets.
+
+        Leases the ring no longer gives this member are lost but still held:
+        the caller writes out what it has for them and then release()s them,
+        so the next owner cannot start before that. Runs in its own BEGIN
+        IMMEDIATE transaction unless one is open; the caller commits.
+        """
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "insert into scheduler_members(member, heartbeat) values(?,?) "
+            "on conflict(member) do update set heartbeat=excluded.heartbeat",
+            (self.member, now),
+        )
+        conn.execute(
+            "delete from scheduler_members where heartbeat < ?", (now - 10 * self.ttl,)
+        )
+        members = [
+            r[0]
+            for r in conn.execute(
+                "select member from scheduler_members where heartbeat >= ?",
+                (now - self.ttl,),
+            )
+        ]
+        wanted = self.assignment(members)
+        # take free or expired shards; renew the ones already held
+        conn.executemany(
+            "insert into shard_leases(shard, owner, expires) values(?,?,?) "
+            "on conflict(shard) do update set owner=excluded.owner, "
+            "expires=excluded.expires "
+            "where shard_leases.owner=excluded.owner or shard_leases.expires < ?",
+            [(s, self.member, now + self.ttl, now) for s in wanted],
+        )
+        held = wanted & {
+            r[0]
+            for r in conn.execute(
+                "select shard from shard_leases where owner=?", (self.member,)
+            )
+        }
+        gained, lost = held - self.owned, self.owned - held
+        self.owned = held
+        self.expires = now + self.ttl
+        return gained, lost
+
+    def release(self, conn, shards):
+        """Give up the leases of shards so their new owner can take them."""
+        conn.executemany(
+            "delete from shard_leases where shard=? and owner=?",
+            [(s, self.member) for s in shards],
+        )
+
+    def leave(self, conn):
+        """Give up all leases so other members can take them at once."""
+        conn.execute("delete from shard_leases where owner=?", (self.member,))
+        conn.execute("delete from scheduler_members where member=?", (self.member,))
+        lost, self.owned = self.owned, set()
+        self.expires = 0.0
+        return lost
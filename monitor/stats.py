@@ -0,0 +1,269 @@
+"""Streaming latency and uptime statistics per canonical target.
+
+Latencies go into DDSketch-style quantile sketches: logarithmic buckets with
+a relative accuracy of ALPHA, so any quantile is within 1% of the true value
+and the sketch size depends on the latency range, not the number of probes.
+Rolling windows keep one small sketch per time bucket and merge the buckets
+that overlap the window when asked, so a window is exact up to one bucket
+width at its old edge.
+
+The scheduler keeps the stats in memory and checkpoints them to
+analytics/{cid}.json; readers rebuild the windows from the checkpoint.
+"""
+
+import json
+import math
+import os
+import time
+from pathlib import Path
+
+ALPHA = 0.01
+# latencies at or below this many ms are counted as zero
+MIN_VALUE = 1e-3
+QUANTILES = (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99))
+# name, span, bucket width (seconds)
+WINDOWS = (
+    ("1h", 3600, 300),
+    ("24h", 86400, 3600),
+    ("7d", 604800, 21600),
+)
+
+
+class Sketch:
+    """Mergeable quantile sketch with relative error ALPHA."""
+
+    def __init__(self, alpha=ALPHA):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero = 0
+        self.count = 0
+
+    def add(self, value, n=1):
+        if value <= MIN_VALUE:
+            self.zero += n
+        else:
+            i = math.ceil(math.log(value) / self._log_gamma)
+            self.bins[i] = self.bins.get(i, 0) + n
+        self.count += n
+
+    def merge(self, other):
+        for i, n in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + n
+        self.zero += other.zero
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if rank < seen:
+                return 2 * self.gamma**i / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {"zero": self.zero, "bins": sorted(self.bins.items())}
+
+    @classmethod
+    def from_dict(cls, d, alpha=ALPHA):
+        s = cls(alpha)
+        s.zero = d.get("zero", 0)
+        s.bins = {int(i): n for i, n in d.get("bins", [])}
+        s.count = s.zero + sum(s.bins.values())
+        return s
+
+
+def _quantiles(sketch):
+    return {
+        key: None if v is None else round(v, 3)
+        for key, q in QUANTILES
+        for v in [sketch.quantile(q)]
+    }
+
+
+class RollingWindow:
+    """Checks, successes and latencies over the last `span` seconds."""
+
+    def __init__(self, span, width):
+        self.span = span
+        self.width = width
+        # bucket start -> [checks, ok, Sketch]
+        self.buckets = {}
+
+    def add(self, ts, ok, latency=None):
+        start = ts - ts % self.width
+        bucket = self.buckets.get(start)
+        if bucket is None:
+            bucket = self.buckets[start] = [0, 0, Sketch()]
+            self.prune(ts)
+        bucket[0] += 1
+        if ok:
+            bucket[1] += 1
+            if latency is not None:
+                bucket[2].add(latency)
+
+    def prune(self, now):
+        for start in [s for s in self.buckets if s + self.width <= now - self.span]:
+            del self.buckets[start]
+
+    def summary(self, now):
+        checks = ok = 0
+        sketch = Sketch()
+        for start, (n, k, s) in self.buckets.items():
+            if now - self.span < start + self.width and start <= now:
+                checks += n
+                ok += k
+                sketch.merge(s)
+        return {
+            "checks": checks,
+            "checks_ok": ok,
+            "uptime": round(ok / checks, 6) if checks else None,
+            **_quantiles(sketch),
+        }
+
+    def to_list(self):
+        return [
+            [start, n, k, s.to_dict()]
+            for start, (n, k, s) in sorted(self.buckets.items())
+        ]
+
+    def load(self, buckets):
+        self.buckets = {
+            start: [n, k, Sketch.from_dict(s)] for start, n, k, s in buckets
+        }
+
+
+class TargetStats:
+    """Lifetime counters plus rolling windows for one target."""
+
+    def __init__(self):
+        self.checks_total = 0
+        self.checks_ok = 0
+        self.avg_latency_ms = None
+        self.sketch = Sketch()
+        self.windows = {
+            name: RollingWindow(span, width) for name, span, width in WINDOWS
+        }
+        self.updated = None
+
+    def record(self, rec):
+        ts = rec.get("ts") or time.time()
+        ok = rec.get("status") == "ok"
+        latency = rec.get("latency_ms") if ok else None
+        self.checks_total += 1
+        if ok:
+            self.checks_ok += 1
+            if latency is not None:
+                if self.avg_latency_ms is None:
+                    self.avg_latency_ms = latency
+                else:
+                    self.avg_latency_ms += (
+                        latency - self.avg_latency_ms
+                    ) / self.checks_ok
+                self.sketch.add(latency)
+        for window in self.windows.values():
+            window.add(ts, ok, latency)
+        self.updated = ts
+
+    def summary(self, now=None):
+        now = time.time() if now is None else now
+        return {
+            "checks_total": self.checks_total,
+            "checks_ok": self.checks_ok,
+            "avg_latency_ms": self.avg_latency_ms,
+            **_quantiles(self.sketch),
+            "windows": {name: w.summary(now) for name, w in self.windows.items()},
+            "updated": self.updated,
+        }
+
+    def to_dict(self, now=None):
+        # the summary is kept alongside the state for plain JSON readers
+        data = self.summary(now)
+        data["state"] = {
+            "sketch": self.sketch.to_dict(),
+            "windows": {name: w.to_list() for name, w in self.windows.items()},
+        }
+        return data
+
+    @classmethod
+    def from_dict(cls, d):
+        # also accepts the plain counters written before sketches existed
+        t = cls()
+        t.checks_total = d.get("checks_total", 0)
+        t.checks_ok = d.get("checks_ok", 0)
+        t.avg_latency_ms = d.get("avg_latency_ms")
+        t.updated = d.get("updated")
+        state = d.get("state", {})
+        t.sketch = Sketch.from_dict(state.get("sketch", {}))
+        for name, buckets in state.get("windows", {}).items():
+            if name in t.windows:
+                t.windows[name].load(buckets)
+        return t
+
+
+def read_summary(path, now=None):
+    """Summary for an analytics checkpoint, or {} if there is none.
+
+    Files without sketch state (from before this module) are returned as is.
+    """
+    path = Path(path)
+    if not path.exists():
+        return {}
+    data = json.loads(path.read_text())
+    if "state" not in data:
+        return data
+    return TargetStats.from_dict(data).summary(now)
+
+
+class AnalyticsStore:
+    """In-memory TargetStats for all targets, checkpointed to root/{cid}.json."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self._targets = {}
+        self._dirty = set()
+
+    def get(self, cid):
+        t = self._targets.get(cid)
+        if t is None:
+            path = self.root / f"{cid}.json"
+            t = TargetStats()
+            if path.exists():
+                try:
+                    t = TargetStats.from_dict(json.loads(path.read_text()))
+                except ValueError:
+                    pass
+            self._targets[cid] = t
+        return t
+
+    def record(self, cid, rec):
+        self.get(cid).record(rec)
+        self._dirty.add(cid)
+
+    def cids(self):
+        return set(self._targets)
+
+    def forget(self, cid):
+        """Drop cid's stats without writing them; checkpoint() first to keep them.
+
+        The next get() reloads them from the checkpoint file.
+        """
+        self._targets.pop(cid, None)
+        self._dirty.discard(cid)
+
+    def checkpoint(self, now=None):
+        """Write the stats of every target changed since the last checkpoint."""
+        dirty, self._dirty = self._dirty, set()
+        for cid in dirty:
+            path = self.root / f"{cid}.json"
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.write_text(json.dumps(self._targets[cid].to_dict(now)))
+            os.replace(tmp, path)
+        return len(dirty)
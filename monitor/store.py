@@ -0,0 +1,372 @@
+"""Compact storage for canonical probe results.
+
+Each canonical target gets a directory of numbered segments. The newest
+segment is a row file (NNNNNN.rows) of fixed-width records that probes are
+appended to; once it holds SEGMENT_RECORDS records it is compacted into a
+columnar file (NNNNNN.col) holding one packed array per field behind a small
+header. Error messages are interned per target in errors.txt and records
+carry their line number (0 means no error).
+
+Watcher histories do not copy probe records: a watcher's .ref file holds
+(entry ts, probe ts) pairs that are resolved against its target's store.
+"""
+
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+
+SEGMENT_RECORDS = 4096
+# field name, array typecode; the row layout packs them in this order
+FIELDS = (
+    ("ts", "d"),
+    ("http_status", "H"),
+    ("latency_ms", "f"),
+    ("size", "I"),
+    ("error_id", "H"),
+)
+ROW = struct.Struct("<" + "".join(code for _, code in FIELDS))
+COL_HEADER = struct.Struct("<4sIdd")
+COL_MAGIC = b"PRC1"
+REF_HEADER = struct.Struct("<4s64s")
+REF_MAGIC = b"WRF1"
+REF = struct.Struct("<dd")
+MAX_ERROR_LEN = 200
+
+_swap = sys.byteorder == "big"
+
+
+class FileWriter:
+    """Writes straight to disk; logwriter.LogWriter is the buffered drop-in."""
+
+    def write(self, path, data):
+        try:
+            f = open(path, "ab")
+        except FileNotFoundError:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            f = open(path, "ab")
+        with f:
+            f.write(data)
+
+    def seal(self, path, fn):
+        # nothing more will be written to path; fn runs once it is on disk
+        fn(path)
+
+    def flush(self):
+        return 0
+
+
+def _segments(cid_dir):
+    # {seq: path}; a .col wins over a .rows left behind by an interrupted
+    # compaction
+    segs = {}
+    if not cid_dir.is_dir():
+        return segs
+    for p in cid_dir.iterdir():
+        if p.suffix == ".col" or (p.suffix == ".rows" and int(p.stem) not in segs):
+            segs[int(p.stem)] = p
+    return dict(sorted(segs.items()))
+
+
+def _load_errors(cid_dir):
+    p = cid_dir / "errors.txt"
+    if not p.exists():
+        return []
+    return p.read_text().split("\n")[:-1]
+
+
+class ProbeStore:
+    """Append-side of the store; one instance per writer process."""
+
+    def __init__(self, root, writer=None):
+        self.root = Path(root)
+        self.writer = writer or FileWriter()
+        self._active = {}
+        self._errors = {}
+        # cid -> watcher .ref files known to have a header
+        self._refs = {}
+
+    def _state(self, cid):
+        state = self._active.get(cid)
+        if state is None:
+            cid_dir = self.root / cid
+            cid_dir.mkdir(parents=True, exist_ok=True)
+            segs = _segments(cid_dir)
+            seq, count = 0, 0
+            if segs:
+                seq, last = list(segs.items())[-1]
+                if last.suffix == ".col":
+                    seq += 1
+                else:
+                    count = last.stat().st_size // ROW.size
+            state = self._active[cid] = [seq, count]
+        return state
+
+    def _error_id(self, cid, message):
+        table = self._errors.get(cid)
+        if table is None:
+            names = _load_errors(self.root / cid)
+            table = self._errors[cid] = {m: i + 1 for i, m in enumerate(names)}
+        message = " ".join(str(message).split())[:MAX_ERROR_LEN]
+        if message not in table:
+            table[message] = len(table) + 1
+            self.writer.write(self.root / cid / "errors.txt", (message + "\n").encode())
+        return table[message]
+
+    def append(self, cid, rec):
+        state = self._state(cid)
+        if rec.get("status") == "ok":
+            error_id = 0
+        else:
+            error_id = self._error_id(cid, rec.get("error") or "error")
+        row = ROW.pack(
+            rec["ts"],
+            min(int(rec.get("http_status") or 0), 0xFFFF),
+            float(rec.get("latency_ms") or 0.0),
+            min(int(rec.get("size") or 0), 0xFFFFFFFF),
+            error_id,
+        )
+        self.writer.write(self.root / cid / f"{state[0]:06d}.rows", row)
+        state[1] += 1
+        if state[1] >= SEGMENT_RECORDS:
+            self.compact(cid)
+
+    def compact(self, cid):
+        """Turn the active row segment of cid into a columnar segment."""
+        seq = self._state(cid)[0]
+        self._active[cid] = [seq + 1, 0]
+        self.writer.seal(self.root / cid / f"{seq:06d}.rows", _compact_rows)
+
+    def cids(self):
+        return set(self._active) | set(self._errors) | set(self._refs)
+
+    def forget(self, cid):
+        """Drop the segment, error and reference state cached for cid.
+
+        It is read back from disk on next use. Call it, after the writer has
+        flushed, when another process may write cid (its shard moved).
+        """
+        self._active.pop(cid, None)
+        self._errors.pop(cid, None)
+        self._refs.pop(cid, None)
+
+    def append_ref(self, path, cid, entry_ts, probe_ts):
+        """Append a watcher history reference to a canonical probe record."""
+        data = REF.pack(entry_ts, probe_ts)
+        # the header may still be buffered, so remember which files have one
+        refs = self._refs.setdefault(cid, set())
+        if path not in refs:
+            if not path.exists():
+                data = REF_HEADER.pack(REF_MAGIC, cid.encode()) + data
+            refs.add(path)
+        self.writer.write(path, data)
+
+
+def _compact_rows(rows_path):
+    if not rows_path.exists():
+        return
+    cols = _read_rows(rows_path)
+    col_path = rows_path.with_suffix(".col")
+    tmp = col_path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        ts = cols["ts"]
+        f.write(
+            COL_HEADER.pack(
+                COL_MAGIC,
+                len(ts),
+                ts[0] if ts else 0.0,
+                ts[-1] if ts else 0.0,
+            )
+        )
+        for name, _ in FIELDS:
+            values = cols[name]
+            if _swap:
+                values = array(values.typecode, values)
+                values.byteswap()
+            values.tofile(f)
+    tmp.replace(col_path)
+    rows_path.unlink()
+
+
+def _read_rows(path):
+    data = path.read_bytes()
+    # a torn trailing record from an interrupted append is ignored
+    data = data[: len(data) - len(data) % ROW.size]
+    cols = {name: array(code) for name, code in FIELDS}
+    for values in ROW.iter_unpack(data):
+        for (name, _), v in zip(FIELDS, values):
+            cols[name].append(v)
+    return cols
+
+
+def _read_col(path):
+    with open(path, "rb") as f:
+        magic, count, _, _ = COL_HEADER.unpack(f.read(COL_HEADER.size))
+        if magic != COL_MAGIC:
+            raise ValueError(f"{path} is not a columnar segment")
+        cols = {}
+        for name, code in FIELDS:
+            values = array(code)
+            values.fromfile(f, count)
+            if _swap:
+                values.byteswap()
+            cols[name] = values
+    return cols
+
+
+def _col_span(path):
+    with open(path, "rb") as f:
+        _, count, ts_min, ts_max = COL_HEADER.unpack(f.read(COL_HEADER.size))
+    return ts_min, ts_max
+
+
+def _read_segment(path):
+    return _read_col(path) if path.suffix == ".col" else _read_rows(path)
+
+
+def _to_record(cid, cols, i, errors):
+    error_id = cols["error_id"][i]
+    if error_id:
+        error = errors[error_id - 1] if error_id <= len(errors) else "error"
+        return {"ts": cols["ts"][i], "cid": cid, "status": "error", "error": error}
+    return {
+        "ts": cols["ts"][i],
+        "cid": cid,
+        "status": "ok",
+        "http_status": cols["http_status"][i],
+        "latency_ms": round(cols["latency_ms"][i], 3),
+        "size": cols["size"][i],
+    }
+
+
+def tail(root, cid, n=100):
+    """Return the last n probe records of cid, oldest first."""
+    cid_dir = Path(root) / cid
+    errors = None
+    out = []
+    for path in reversed(list(_segments(cid_dir).values())):
+        if len(out) >= n:
+            break
+        cols = _read_segment(path)
+        if errors is None:
+            errors = _load_errors(cid_dir)
+        count = len(cols["ts"])
+        for i in range(count - 1, max(count - (n - len(out)), 0) - 1, -1):
+            out.append(_to_record(cid, cols, i, errors))
+    out.reverse()
+    return out
+
+
+def read_range(root, cid, since=None, until=None, limit=100):
+    """Return up to limit records of cid with since <= ts <= until.
+
+    Like reports.read_range: oldest first from since, or the latest limit
+    records when only until is given.
+    """
+    cid_dir = Path(root) / cid
+    segs = list(_segments(cid_dir).values())
+    lo_ts = float("-inf") if since is None else since
+    hi_ts = float("inf") if until is None else until
+    newest_first = since is None
+    if newest_first:
+        segs.reverse()
+    errors = _load_errors(cid_dir)
+    out = []
+    for path in segs:
+        if len(out) >= limit:
+            break
+        if path.suffix == ".col":
+            ts_min, ts_max = _col_span(path)
+            if ts_max < lo_ts or ts_min > hi_ts:
+                continue
+        cols = _read_segment(path)
+        ts = cols["ts"]
+        start, stop = bisect_left(ts, lo_ts), bisect_right(ts, hi_ts)
+        indexes = range(start, stop)
+        if newest_first:
+            indexes = reversed(indexes)
+        for i in indexes:
+            out.append(_to_record(cid, cols, i, errors))
+            if len(out) >= limit:
+                break
+    if newest_first:
+        out.reverse()
+    return out
+
+
+def lookup(root, cid, stamps):
+    """Return {ts: record} for the probe records of cid at the given ts."""
+    stamps = sorted(set(stamps))
+    if not stamps:
+        return {}
+    cid_dir = Path(root) / cid
+    errors = _load_errors(cid_dir)
+    found = {}
+    for path in _segments(cid_dir).values():
+        if path.suffix == ".col":
+            ts_min, ts_max = _col_span(path)
+            if ts_max < stamps[0] or ts_min > stamps[-1]:
+                continue
+        cols = _read_segment(path)
+        ts = cols["ts"]
+        for stamp in stamps:
+            i = bisect_left(ts, stamp)
+            if i < len(ts) and ts[i] == stamp:
+                found[stamp] = _to_record(cid, cols, i, errors)
+    return found
+
+
+def _open_refs(path):
+    # returns (cid, open file, number of complete entries)
+    f = open(path, "rb")
+    magic, cid = REF_HEADER.unpack(f.read(REF_HEADER.size))
+    if magic != REF_MAGIC:
+        f.close()
+        raise ValueError(f"{path} is not a watcher reference file")
+    count = (path.stat().st_size - REF_HEADER.size) // REF.size
+    return cid.rstrip(b"\0").decode(), f, count
+
+
+def _ref_at(f, i):
+    f.seek(REF_HEADER.size + i * REF.size)
+    return REF.unpack(f.read(REF.size))
+
+
+def tail_refs(path, n=100):
+    """Return (cid, [(entry_ts, probe_ts), ...]) for the last n references."""
+    cid, f, count = _open_refs(path)
+    with f:
+        start = max(count - n, 0)
+        f.seek(REF_HEADER.size + start * REF.size)
+        data = f.read((count - start) * REF.size)
+    return cid, list(REF.iter_unpack(data))
+
+
+def range_refs(path, since=None, until=None, limit=100):
+    """Like read_range, over the entry ts of a watcher reference file."""
+    cid, f, count = _open_refs(path)
+    with f:
+
+        def first_after(ts, inclusive):
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                t = _ref_at(f, mid)[0]
+                if t < ts or (not inclusive and t == ts):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        start = 0 if since is None else first_after(since, True)
+        stop = count if until is None else first_after(until, False)
+        if since is None:
+            start = max(start, stop - limit)
+        else:
+            stop = min(stop, start + limit)
+        if stop <= start:
+            return cid, []
+        f.seek(REF_HEADER.size + start * REF.size)
+        data = f.read((stop - start) * REF.size)
+    return cid, list(REF.iter_unpack(data))
@@ -0,0 +1,22 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import db
+
+
+@pytest.fixture(autouse=True)
+def close_pooled_connections():
+    """Close pooled connections and drop WAL files of deleted temp databases"""
+    yield
+    closed = db.close_conns()
+    monitor_db = sys.modules.get("monitor.db")
+    if monitor_db is not None:
+        closed += monitor_db.close_conns()
+    for path in closed:
+        if not Path(path).exists():
+            for suffix in ("-wal", "-shm"):
+                Path(path + suffix).unlink(missing_ok=True)
@@ -0,0 +1,94 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import adaptive
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class TestAdaptiveLimit:
+    """Test cases for the AIMD probe concurrency limit"""
+
+    def test_permits_follow_the_limit(self):
+        """Test that no more than `limit` holders run at once"""
+        limit = adaptive.AdaptiveLimit(3)
+        peak = [0]
+
+        async def hold():
+            async with limit:
+                peak[0] = max(peak[0], limit.in_flight)
+                await asyncio.sleep(0.01)
+
+        async def main():
+            await asyncio.gather(*(hold() for _ in range(10)))
+
+        run(main())
+        assert peak[0] == 3
+        assert limit.in_flight == 0
+
+    def test_grows_when_saturated(self):
+        """Test the additive increase while work waits for permits"""
+        limit = adaptive.AdaptiveLimit(2, max_limit=3)
+
+        async def main():
+            async with limit:
+                async with limit:
+                    assert await limit.adjust(queued=5) == 3
+                    assert await limit.adjust(queued=5) == 3
+            # idle: no growth
+            return await limit.adjust(queued=0)
+
+        assert run(main()) == 3
+        assert limit.metrics["increases"] == 1
+
+    def test_shrinks_on_loop_lag(self):
+        """Test the multiplicative decrease when the event loop lags"""
+        limit = adaptive.AdaptiveLimit(8)
+        limit.record_lag(0.5)
+        assert run(limit.adjust(queued=10)) == 6
+        assert limit.metrics["loop_lag_ms"] == 500
+        # the lag sample is reset after each step
+        assert run(limit.adjust()) == 6
+
+    def test_shrinks_on_slow_probes(self):
+        """Test that latency is judged against each target's own baseline"""
+        limit = adaptive.AdaptiveLimit(4, min_limit=3)
+        for _ in range(5):
+            limit.record("fast", 10)
+            limit.record("slow", 1000)
+        assert run(limit.adjust()) == 4
+        assert limit.metrics["latency_ratio"] == 1.0
+
+        for _ in range(5):
+            limit.record("fast", 50)
+        assert run(limit.adjust()) == 3
+        assert run(limit.adjust()) == 3
+        assert limit.metrics["decreases"] == 1
+
+    def test_bounds(self):
+        """Test that the initial limit is clamped to [min_limit, max_limit]"""
+        assert adaptive.AdaptiveLimit(100, max_limit=5).limit == 5
+        assert adaptive.AdaptiveLimit(0).limit == 1
+
+    def test_run_publishes_metrics(self, monkeypatch):
+        """Test the background loop samples lag and reports each step"""
+        monkeypatch.setattr(adaptive, "ADJUST_INTERVAL", 0.05)
+        monkeypatch.setattr(adaptive, "LAG_SAMPLE", 0.01)
+        limit = adaptive.AdaptiveLimit(2)
+        seen = []
+
+        async def main():
+            task = asyncio.create_task(limit.run(lambda: 7, seen.append))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        run(main())
+        assert seen
+        assert seen[-1]["queued"] == 7
+        assert set(seen[-1]) >= {"limit", "in_flight", "loop_lag_ms"}
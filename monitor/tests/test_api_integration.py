@@ -269,6 +269,47 @@ class TestAPIIntegration:
             ).fetchone()
             assert session["credits"] == 5
 
+    def test_consume_idempotency_key_and_batch(self, client):
+        """Test that a retried keyed charge is replayed and batches charge in order"""
+        token = str(uuid.uuid4())
+        with db.get_conn() as conn:
+            ts = time.time()
+            conn.execute(
+                "INSERT INTO sessions(token, credits, created, last_used) VALUES (?, ?, ?, ?)",
+                (token, 10, ts, ts),
+            )
+            conn.commit()
+        wid = client.post(
+            "/register", json={"token": token, "url": "https://example.com"}
+        ).json()["wid"]
+
+        for _ in range(2):
+            response = client.post("/consume", json={"wid": wid, "cost": 2, "key": "a"})
+            assert response.status_code == 200
+        assert response.json() == {"status": "ok", "credits": 8, "replayed": True}
+
+        response = client.post(
+            "/consume/batch",
+            json={
+                "charges": [
+                    {"wid": wid, "cost": 5, "key": "b"},
+                    {"wid": wid, "cost": 5},
+                    {"wid": "missing"},
+                    {"wid": wid, "cost": 2, "key": "a"},
+                ]
+            },
+        )
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [r["status"] for r in results] == [
+            "ok",
+            "insufficient_funds",
+            "not_found",
+            "ok",
+        ]
+        assert results[0]["credits"] == 3 and results[3]["replayed"]
+        assert client.post("/consume/batch", json={"charges": [{}]}).status_code == 400
+
     def test_consume_invalid_watcher(self, client):
         """Test consuming credits with invalid watcher ID"""
         consume_data = {"wid": "invalid-wid", "cost": 10}
@@ -332,6 +373,145 @@ class TestAPIIntegration:
         # Cleanup
         results_file.unlink()
 
+    def test_reports_cid_limit(self, client):
+        """Test that the cid report endpoint honors its limit parameter"""
+        import json
+
+        cid = "test_cid_limit"
+        results_dir = Path("results")
+        results_dir.mkdir(exist_ok=True)
+        results_file = results_dir / f"{cid}.log"
+        with results_file.open("w") as f:
+            for i in range(5):
+                f.write(json.dumps({"timestamp": i}) + "\n")
+
+        response = client.get(f"/reports/cid/{cid}?limit=2")
+
+        assert response.status_code == 200
+        assert [r["timestamp"] for r in response.json()] == [3, 4]
+
+        # Cleanup
+        results_file.unlink()
+
+    def test_reports_cid_time_range(self, client):
+        """Test since/until windows on the cid report endpoint"""
+        import reports as reports_module
+
+        cid = "test_cid_range"
+        results_file = Path("results") / f"{cid}.log"
+        results_file.parent.mkdir(exist_ok=True)
+        for i in range(10):
+            reports_module.append_record(results_file, {"ts": 1000 + i * 60, "id": i})
+
+        response = client.get(f"/reports/cid/{cid}?since=1120&until=1240")
+
+        assert response.status_code == 200
+        assert [r["id"] for r in response.json()] == [2, 3, 4]
+
+        # Cleanup
+        results_file.unlink()
+        reports_module.index_path(results_file).unlink()
+
+    def test_analytics_cid(self, client, tmp_path, monkeypatch):
+        """Test the percentile analytics endpoint"""
+        import reports as reports_module
+        import stats
+
+        monkeypatch.setattr(reports_module, "ANALYTICS", tmp_path)
+        analytics = stats.AnalyticsStore(tmp_path)
+        now = time.time()
+        for i in range(100):
+            analytics.record("c1", {"ts": now, "status": "ok", "latency_ms": i + 1})
+        analytics.checkpoint(now)
+
+        response = client.get("/analytics/cid/c1")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["checks_total"] == 100
+        assert data["windows"]["1h"]["checks"] == 100
+        assert data["windows"]["1h"]["p95_ms"] == pytest.approx(95, rel=0.02)
+        assert client.get("/analytics/cid/missing").json() == {}
+
+    def test_scheduler_metrics(self, client, tmp_path, monkeypatch):
+        """Test the scheduler metrics endpoint"""
+        import reports as reports_module
+
+        monkeypatch.setattr(reports_module, "METRICS", tmp_path / "metrics.json")
+        assert client.get("/metrics/scheduler").json() == {}
+
+        (tmp_path / "metrics.json").write_text('{"concurrency": {"limit": 4}}')
+        response = client.get("/metrics/scheduler")
+
+        assert response.status_code == 200
+        assert response.json()["concurrency"]["limit"] == 4
+
+    def test_register_on_change_and_list_changes(self, client):
+        """Test registering an on-change watcher and reading content changes"""
+        token = str(uuid.uuid4())
+        with db.get_conn() as conn:
+            ts = time.time()
+            conn.execute(
+                "INSERT INTO sessions(token, credits, created, last_used) VALUES (?, ?, ?, ?)",
+                (token, 100, ts, ts),
+            )
+            conn.commit()
+
+        result = client.post(
+            "/register",
+            json={"token": token, "url": "https://example.com", "on_change": True},
+        ).json()
+        watchers = client.get(f"/d/{token}").json()["watchers"]
+        assert watchers[0]["on_change"] == 1
+
+        with db.get_conn() as conn:
+            conn.executemany(
+                "INSERT INTO content_changes(cid, ts, fingerprint, size) VALUES (?,?,?,?)",
+                [(result["cid"], 100, "aa", 10), (result["cid"], 200, "bb", 12)],
+            )
+            conn.commit()
+
+        changes = client.get(f"/changes/cid/{result['cid']}").json()
+        assert [c["fingerprint"] for c in changes] == ["bb", "aa"]
+        since = client.get(f"/changes/cid/{result['cid']}?since=150").json()
+        assert since == [{"ts": 200, "fingerprint": "bb", "size": 12}]
+        assert client.get("/changes/cid/missing").json() == []
+
+    def test_admin_earnings_and_receipts(self, client, monkeypatch):
+        """Test that earnings exports and receipts are served from the rollups"""
+        client.post("/topup", json={"sats": 10})
+        with db.get_conn() as conn:
+            token = conn.execute("SELECT token FROM sessions").fetchone()[0]
+        wid = client.post(
+            "/register", json={"token": token, "url": "https://example.com"}
+        ).json()["wid"]
+        client.post("/consume", json={"wid": wid, "cost": 3})
+        day = time.strftime("%Y-%m-%d", time.gmtime())
+
+        assert client.get("/admin/earnings").status_code == 403
+        monkeypatch.setattr(app, "check_admin_key", lambda headers: True)
+        rows = client.get(f"/admin/earnings?since={day}").json()["rows"]
+        assert {(r["action"], r["events"], r["amount"]) for r in rows} == {
+            ("CREATE_SESSION_TOPUP", 1, 10),
+            ("CONSUME", 1, 3),
+        }
+        response = client.get("/admin/earnings?by=watcher&format=csv")
+        assert response.headers["content-type"].startswith("text/csv")
+        lines = response.text.splitlines()
+        assert lines[0] == "day,wid,token,action,events,amount"
+        assert lines[1] == f"{day},{wid},{token},CONSUME,1,3"
+        assert client.get("/admin/earnings?since=yesterday").status_code == 400
+        assert client.get("/admin/earnings?by=cid").status_code == 400
+
+        receipt = client.get(f"/receipts/{token}").json()
+        assert receipt["credits"] == 7
+        assert receipt["totals"]["CONSUME"] == {"events": 1, "amount": 3}
+        assert receipt["watchers"] == [
+            {"wid": wid, "action": "CONSUME", "events": 1, "amount": 3}
+        ]
+        assert client.get(f"/receipts/{token}?until=2000-01-01").json()["days"] == []
+        assert client.get("/receipts/missing").status_code == 404
+
     def test_reports_wid(self, client):
         """Test getting reports for a specific watcher"""
         # Create a session and watcher
@@ -0,0 +1,107 @@
+import datetime
+import gzip
+import hashlib
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+from monitor import archive, db
+
+
+def ts(year, month, day=1):
+    return datetime.datetime(year, month, day, tzinfo=datetime.timezone.utc).timestamp()
+
+
+NOW = ts(2026, 10, 18)
+
+
+class TestArchive:
+    """Test cases for moving old ledger months into compressed partitions"""
+
+    @pytest.fixture
+    def conn(self, tmp_path, monkeypatch):
+        """Database whose ledger spans January to October 2026"""
+        monkeypatch.setattr(db, "DB_PATH", tmp_path / "test.db")
+        db.init_db()
+        with db.get_conn() as conn:
+            rows = []
+            for month in (1, 2, 6, 10):
+                for day in (1, 15):
+                    rows.append((ts(2026, month, day), "CONSUME", "tok", "w1", 1))
+            conn.executemany(
+                "insert into ledger(ts,action,token,wid,amount) values(?,?,?,?,?)",
+                rows,
+            )
+            conn.commit()
+            yield conn
+        db.close_conns()
+
+    def months(self, conn):
+        return sorted(
+            {
+                datetime.datetime.fromtimestamp(r[0], datetime.timezone.utc).month
+                for r in conn.execute("select ts from ledger")
+            }
+        )
+
+    def test_cutoff(self):
+        """Test that the current month and keep months before it are kept"""
+        assert archive.cutoff(NOW, 3) == datetime.datetime(
+            2026, 7, 1, tzinfo=datetime.timezone.utc
+        )
+        assert archive.cutoff(ts(2026, 2, 10), 3).date() == datetime.date(2025, 11, 1)
+
+    def test_old_months_are_archived(self, conn, tmp_path):
+        """Test that old months move to gzipped databases and leave the ledger"""
+        parts = archive.archive(conn, now=NOW, keep=3, directory=tmp_path / "a")
+        assert [(p["month"], p["rows"]) for p in parts] == [
+            ("2026-01", 2),
+            ("2026-02", 2),
+            ("2026-06", 2),
+        ]
+        assert self.months(conn) == [10]
+        recorded = conn.execute(
+            "select month, rows, path, sha256 from ledger_partitions order by month"
+        ).fetchall()
+        assert [r["month"] for r in recorded] == ["2026-01", "2026-02", "2026-06"]
+
+        gz = Path(recorded[0]["path"])
+        assert gz.name == "ledger-2026-01-1.db.gz"
+        assert hashlib.sha256(gz.read_bytes()).hexdigest() == recorded[0]["sha256"]
+        plain = tmp_path / "jan.db"
+        plain.write_bytes(gzip.decompress(gz.read_bytes()))
+        part = sqlite3.connect(plain)
+        assert [r[0] for r in part.execute("select id from ledger")] == [1, 2]
+        part.close()
+
+    def test_rollups_survive_archival(self, conn, tmp_path):
+        """Test that daily rollups still cover archived rows"""
+        archive.archive(conn, now=NOW, keep=3, directory=tmp_path)
+        events = conn.execute("select sum(events) from earnings_daily").fetchone()[0]
+        watcher = conn.execute(
+            "select sum(amount) from watcher_earnings_daily"
+        ).fetchone()[0]
+        assert events == watcher == 8
+
+    def test_rerun_finishes_interrupted_deletes(self, conn, tmp_path):
+        """Test that rows of a recorded partition are removed, not archived twice"""
+        archive.archive(conn, now=NOW, keep=3, directory=tmp_path)
+        # as if a run died after recording January but before deleting it
+        conn.execute(
+            "insert into ledger(id,ts,action,token,amount) "
+            "values(1,?,'CONSUME','tok',1)",
+            (ts(2026, 1, 1),),
+        )
+        conn.commit()
+        assert archive.archive(conn, now=NOW, keep=3, directory=tmp_path) == []
+        assert self.months(conn) == [10]
+        assert conn.execute("select count(*) from ledger_partitions").fetchone()[0] == 3
+
+    def test_nothing_to_archive(self, conn, tmp_path):
+        """Test that a ledger with only recent months is left alone"""
+        assert archive.archive(conn, now=NOW, keep=12, directory=tmp_path) == []
+        assert self.months(conn) == [1, 2, 6, 10]
@@ -0,0 +1,251 @@
+import asyncio
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import asyncdb
+import db
+import queries
+
+
+def insert(conn, value):
+    conn.execute("insert into t(v) values(?)", (value,))
+    return threading.current_thread().name
+
+
+def values(conn):
+    return [r[0] for r in conn.execute("select v from t order by rowid")]
+
+
+def slow_insert(conn, value):
+    time.sleep(0.3)
+    return insert(conn, value)
+
+
+def fail(conn, value):
+    insert(conn, value)
+    raise RuntimeError("boom")
+
+
+class TestAsyncDB:
+    """Test cases for the API's thread-backed database access"""
+
+    @pytest.fixture
+    def adb(self, tmp_path, monkeypatch):
+        """Point the executor at a temporary database with one table"""
+        monkeypatch.setattr(db, "DB_PATH", tmp_path / "test.db")
+        db.init_db()
+        with db.get_conn() as conn:
+            conn.execute("create table t(v text)")
+            conn.commit()
+        adb = asyncdb.AsyncDB(readers=2)
+        yield adb
+        adb.close()
+
+    def test_reads_and_writes_run_off_the_loop(self, adb):
+        """Test that query functions run on the executor's threads"""
+
+        async def run():
+            writer = await adb.write(insert, "a")
+            return writer, await adb.read(values)
+
+        writer, rows = asyncio.run(run())
+        assert writer.startswith("db-write")
+        assert rows == ["a"]
+
+    def test_failed_write_is_rolled_back(self, adb):
+        """Test that a write raising an exception leaves nothing behind"""
+
+        async def run():
+            with pytest.raises(RuntimeError):
+                await adb.write(fail, "x")
+            await adb.write(insert, "y")
+            return await adb.read(values)
+
+        assert asyncio.run(run()) == ["y"]
+
+    def test_slow_write_does_not_block_loop_or_reads(self, adb):
+        """Test that other requests proceed while a write is committing"""
+
+        async def run():
+            write = asyncio.create_task(adb.write(slow_insert, "slow"))
+            await asyncio.sleep(0.05)
+            start = time.monotonic()
+            rows = await adb.read(values)
+            elapsed = time.monotonic() - start
+            await write
+            return rows, elapsed
+
+        rows, elapsed = asyncio.run(run())
+        assert rows == []
+        assert elapsed < 0.2
+
+    def test_writes_are_serialized(self, adb):
+        """Test that concurrent writes all commit, in submission order"""
+
+        async def run():
+            await asyncio.gather(*(adb.write(insert, str(i)) for i in range(20)))
+            return await adb.read(values)
+
+        assert asyncio.run(run()) == [str(i) for i in range(20)]
+
+    def test_concurrent_writes_share_commits(self, adb):
+        """Test that a burst of writes is committed in a few transactions"""
+
+        async def run():
+            await asyncio.gather(*(adb.write(insert, str(i)) for i in range(100)))
+            return adb._writer.stats
+
+        stats = asyncio.run(run())
+        assert stats["jobs"] == 100
+        assert stats["transactions"] < 10
+
+    def test_failure_in_group_keeps_the_others(self, adb):
+        """Test that a failing write only rolls back its own statements"""
+
+        async def run():
+            return await asyncio.gather(
+                adb.write(insert, "a"),
+                adb.write(fail, "x"),
+                adb.write(insert, "b"),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run(run())
+        assert isinstance(results[1], RuntimeError)
+        # resolved futures mean committed: a fresh connection sees the rows
+        conn = sqlite3.connect(db.DB_PATH)
+        assert [r[0] for r in conn.execute("select v from t")] == ["a", "b"]
+        conn.close()
+
+    def test_close_releases_connections(self, adb):
+        """Test that close() closes every executor thread's connection"""
+
+        async def run():
+            await asyncio.gather(adb.read(values), adb.write(insert, "a"))
+
+        asyncio.run(run())
+        before = db.pool_stats()["open"]
+        adb.close()
+        assert db.pool_stats()["open"] < before
+        # the executor starts again on next use
+        assert asyncio.run(adb.read(values)) == ["a"]
+
+
+class TestQueries:
+    """Test cases for the query functions behind the API routes"""
+
+    @pytest.fixture
+    def conn(self, tmp_path, monkeypatch):
+        """Open a temporary database"""
+        monkeypatch.setattr(db, "DB_PATH", tmp_path / "test.db")
+        db.init_db()
+        with db.get_conn() as conn:
+            yield conn
+
+    def test_topup_creates_or_credits_session(self, conn):
+        """Test that topup creates a session or adds to an existing one"""
+        created = queries.topup(conn, None, "tok", 10, 100.0)
+        assert created == queries.Topup("tok", 10, "CREATE_SESSION_TOPUP")
+        assert queries.topup(conn, "tok", "unused", 5, 101.0).balance == 15
+        assert queries.topup(conn, "missing", "unused", 5, 102.0) is None
+        actions = [r[0] for r in conn.execute("select action from ledger")]
+        assert actions == ["CREATE_SESSION_TOPUP", "TOPUP"]
+
+    def test_register_and_dashboard(self, conn):
+        """Test that a registered watcher shows on its session's dashboard"""
+        queries.topup(conn, None, "tok", 10, 100.0)
+        assert not queries.register_watcher(
+            conn, "missing", "c1", "http://a", "w0", 60, False, 100.0
+        )
+        assert queries.register_watcher(
+            conn, "tok", "c1", "http://a", "w1", 60, True, 100.0
+        )
+        assert queries.register_watcher(
+            conn, "tok", "c1", "http://a", "w2", 60, False, 100.0
+        )
+        board = queries.dashboard(conn, "tok")
+        assert [w["wid"] for w in board["watchers"]] == ["w1", "w2"]
+        assert [w["on_change"] for w in board["watchers"]] == [1, 0]
+        assert len(queries.list_targets(conn)) == 1
+        assert queries.dashboard(conn, "missing") is None
+
+
+class TestConsume:
+    """Test cases for atomic, idempotent charging"""
+
+    @pytest.fixture
+    def conn(self, tmp_path, monkeypatch):
+        """Open a temporary database with one session and two watchers"""
+        monkeypatch.setattr(db, "DB_PATH", tmp_path / "test.db")
+        db.init_db()
+        with db.get_conn() as conn:
+            queries.topup(conn, None, "tok", 10, 100.0)
+            for wid in ("w1", "w2"):
+                queries.register_watcher(
+                    conn, "tok", "c1", "http://a", wid, 60, False, 100.0
+                )
+            conn.commit()
+            yield conn
+
+    def ledger(self, conn):
+        return [tuple(r) for r in conn.execute("select action, wid from ledger")][1:]
+
+    def test_charge_and_insufficient_funds(self, conn):
+        """Test that a charge debits and an unpayable one is only recorded"""
+        assert queries.consume(conn, "w1", 7, 101.0) == queries.Charge(True, "tok", 3)
+        assert queries.consume(conn, "w2", 7, 102.0) == queries.Charge(False, "tok", 3)
+        assert queries.consume(conn, "nope", 1, 103.0) is None
+        assert self.ledger(conn) == [("CONSUME", "w1"), ("CHECK_FAILED_CHARGE", "w2")]
+
+    def test_idempotency_key_replays_outcome(self, conn):
+        """Test that a retried key is not charged twice until it expires"""
+        first = queries.consume(conn, "w1", 3, 101.0, key="k1", ttl=60)
+        again = queries.consume(conn, "w1", 3, 102.0, key="k1", ttl=60)
+        other = queries.consume(conn, "w2", 3, 103.0, key="k1", ttl=60)
+        assert first == queries.Charge(True, "tok", 7)
+        assert again == queries.Charge(True, "tok", 7, replayed=True)
+        assert other.balance == 4 and not other.replayed
+        assert len(self.ledger(conn)) == 2
+        # after the ttl the key charges again, and purging drops old keys
+        assert not queries.consume(conn, "w1", 3, 200.0, key="k1", ttl=60).replayed
+        assert queries.purge_idempotency_keys(conn, 250.0) == 1
+        assert conn.execute("select count(*) from idempotency_keys").fetchone()[0] == 1
+
+    def test_batch_is_applied_in_order(self, conn):
+        """Test that a batch charges in order and stops paying when funds run out"""
+        results = queries.consume_batch(
+            conn,
+            [("w1", 4, None), ("w2", 4, "k"), ("w1", 4, None), ("x", 1, None)],
+            101.0,
+        )
+        assert [r and r.ok for r in results] == [True, True, False, None]
+        assert results[1].balance == 2
+
+    def test_concurrent_charges_never_overdraw(self, conn):
+        """Test that racing charges from separate connections cannot overspend"""
+        barrier = threading.Barrier(8)
+        outcomes = []
+
+        def charge(i):
+            with db.get_conn() as c:
+                barrier.wait()
+                c.execute("BEGIN IMMEDIATE")
+                outcomes.append(queries.consume(c, "w1", 3, 101.0 + i).ok)
+                c.commit()
+            db.close_conns()
+
+        threads = [threading.Thread(target=charge, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        credits = conn.execute("select credits from sessions").fetchone()[0]
+        assert sorted(outcomes) == [False] * 5 + [True] * 3
+        assert credits == 1
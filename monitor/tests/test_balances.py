@@ -0,0 +1,128 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+from monitor import balances, db
+
+
+class CountingConn:
+    """Connection wrapper that records every statement executed"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.sql = []
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def execute(self, sql, *args):
+        self.sql.append(sql)
+        return self.conn.execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        self.sql.append(sql)
+        return self.conn.executemany(sql, *args)
+
+
+class TestBalanceService:
+    """Test cases for the in-memory session balance cache"""
+
+    @pytest.fixture
+    def conn(self, monkeypatch):
+        """Database with two sessions and a watcher each"""
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        monkeypatch.setattr(db, "DB_PATH", Path(path))
+        db.init_db()
+        with db.get_conn() as conn:
+            for token, credits in (("rich", 10), ("poor", 1)):
+                conn.execute(
+                    "insert into sessions(token,credits,created,last_used) "
+                    "values(?,?,0,0)",
+                    (token, credits),
+                )
+            conn.commit()
+            yield conn
+        db.close_conns()
+        os.unlink(path)
+
+    def credits(self, conn, token):
+        return conn.execute(
+            "select credits from sessions where token=?", (token,)
+        ).fetchone()[0]
+
+    def test_cached_balance_skips_the_read(self, conn):
+        """Test that a token the cache can cover is debited without a select"""
+        service = balances.BalanceService()
+        service.reconcile(conn)
+        counted = CountingConn(conn)
+        charged, short = service.charge(counted, [("w1", "rich", 1), ("w2", "rich", 2)])
+        conn.commit()
+        assert charged == [("w1", "rich", 9), ("w2", "rich", 7)] and short == []
+        assert not any(s.lstrip().startswith("select") for s in counted.sql)
+        assert service.balance("rich") == 7 == self.credits(conn, "rich")
+        assert service.stats["loads"] == 0
+        rows = conn.execute("select action, balance from ledger order by id").fetchall()
+        assert [tuple(r) for r in rows] == [("CONSUME", 9), ("CONSUME", 7)]
+
+    def test_short_token_is_reloaded(self, conn):
+        """Test that a top-up made elsewhere is seen when the cache looks short"""
+        service = balances.BalanceService()
+        service.reconcile(conn)
+        conn.execute("update sessions set credits=credits+5 where token='poor'")
+        charged, short = service.charge(conn, [("w1", "poor", 1), ("w2", "poor", 2)])
+        conn.commit()
+        assert [b for _, _, b in charged] == [5, 3] and short == []
+        assert service.stats["loads"] == 1
+
+    def test_underfunded_in_order(self, conn):
+        """Test that watchers are paid in order until the session runs out"""
+        service = balances.BalanceService()
+        charged, short = service.charge(
+            conn, [("w1", "poor", 1), ("w2", "poor", 1), ("w3", "nobody", 1)]
+        )
+        conn.commit()
+        assert charged == [("w1", "poor", 0)]
+        assert short == [("w2", "poor", 0), ("w3", "nobody", 0)]
+        assert self.credits(conn, "poor") == 0
+
+    def test_stale_cache_never_overdraws(self, conn):
+        """Test that a balance spent by another process falls back to the DB"""
+        service = balances.BalanceService()
+        service.reconcile(conn)
+        conn.execute("update sessions set credits=1 where token='rich'")
+        charged, short = service.charge(conn, [("w1", "rich", 1), ("w2", "rich", 1)])
+        conn.commit()
+        assert charged == [("w1", "rich", 0)] and short == [("w2", "rich", 0)]
+        assert self.credits(conn, "rich") == 0
+        assert service.balance("rich") == 0
+        assert service.stats["stale"] == 1
+        assert conn.execute("select count(*) from ledger").fetchone()[0] == 2
+
+    def test_rebuild_from_ledger(self, conn):
+        """Test that the cache is seeded from the ledger and drift is counted"""
+        conn.execute(
+            "insert into ledger(ts,action,token,amount,balance) values"
+            "(1,'TOPUP','rich',10,10),(2,'CONSUME','rich',1,9),"
+            "(1,'TOPUP','poor',1,1)"
+        )
+        conn.commit()
+        service = balances.BalanceService()
+        assert service.rebuild(conn) == 1
+        assert service.balance("rich") == 10 and service.balance("poor") == 1
+        assert len(service) == 2
+
+    def test_reconcile_replaces_cache(self, conn):
+        """Test that reconcile adopts sessions.credits and drops gone tokens"""
+        service = balances.BalanceService()
+        service.reconcile(conn)
+        conn.execute("delete from sessions where token='poor'")
+        conn.execute("update sessions set credits=3 where token='rich'")
+        assert service.reconcile(conn) == 2
+        assert service.balance("rich") == 3 and service.balance("poor") is None
+        assert service.stats["drift"] == 2
@@ -1,4 +1,6 @@
+import asyncio
 import os
+import socket
 import sys
 import tempfile
 import time
@@ -131,22 +133,6 @@ class TestChecker:
         should_run = current_time >= (last_probe + interval)
         assert should_run == False
 
-    def test_subprocess_call_pattern(self, temp_db):
-        """Test the subprocess call pattern used for HTTP checks"""
-        import subprocess
-
-        # Test a simple curl command (similar to what's used in checker)
-        result = subprocess.run(
-            ["curl", "-sS", "--max-time", "5", "-o", "/dev/null", "-w", "%{http_code}", "https://httpbin.org/status/200"],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-
-        # Should succeed
-        assert result.returncode == 0
-        assert result.stdout.strip() == "200"
-
     def test_error_handling_patterns(self, temp_db):
         """Test error handling patterns used in checker"""
         from checker import log
@@ -162,4 +148,174 @@ class TestChecker:
         with open(log_file, 'r') as f:
             content = f.read()
             assert "TEST_ERROR" in content
-            assert "Test error" in content
\ No newline at end of file
+            assert "Test error" in content
+
+
+def serve(handler):
+    """Start a raw asyncio HTTP server answering every request with handler()"""
+
+    async def on_client(reader, writer):
+        while (await reader.readline()).strip():
+            pass
+        writer.write(handler())
+        await writer.drain()
+        writer.close()
+
+    return asyncio.start_server(on_client, "127.0.0.1", 0)
+
+
+class TestProbeEngine:
+    """Test cases for the in-process async probe engine"""
+
+    def run_probe(self, payload, **kwargs):
+        import checker
+
+        async def run():
+            server = await serve(lambda: payload)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                return await checker.probe_http(f"http://127.0.0.1:{port}/x", **kwargs)
+
+        return asyncio.run(run())
+
+    def test_content_length_body(self):
+        """Test status, size and timing breakdown for a sized body"""
+        result = self.run_probe(
+            b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello"
+        )
+        assert result["ok"]
+        assert result["http_status"] == 200
+        assert result["size"] == 5
+        assert result["dns_ms"] is not None
+        assert result["connect_ms"] is not None
+        assert result["tls_ms"] is None
+        assert 0 <= result["ttfb_ms"] <= result["latency_ms"]
+
+    def test_chunked_body_counts_decoded_bytes(self):
+        """Test that chunk framing is not counted in the download size"""
+        result = self.run_probe(
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"3\r\nabc\r\n4;ext=1\r\ndefg\r\n0\r\n\r\n"
+        )
+        assert result["ok"]
+        assert result["size"] == 7
+
+    def test_close_delimited_body(self):
+        """Test a body without length that ends when the server closes"""
+        result = self.run_probe(b"HTTP/1.0 404 Not Found\r\n\r\n" + b"x" * 100000)
+        assert result["ok"]
+        assert result["http_status"] == 404
+        assert result["size"] == 100000
+
+    def test_timeout_is_reported(self):
+        """Test that a stalled server produces a failed probe, not a hang"""
+        import checker
+
+        async def run():
+            async def stall(reader, writer):
+                await asyncio.sleep(5)
+
+            server = await asyncio.start_server(stall, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                return await checker.probe_http(
+                    f"http://127.0.0.1:{port}/", timeout=0.2
+                )
+
+        result = asyncio.run(run())
+        assert not result["ok"]
+        assert "timed out" in result["error"]
+        assert result["latency_ms"] < 2000
+
+    def test_connection_refused(self):
+        """Test that a refused connection is recorded as an error"""
+        import checker
+
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        result = asyncio.run(checker.probe_http(f"http://127.0.0.1:{port}/"))
+        assert not result["ok"]
+        assert result["error"]
+
+
+class TestCheckerEngine:
+    """Test cases for due-watcher selection and per-watcher last_probe"""
+
+    @pytest.fixture
+    def temp_db(self):
+        """Create a temporary database with two watchers"""
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".db") as f:
+            temp_path = f.name
+
+        original_path = db.DB_PATH
+        db.DB_PATH = Path(temp_path)
+        db.init_db()
+        with db.get_conn() as conn:
+            c = conn.cursor()
+            now = time.time()
+            c.execute(
+                "INSERT INTO sessions(token, credits, created) VALUES ('tok', 10, ?)",
+                (now,),
+            )
+            c.execute(
+                "INSERT INTO canonical_targets(cid, url) VALUES ('c1', 'http://127.0.0.1:9/')"
+            )
+            c.executemany(
+                "INSERT INTO watchers(wid, cid, token, interval, enabled, created, last_probe) VALUES (?, 'c1', 'tok', ?, 1, ?, ?)",
+                [("due", 60, now, now - 120), ("fresh", 60, now, now - 10)],
+            )
+            conn.commit()
+
+        yield temp_path
+
+        db.DB_PATH = original_path
+        os.unlink(temp_path)
+
+    def test_load_due_uses_watcher_interval(self, temp_db):
+        """Test that only watchers past their own interval are due"""
+        import checker
+
+        with db.get_conn() as conn:
+            due = checker.load_due(conn, time.time())
+            assert [d["wid"] for d in due] == ["due"]
+            assert checker.load_due(conn, time.time(), skip={"due"}) == []
+
+    def test_cycle_probes_charges_and_records_last_probe(
+        self, temp_db, tmp_path, monkeypatch
+    ):
+        """Test that a cycle probes due watchers and records them in one batch"""
+        import checker
+
+        monkeypatch.setattr(checker, "CUSTOMERS", tmp_path)
+        monkeypatch.setattr(checker, "log", lambda *a: None)
+
+        async def fake_probe(url, timeout=None):
+            return {"ok": True, "http_status": 200, "size": 1, "latency_ms": 1.0}
+
+        monkeypatch.setattr(checker, "probe_http", fake_probe)
+
+        async def run():
+            engine = checker.CheckerEngine(concurrency=2)
+            assert engine.cycle() == 1
+            await asyncio.gather(*engine.tasks)
+            # the probe is recorded before the next due selection
+            assert engine.cycle() == 0
+            return engine
+
+        engine = asyncio.run(run())
+        assert engine.probed == {}
+        with db.get_conn() as conn:
+            row = conn.execute(
+                "SELECT last_probe FROM watchers WHERE wid = 'due'"
+            ).fetchone()
+            assert row["last_probe"] > time.time() - 5
+            credits = conn.execute(
+                "SELECT credits FROM sessions WHERE token = 'tok'"
+            ).fetchone()["credits"]
+            assert credits == 9
+            ledger = conn.execute("SELECT action, wid FROM ledger").fetchall()
+            assert [tuple(r) for r in ledger] == [("CONSUME", "due")]
+        history = tmp_path / "tok" / "watchers" / "due.log"
+        assert history.exists()
@@ -179,3 +179,100 @@ class TestCreditManagement:
             assert entry["token"] == token
             assert entry["amount"] == amount
             assert entry["balance"] == balance
+
+    def make_watchers(self, balances):
+        """Create one session per balance with two watchers each"""
+        ts = time.time()
+        charges = []
+        with db.get_conn() as conn:
+            c = conn.cursor()
+            c.execute(
+                "INSERT INTO canonical_targets(cid, url) VALUES ('c1', 'https://example.com')"
+            )
+            for i, credits in enumerate(balances):
+                token = f"tok{i}"
+                c.execute(
+                    "INSERT INTO sessions(token, credits, created) VALUES (?, ?, ?)",
+                    (token, credits, ts),
+                )
+                for j in range(2):
+                    wid = f"w{i}{j}"
+                    c.execute(
+                        "INSERT INTO watchers(wid, cid, token, interval, created) VALUES (?, 'c1', ?, 60, ?)",
+                        (wid, token, ts),
+                    )
+                    charges.append((wid, token, 1))
+            conn.commit()
+        return charges
+
+    def test_charge_watchers_bulk(self, temp_db):
+        """Test that funded watchers are all charged in one call"""
+        charges = self.make_watchers([10, 5])
+
+        with db.get_conn() as conn:
+            charged, underfunded = db.charge_watchers(conn, charges, cid="c1")
+            conn.commit()
+
+        assert underfunded == []
+        assert charged == [
+            ("w00", "tok0", 9),
+            ("w01", "tok0", 8),
+            ("w10", "tok1", 4),
+            ("w11", "tok1", 3),
+        ]
+        with db.get_conn() as conn:
+            c = conn.cursor()
+            credits = dict(c.execute("SELECT token, credits FROM sessions").fetchall())
+            assert credits == {"tok0": 8, "tok1": 3}
+            rows = c.execute(
+                "SELECT action, cid, wid, amount, balance FROM ledger ORDER BY id"
+            ).fetchall()
+            assert [tuple(r) for r in rows] == [
+                ("CONSUME", "c1", "w00", 1, 9),
+                ("CONSUME", "c1", "w01", 1, 8),
+                ("CONSUME", "c1", "w10", 1, 4),
+                ("CONSUME", "c1", "w11", 1, 3),
+            ]
+
+    def test_charge_watchers_underfunded(self, temp_db):
+        """Test partial and empty balances are charged watcher by watcher"""
+        charges = self.make_watchers([1, 0])
+        charges.append(("ghost", "missing-token", 1))
+
+        with db.get_conn() as conn:
+            charged, underfunded = db.charge_watchers(conn, charges)
+            conn.commit()
+
+        assert charged == [("w00", "tok0", 0)]
+        assert underfunded == [
+            ("w01", "tok0", 0),
+            ("w10", "tok1", 0),
+            ("w11", "tok1", 0),
+            ("ghost", "missing-token", 0),
+        ]
+        with db.get_conn() as conn:
+            c = conn.cursor()
+            credits = dict(c.execute("SELECT token, credits FROM sessions").fetchall())
+            assert credits == {"tok0": 0, "tok1": 0}
+            failed = c.execute(
+                "SELECT count(*) FROM ledger WHERE action = 'CHECK_FAILED_CHARGE'"
+            ).fetchone()[0]
+            assert failed == 4
+
+    def test_charge_watchers_rolls_back_with_caller(self, temp_db):
+        """Test that charges are only durable once the caller commits"""
+        charges = self.make_watchers([10])
+
+        with db.get_conn() as conn:
+            db.charge_watchers(conn, charges)
+            conn.rollback()
+
+        with db.get_conn() as conn:
+            c = conn.cursor()
+            assert c.execute("SELECT credits FROM sessions").fetchone()[0] == 10
+            assert c.execute("SELECT count(*) FROM ledger").fetchone()[0] == 0
+
+    def test_charge_watchers_empty(self, temp_db):
+        """Test that an empty batch does nothing"""
+        with db.get_conn() as conn:
+            assert db.charge_watchers(conn, []) == ([], [])
@@ -76,3 +76,164 @@ class TestDatabaseOperations:
             result = c.fetchone()
             # Should be able to access by column name
             assert result["test_col"] == 1
+
+    def test_get_conn_reuses_thread_connection(self, temp_db):
+        """Test that repeated get_conn calls on a thread share one connection"""
+        with db.get_conn() as first:
+            pass
+        with db.get_conn() as second:
+            assert second is first
+
+    def test_threads_get_separate_connections(self, temp_db):
+        """Test that each thread gets its own pooled connection"""
+        import threading
+
+        seen = []
+
+        def worker():
+            with db.get_conn() as conn:
+                seen.append(id(conn))
+            db.close_conns()
+
+        with db.get_conn() as conn:
+            t = threading.Thread(target=worker)
+            t.start()
+            t.join()
+            assert seen and seen[0] != id(conn)
+
+    def test_connection_pragmas(self, temp_db):
+        """Test WAL journaling and per-connection tuning"""
+        with db.get_conn() as conn:
+            c = conn.cursor()
+            assert c.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            assert c.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+            assert c.execute("PRAGMA busy_timeout").fetchone()[0] == db.BUSY_TIMEOUT_MS
+            assert c.execute("PRAGMA mmap_size").fetchone()[0] == db.MMAP_SIZE
+
+    def test_uncommitted_work_rolled_back_on_exit(self, temp_db):
+        """Test that an open transaction does not leak to the next checkout"""
+        with db.get_conn() as conn:
+            with db.get_conn() as inner:
+                inner.execute(
+                    "INSERT INTO sessions(token, credits, created) VALUES ('t', 1, 0)"
+                )
+            # the nested exit must not roll back the outer block's work
+            assert conn.in_transaction
+        with db.get_conn() as conn:
+            assert not conn.in_transaction
+            count = conn.execute("SELECT count(*) FROM sessions").fetchone()[0]
+            assert count == 0
+
+    def test_pool_stats(self, temp_db):
+        """Test that pool metrics count opens, reuses and checkouts"""
+        with db.get_conn():
+            pass
+        before = db.pool_stats()
+        with db.get_conn():
+            during = db.pool_stats()
+        after = db.pool_stats()
+
+        assert during["in_use"] == before["in_use"] + 1
+        assert after["reused"] == before["reused"] + 1
+        assert after["checkouts"] == before["checkouts"] + 1
+        assert after["opened"] == before["opened"]
+        assert after["open"] >= 1
+
+    def test_migrations_record_schema_version(self, temp_db):
+        """Test that every migration is applied once and recorded"""
+        with db.get_conn() as conn:
+            assert db.schema_version(conn) == db.MIGRATIONS[-1][0]
+            versions = [
+                r[0] for r in conn.execute("SELECT version FROM schema_migrations")
+            ]
+            assert versions == [m[0] for m in db.MIGRATIONS]
+            # running again is a no-op
+            assert db.migrate(conn) == []
+
+    def test_watchers_last_probe_column(self, temp_db):
+        """Test that the watchers table has the last_probe column"""
+        with db.get_conn() as conn:
+            columns = [r[1] for r in conn.execute("PRAGMA table_info(watchers)")]
+            assert "last_probe" in columns
+
+    def test_hot_query_indexes(self, temp_db):
+        """Test that the hot watcher, target and ledger queries use indexes"""
+        queries = [
+            "SELECT wid FROM watchers WHERE cid = 'x' AND enabled = 1",
+            "SELECT wid FROM watchers WHERE token = 'x'",
+            "SELECT cid FROM canonical_targets WHERE next_run <= 1",
+            "SELECT id FROM ledger WHERE token = 'x' AND ts > 1",
+        ]
+        with db.get_conn() as conn:
+            for query in queries:
+                plan = " ".join(
+                    r[-1] for r in conn.execute("EXPLAIN QUERY PLAN " + query)
+                )
+                assert "USING" in plan and "INDEX" in plan, (query, plan)
+
+    def test_migrate_legacy_database(self, tmp_path):
+        """Test migrating a pre-migrations database that already has last_probe"""
+        path = tmp_path / "legacy.db"
+        conn = sqlite3.connect(path)
+        for sql in db.BASE_SCHEMA:
+            conn.execute(sql)
+        conn.execute("ALTER TABLE watchers ADD COLUMN last_probe REAL")
+        conn.execute(
+            "INSERT INTO sessions(token, credits, created) VALUES ('keep', 5, 0)"
+        )
+        conn.commit()
+
+        assert db.migrate(conn) == [m[0] for m in db.MIGRATIONS]
+        assert conn.execute("SELECT credits FROM sessions").fetchone()[0] == 5
+        conn.close()
+
+    def test_failed_migration_is_rolled_back(self, tmp_path, monkeypatch):
+        """Test that a failing migration leaves no partial changes behind"""
+
+        def broken(c):
+            c.execute("CREATE TABLE half_done(x)")
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(db, "MIGRATIONS", db.MIGRATIONS + [(999, "broken", broken)])
+        conn = sqlite3.connect(tmp_path / "broken.db")
+        with pytest.raises(RuntimeError):
+            db.migrate(conn)
+        tables = [
+            r[0]
+            for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        ]
+        assert "half_done" not in tables
+        assert db.schema_version(conn) == db.MIGRATIONS[-2][0]
+        conn.close()
+
+    def test_ledger_rollups(self, tmp_path):
+        """Test that daily rollups are backfilled and then kept by the trigger"""
+        conn = sqlite3.connect(tmp_path / "rollup.db")
+        for sql in db.BASE_SCHEMA:
+            conn.execute(sql)
+        conn.execute(
+            "INSERT INTO ledger(ts, action, token, wid, amount) "
+            "VALUES (0, 'CONSUME', 'tok', 'w1', 1)"
+        )
+        conn.commit()
+        db.migrate(conn)
+        conn.executemany(
+            "INSERT INTO ledger(ts, action, token, wid, amount) VALUES (?,?,?,?,?)",
+            [
+                (60, "CONSUME", "tok", "w1", 2),
+                (86400, "CONSUME", "tok", "w2", 1),
+                (86400, "TOPUP", "tok", None, 10),
+            ],
+        )
+        conn.execute("DELETE FROM ledger")
+        assert conn.execute(
+            "SELECT day, action, events, amount FROM earnings_daily ORDER BY 1, 2"
+        ).fetchall() == [
+            ("1970-01-01", "CONSUME", 2, 3),
+            ("1970-01-02", "CONSUME", 1, 1),
+            ("1970-01-02", "TOPUP", 1, 10),
+        ]
+        assert conn.execute(
+            "SELECT day, wid, events FROM watcher_earnings_daily ORDER BY 1, 2"
+        ).fetchall() == [("1970-01-01", "w1", 2), ("1970-01-02", "w2", 1)]
+        conn.close()
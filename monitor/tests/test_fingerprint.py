@@ -0,0 +1,50 @@
+import hashlib
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import fingerprint
+
+
+def digest(chunks, strip=()):
+    fp = fingerprint.Fingerprint("sha256", strip)
+    for chunk in chunks:
+        fp.update(chunk)
+    return fp.hexdigest()
+
+
+class TestFingerprint:
+    """Test cases for incremental body fingerprints"""
+
+    def test_plain_hash_matches_hashlib(self):
+        """Test that without stripping the fingerprint is the body's hash"""
+        body = b"<html>hello</html>\n" * 100
+        chunks = [body[i : i + 7] for i in range(0, len(body), 7)]
+        assert digest(chunks) == hashlib.sha256(body).hexdigest()
+
+    def test_volatile_regions_are_ignored(self):
+        """Test that stripped regions do not change the fingerprint"""
+        strip = [r"<time>[^<]*</time>", r'csrf="\w+"']
+        a = b'<p>news</p>\n<time>10:00</time>\n<form csrf="abc123">\n'
+        b = b'<p>news</p>\n<time>10:05</time>\n<form csrf="zzz999">\n'
+        assert digest([a], strip) == digest([b], strip)
+        assert digest([a], strip) != digest([b"<p>other</p>\n"], strip)
+
+    def test_chunk_boundaries_do_not_matter(self):
+        """Test that a volatile region split across chunks is still stripped"""
+        strip = [r"<time>[^<]*</time>"]
+        body = b"a\n<time>10:00</time> b\nc"
+        whole = digest([body], strip)
+        for cut in range(1, len(body)):
+            assert digest([body[:cut], body[cut:]], strip) == whole
+        assert whole == hashlib.sha256(b"a\n b\nc").hexdigest()
+
+    def test_long_line_is_hashed_in_pieces(self, monkeypatch):
+        """Test that a body without newlines is not buffered indefinitely"""
+        monkeypatch.setattr(fingerprint, "MAX_LINE", 10)
+        fp = fingerprint.Fingerprint("sha256", [r"x"])
+        fp.update(b"a" * 25)
+        assert fp._tail == b""
+        fp.update(b"bbx")
+        assert fp.hexdigest() == hashlib.sha256(b"a" * 25 + b"bb").hexdigest()
@@ -0,0 +1,59 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import hostlimit
+
+
+class TestHostLimiter:
+    """Test cases for per-host rate and concurrency limits"""
+
+    def test_token_bucket_rate(self):
+        """Test that a host gets its burst and then HOST_RATE per second"""
+        limiter = hostlimit.HostLimiter(rate=2, burst=3, concurrency=100)
+        assert [limiter.try_acquire("h", 0) for _ in range(3)] == [0, 0, 0]
+        assert limiter.try_acquire("h", 0) == 0.5
+        assert limiter.try_acquire("h", 0.25) == 0.25
+        assert limiter.try_acquire("h", 0.5) == 0
+        # other hosts have their own bucket
+        assert limiter.try_acquire("other", 0.5) == 0
+
+    def test_concurrency_cap(self):
+        """Test that a host is busy at its cap until a probe is released"""
+        limiter = hostlimit.HostLimiter(rate=100, burst=100, concurrency=2)
+        assert limiter.try_acquire("h", 0) == 0
+        assert limiter.try_acquire("h", 0) == 0
+        assert limiter.try_acquire("h", 0) == hostlimit.BUSY_RETRY
+        assert limiter.in_flight("h") == 2
+        limiter.release("h")
+        assert limiter.try_acquire("h", 0) == 0
+        assert limiter.stats == {"acquired": 3, "rate_limited": 0, "busy": 1}
+
+    def test_prune_idle_hosts(self):
+        """Test that only idle hosts with a full bucket are forgotten"""
+        limiter = hostlimit.HostLimiter(rate=1, burst=2, concurrency=2)
+        limiter.try_acquire("busy", 0)
+        limiter.try_acquire("idle", 0)
+        limiter.release("idle")
+
+        assert limiter.prune(0.5) == 0
+        assert limiter.prune(1) == 1
+        assert limiter.in_flight("busy") == 1
+
+    def test_host_of_and_jitter(self):
+        """Test host keys and the stable start offsets"""
+        assert (
+            hostlimit.host_of("https://API.example.com:8443/x?y") == "api.example.com"
+        )
+        offsets = {hostlimit.jitter(f"c{i}", 30) for i in range(100)}
+        assert len(offsets) == 100
+        assert all(0 <= o < 30 for o in offsets)
+        assert hostlimit.jitter("c1", 30) == hostlimit.jitter("c1", 30)
+
+    def test_from_config(self):
+        """Test that config.json keys override the defaults"""
+        limiter = hostlimit.HostLimiter.from_config({"host_rate": 0.5})
+        assert limiter.rate == 0.5
+        assert limiter.burst == hostlimit.HOST_BURST
+        assert limiter.concurrency == hostlimit.HOST_CONCURRENCY
@@ -0,0 +1,131 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import logwriter
+import store
+
+
+class TestLogWriter:
+    """Test cases for the write-behind log writer"""
+
+    def test_appends_are_buffered_until_flush(self, tmp_path):
+        """Test that writes reach disk in one write per file per flush"""
+        w = logwriter.LogWriter()
+        path = tmp_path / "sub" / "a.log"
+        for i in range(100):
+            w.write(path, b"%d\n" % i)
+
+        assert not path.exists()
+        assert w.flush() == 1
+        assert path.read_bytes() == b"".join(b"%d\n" % i for i in range(100))
+        assert w.stats["writes"] == 1
+        assert w.flush() == 0
+        w.close()
+
+    def test_open_handles_are_bounded(self, tmp_path):
+        """Test that the handle LRU evicts the least recently used file"""
+        w = logwriter.LogWriter(max_open=2)
+        for round_ in range(3):
+            for name in ("a", "b", "c"):
+                w.write(tmp_path / name, name.encode())
+            w.flush()
+            assert len(w._handles) == 2
+
+        for name in ("a", "b", "c"):
+            assert (tmp_path / name).read_bytes() == name.encode() * 3
+        w.close()
+        assert not w._handles
+
+    def test_seal_runs_after_data_is_written(self, tmp_path):
+        """Test that a sealed file is complete and closed when fn runs"""
+        w = logwriter.LogWriter()
+        path = tmp_path / "seg"
+        seen = []
+        w.write(path, b"data")
+        w.flush()
+        w.write(path, b"more")
+        w.seal(path, lambda p: seen.append(p.read_bytes()))
+
+        assert seen == []
+        w.flush()
+        assert seen == [b"datamore"]
+        assert path not in w._handles
+
+    @pytest.mark.parametrize(
+        "policy, interval, expected",
+        [("always", 5, 4), ("interval", 0, 4), ("interval", 3600, 0), ("never", 0, 0)],
+    )
+    def test_fsync_policy(self, tmp_path, policy, interval, expected):
+        """Test how many fsyncs each policy issues for two flushes"""
+        w = logwriter.LogWriter(fsync=policy, fsync_interval=interval)
+        for _ in range(2):
+            w.write(tmp_path / "a", b"x")
+            w.write(tmp_path / "b", b"y")
+            w.flush()
+        assert w.stats["fsyncs"] == expected
+
+    def test_rejects_unknown_fsync_policy(self):
+        """Test that a typo in the fsync policy is caught"""
+        with pytest.raises(ValueError):
+            logwriter.LogWriter.from_config({"log_fsync": "sometimes"})
+
+    def test_run_flushes_on_time_and_size(self, tmp_path):
+        """Test the background flusher's interval and size triggers"""
+        w = logwriter.LogWriter(max_buffer=1024, flush_interval=0.05)
+
+        async def run():
+            task = asyncio.create_task(w.run())
+            await asyncio.sleep(0)
+            w.write(tmp_path / "small", b"x")
+            await asyncio.sleep(0.2)
+            small = (tmp_path / "small").exists()
+
+            w.flush_interval = 3600
+            await asyncio.sleep(0.1)
+            w.write(tmp_path / "big", b"x" * 2048)
+            await asyncio.sleep(0.1)
+            big = (tmp_path / "big").exists()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return small, big
+
+        assert asyncio.run(run()) == (True, True)
+        w.close()
+
+
+class TestBufferedStore:
+    """Test cases for the probe store on top of the log writer"""
+
+    def test_compaction_waits_for_buffered_rows(self, tmp_path, monkeypatch):
+        """Test that a segment is compacted only once its rows are on disk"""
+        monkeypatch.setattr(store, "SEGMENT_RECORDS", 4)
+        w = logwriter.LogWriter()
+        s = store.ProbeStore(tmp_path, w)
+        for i in range(6):
+            s.append("c1", {"ts": i, "status": "ok", "http_status": 200})
+
+        assert not (tmp_path / "c1" / "000000.col").exists()
+        w.flush()
+        names = sorted(p.name for p in (tmp_path / "c1").iterdir())
+        assert names == ["000000.col", "000001.rows"]
+        assert [r["ts"] for r in store.tail(tmp_path, "c1")] == [0, 1, 2, 3, 4, 5]
+        w.close()
+
+    def test_ref_header_written_once(self, tmp_path):
+        """Test that buffered watcher refs get a single header"""
+        w = logwriter.LogWriter()
+        s = store.ProbeStore(tmp_path, w)
+        path = tmp_path / "w" / "w1.ref"
+        s.append_ref(path, "c1", 1, 1)
+        s.append_ref(path, "c1", 2, 2)
+        w.flush()
+        s.append_ref(path, "c1", 3, 3)
+        w.flush()
+
+        assert store.tail_refs(path) == ("c1", [(1, 1), (2, 2), (3, 3)])
+        w.close()
@@ -0,0 +1,58 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import overload
+
+
+class TestLagMonitor:
+    """Test cases for schedule lag tracking and overload detection"""
+
+    def test_histogram_is_cumulative(self):
+        """Test that lags land in cumulative le buckets"""
+        lags = overload.LagMonitor()
+        for lag in (0.05, 0.3, 0.3, 4, 1000, -1):
+            lags.record(lag, now=100)
+
+        m = lags.metrics(now=100)
+        assert m["histogram"]["0.1"] == 2  # negative lag counts as zero
+        assert m["histogram"]["0.5"] == 4
+        assert m["histogram"]["5"] == 5
+        assert m["histogram"]["+Inf"] == m["count"] == 6
+        assert m["sum"] == 1004.65
+
+    def test_overload_and_recovery_events(self):
+        """Test the hysteresis between overload and recovery"""
+        lags = overload.LagMonitor(overload_lag=10, recover_lag=2)
+        for _ in range(20):
+            lags.record(30, now=0)
+        event = lags.update(0)
+        assert event["event"] == "overload" and event["p95_lag"] == 30
+        assert lags.overloaded
+        assert lags.update(1) is None
+
+        # in between the thresholds: still overloaded
+        for _ in range(100):
+            lags.record(5, now=70)
+        assert lags.update(70) is None and lags.overloaded
+
+        for _ in range(100):
+            lags.record(0.5, now=140)
+        assert lags.update(140)["event"] == "recovered"
+        assert [e["event"] for e in lags.metrics(140)["events"]] == [
+            "overload",
+            "recovered",
+        ]
+
+    def test_backoff_grows_with_lag(self):
+        """Test that low-priority targets back off further as lag grows"""
+        lags = overload.LagMonitor()
+        assert lags.backoff(0) == overload.MIN_BACKOFF
+        lags.record(100, now=0)
+        assert lags.backoff(0) == 200
+        for _ in range(2):
+            lags.record(10**6, now=0)
+        assert lags.backoff(0) == overload.MAX_BACKOFF
+        # old lags leave the window
+        assert lags.backoff(overload.LAG_WINDOW + 1) == overload.MIN_BACKOFF
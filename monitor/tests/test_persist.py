@@ -0,0 +1,120 @@
+import asyncio
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import persist
+
+
+def insert(conn, value):
+    conn.execute("insert into t(v) values(?)", (value,))
+    return threading.current_thread().name
+
+
+def fail(conn, value):
+    conn.execute("insert into t(v) values(?)", (value,))
+    raise RuntimeError("boom")
+
+
+class TestPersister:
+    """Test cases for the single-thread persistence executor"""
+
+    @pytest.fixture
+    def temp_db(self, tmp_path, monkeypatch):
+        """Point the persister at a temporary database with one table"""
+        path = tmp_path / "test.db"
+        monkeypatch.setattr(persist.db, "DB_PATH", path)
+        with persist.db.get_conn() as conn:
+            conn.execute("create table t(v text)")
+            conn.commit()
+        yield path
+
+    def values(self):
+        with persist.db.get_conn() as conn:
+            return [r[0] for r in conn.execute("select v from t order by rowid")]
+
+    def test_jobs_run_on_writer_thread(self, temp_db):
+        """Test that jobs run in order off the calling thread"""
+        p = persist.Persister()
+        futures = [p.submit(insert, str(i)) for i in range(5)]
+        assert {f.result(timeout=5) for f in futures} == {"persist"}
+        p.close()
+        assert self.values() == ["0", "1", "2", "3", "4"]
+
+    def test_failed_job_only_rolls_back_itself(self, temp_db):
+        """Test that savepoints isolate a failing job in a shared batch"""
+        gate = threading.Event()
+        p = persist.Persister()
+        p.call(gate.wait)
+        ok1 = p.submit(insert, "a")
+        bad = p.submit(fail, "b")
+        ok2 = p.submit(insert, "c")
+        gate.set()
+        p.close()
+
+        assert ok1.result() == ok2.result() == "persist"
+        with pytest.raises(RuntimeError):
+            bad.result()
+        assert self.values() == ["a", "c"]
+        assert p.stats["transactions"] == 1
+        assert p.stats["failed"] == 1
+
+    def test_queued_jobs_share_a_transaction(self, temp_db):
+        """Test that jobs queued behind a slow one are committed together"""
+        gate = threading.Event()
+        p = persist.Persister(max_batch=50)
+        p.call(gate.wait)
+        for i in range(120):
+            p.submit(insert, str(i))
+        gate.set()
+        p.close()
+
+        assert len(self.values()) == 120
+        assert p.stats["transactions"] == 3
+
+    def test_group_delay_gathers_later_jobs(self, temp_db):
+        """Test that jobs arriving within the delay share the first one's commit"""
+        p = persist.Persister(delay=0.5)
+        first = p.submit(insert, "a")
+        time.sleep(0.05)
+        second = p.submit(insert, "b")
+        assert first.result(timeout=5) == second.result(timeout=5)
+        p.close()
+
+        assert self.values() == ["a", "b"]
+        assert p.stats["transactions"] == 1
+
+    def test_plain_jobs_keep_their_place(self, temp_db):
+        """Test that call() jobs run between DB jobs in submission order"""
+        seen = []
+        p = persist.Persister()
+        p.submit(insert, "a")
+        p.call(lambda: seen.append(self.values()))
+        p.submit(insert, "b")
+        p.close()
+
+        assert seen == [["a"]]
+        assert self.values() == ["a", "b"]
+
+    def test_run_survives_cancellation(self, temp_db):
+        """Test that work handed off by a cancelled coroutine is still applied"""
+        gate = threading.Event()
+        p = persist.Persister()
+
+        async def main():
+            p.call(gate.wait)
+            task = asyncio.create_task(p.run(insert, "x"))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            gate.set()
+            return await p.run(insert, "y")
+
+        assert asyncio.run(main()) == "persist"
+        p.close()
+        assert self.values() == ["x", "y"]
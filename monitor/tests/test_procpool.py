@@ -0,0 +1,105 @@
+import asyncio
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+from aiohttp import web
+
+from monitor import procpool
+
+
+async def serve(handler):
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+
+class TestProbePool:
+    """Test cases for probing in worker processes"""
+
+    def test_probes_run_in_workers(self):
+        """Test that every target is probed by some worker and comes back"""
+
+        async def hello(request):
+            return web.Response(text="hello")
+
+        async def run():
+            runner, port = await serve(hello)
+            pool = procpool.ProbePool(2)
+            await pool.start()
+            try:
+                futs = [
+                    pool.probe(f"c{i}", f"http://127.0.0.1:{port}/") for i in range(20)
+                ]
+                recs = await asyncio.wait_for(asyncio.gather(*futs), 30)
+            finally:
+                await pool.close()
+                await runner.cleanup()
+            return pool, recs
+
+        pool, recs = asyncio.run(run())
+        assert [r["cid"] for r in recs] == [f"c{i}" for i in range(20)]
+        assert all(r["status"] == "ok" and r["size"] == 5 for r in recs)
+        assert pool.stats["sent"] == pool.stats["results"] == 20
+        # results come back batched
+        assert pool.stats["batches"] < 20
+        assert not any(p.is_alive() for p in pool._procs)
+
+    def test_load_is_spread(self):
+        """Test that targets go to the least loaded worker"""
+
+        async def run():
+            pool = procpool.ProbePool(3)
+            await pool.start()
+            try:
+                futs = [pool.probe(f"c{i}", "http://127.0.0.1:9/") for i in range(9)]
+                load = list(pool._load)
+                recs = await asyncio.wait_for(asyncio.gather(*futs), 30)
+            finally:
+                await pool.close()
+            return load, recs
+
+        load, recs = asyncio.run(run())
+        assert load == [3, 3, 3]
+        assert all(r["status"] == "error" for r in recs)
+
+    def test_dead_worker_is_replaced(self):
+        """Test that probes held by a killed worker fail and it is restarted"""
+
+        async def slow(request):
+            await asyncio.sleep(2)
+            return web.Response(text="late")
+
+        async def run():
+            runner, port = await serve(slow)
+            pool = procpool.ProbePool(1)
+            await pool.start()
+            try:
+                fut = pool.probe("c1", f"http://127.0.0.1:{port}/")
+                await asyncio.sleep(0.5)
+                old = pool._procs[0]
+                os.kill(old.pid, signal.SIGKILL)
+                await asyncio.to_thread(old.join)
+                pool.check(time.time())
+                rec = await asyncio.wait_for(fut, 5)
+                again = await asyncio.wait_for(
+                    pool.probe("c2", "http://127.0.0.1:9/"), 30
+                )
+            finally:
+                await pool.close()
+                await runner.cleanup()
+            return pool, old, rec, again
+
+        pool, old, rec, again = asyncio.run(run())
+        assert rec["status"] == "error" and "exited" in rec["error"]
+        assert pool.stats["restarts"] == 1
+        assert pool._procs[0] is not old
+        assert again["cid"] == "c2"
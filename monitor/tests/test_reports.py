@@ -136,3 +136,188 @@ class TestReports:
         assert result[0]["id"] == 7  # Should get last 3 items
         assert result[1]["id"] == 8
         assert result[2]["id"] == 9
+
+    def test_tail_lines_reads_backwards_across_blocks(self, temp_dir, monkeypatch):
+        """Test that records spanning block boundaries are read intact"""
+        monkeypatch.setattr(reports, "BLOCK_SIZE", 16)
+        test_file = Path(temp_dir) / "test.log"
+        with test_file.open("w") as f:
+            for i in range(500):
+                f.write(json.dumps({"id": i, "pad": "x" * (i % 37)}) + "\n")
+
+        result = reports.tail_lines(test_file, n=5)
+        assert [r["id"] for r in result] == [495, 496, 497, 498, 499]
+        assert reports.tail_lines(test_file, n=1000)[0]["id"] == 0
+
+    def test_tail_lines_does_not_read_whole_file(self, temp_dir, monkeypatch):
+        """Test that only the end of a large file is read"""
+        test_file = Path(temp_dir) / "big.log"
+        with test_file.open("w") as f:
+            for i in range(20000):
+                f.write(json.dumps({"id": i}) + "\n")
+
+        read_bytes = []
+        real_open = Path.open
+
+        def counting_open(self, *args, **kwargs):
+            fh = real_open(self, *args, **kwargs)
+            real_read = fh.read
+
+            def read(size=-1):
+                data = real_read(size)
+                read_bytes.append(len(data))
+                return data
+
+            fh.read = read
+            return fh
+
+        monkeypatch.setattr(Path, "open", counting_open)
+        result = reports.tail_lines(test_file, n=3)
+        assert [r["id"] for r in result] == [19997, 19998, 19999]
+        assert sum(read_bytes) <= reports.BLOCK_SIZE
+
+    def test_tail_lines_skips_partial_and_corrupt_lines(self, temp_dir):
+        """Test that a half-written last line and corrupt lines are skipped"""
+        test_file = Path(temp_dir) / "test.log"
+        with test_file.open("w") as f:
+            f.write(json.dumps({"id": 1}) + "\n")
+            f.write("{not json\n")
+            f.write("\n")
+            f.write(json.dumps({"id": 2}) + "\n")
+            f.write('{"id": 3, "sta')
+
+        result = reports.tail_lines(test_file, n=2)
+        assert [r["id"] for r in result] == [1, 2]
+
+    def test_tail_lines_zero_limit(self, temp_dir):
+        """Test that a non-positive limit returns nothing"""
+        test_file = Path(temp_dir) / "test.log"
+        test_file.write_text(json.dumps({"id": 1}) + "\n")
+        assert reports.tail_lines(test_file, n=0) == []
+
+    def test_reports_for_cid_limit(self, temp_dir):
+        """Test that reports_for_cid honors its limit"""
+        cid = "limited"
+        with (reports.RESULTS / f"{cid}.log").open("w") as f:
+            for i in range(10):
+                f.write(json.dumps({"id": i}) + "\n")
+
+        result = reports.reports_for_cid(cid, limit=4)
+        assert [r["id"] for r in result] == [6, 7, 8, 9]
+
+    def write_minutely(self, path, start, count):
+        """Append one record per minute through the indexing writer"""
+        for i in range(count):
+            reports.append_record(path, {"ts": start + i * 60, "id": i})
+
+    def test_append_record_maintains_index(self, temp_dir):
+        """Test that the sidecar gets one entry per time bucket"""
+        path = Path(temp_dir) / "c.log"
+        self.write_minutely(path, 0, 180)
+
+        idx = reports.index_path(path)
+        entries = idx.stat().st_size // reports.INDEX_ENTRY.size
+        assert entries == 180 * 60 // reports.INDEX_BUCKET
+        with path.open("rb") as f:
+            f.seek(reports.seek_offset(path, 7200))
+            assert json.loads(f.readline())["ts"] == 7200
+
+    def test_read_range_window(self, temp_dir):
+        """Test reading a since/until window oldest first"""
+        path = Path(temp_dir) / "c.log"
+        self.write_minutely(path, 1000, 600)
+
+        result = reports.read_range(path, since=1000 + 300 * 60, until=1000 + 304 * 60)
+        assert [r["id"] for r in result] == [300, 301, 302, 303, 304]
+        page = reports.read_range(path, since=1000 + 590 * 60, limit=3)
+        assert [r["id"] for r in page] == [590, 591, 592]
+        assert reports.read_range(path, since=10**9) == []
+
+    def test_read_range_until_only(self, temp_dir):
+        """Test that until alone returns the latest records before it"""
+        path = Path(temp_dir) / "c.log"
+        self.write_minutely(path, 0, 600)
+
+        result = reports.read_range(path, until=100 * 60, limit=3)
+        assert [r["id"] for r in result] == [98, 99, 100]
+
+    def test_read_range_seeks_instead_of_scanning(self, temp_dir, monkeypatch):
+        """Test that a window near the end does not read from the start"""
+        path = Path(temp_dir) / "c.log"
+        self.write_minutely(path, 0, 5000)
+        start = reports.seek_offset(path, 4990 * 60)
+        assert start > path.stat().st_size * 0.9
+
+        result = reports.read_range(path, since=4990 * 60)
+        assert [r["id"] for r in result] == list(range(4990, 5000))
+
+    def test_read_range_builds_index_for_legacy_log(self, temp_dir):
+        """Test that a log written without an index gets one on first query"""
+        path = Path(temp_dir) / "legacy.log"
+        with path.open("w") as f:
+            for i in range(300):
+                f.write(json.dumps({"ts": i * 60, "id": i}) + "\n")
+            f.write("{torn")
+
+        result = reports.read_range(path, since=200 * 60, until=202 * 60)
+        assert [r["id"] for r in result] == [200, 201, 202]
+        assert reports.index_path(path).exists()
+
+    def test_timeseries_for_wid_range(self, temp_dir):
+        """Test that timeseries_for_wid accepts since/until"""
+        token, wid = "tok", "w1"
+        path = reports.BASE / "customers" / token / "watchers" / f"{wid}.log"
+        path.parent.mkdir(parents=True)
+        self.write_minutely(path, 0, 10)
+
+        result = reports.timeseries_for_wid(token, wid, since=120, until=240)
+        assert [r["id"] for r in result] == [2, 3, 4]
+
+    def test_reports_for_cid_reads_compact_store(self, temp_dir):
+        """Test that compact records follow older JSON log records"""
+        cid = "mixed"
+        with (reports.RESULTS / f"{cid}.log").open("w") as f:
+            for i in range(3):
+                f.write(json.dumps({"ts": i, "status": "ok"}) + "\n")
+        s = reports.store.ProbeStore(reports.RESULTS)
+        for i in range(3, 6):
+            s.append(
+                cid,
+                {
+                    "ts": i,
+                    "status": "ok",
+                    "http_status": 200,
+                    "latency_ms": 1,
+                    "size": 2,
+                },
+            )
+
+        assert [r["ts"] for r in reports.reports_for_cid(cid, limit=4)] == [2, 3, 4, 5]
+        assert [r["ts"] for r in reports.reports_for_cid(cid, limit=2)] == [4, 5]
+        window = reports.reports_for_cid(cid, since=1, until=4)
+        assert [r["ts"] for r in window] == [1, 2, 3, 4]
+
+    def test_timeseries_for_wid_resolves_references(self, temp_dir):
+        """Test that watcher references are joined with canonical records"""
+        s = reports.store.ProbeStore(reports.RESULTS)
+        ref = reports.BASE / "customers" / "tok" / "watchers" / "w1.ref"
+        for i in range(4):
+            s.append(
+                "c1",
+                {
+                    "ts": i * 60,
+                    "status": "ok",
+                    "http_status": 204,
+                    "latency_ms": 5,
+                    "size": 0,
+                },
+            )
+            s.append_ref(ref, "c1", i * 60 + 1, i * 60)
+
+        result = reports.timeseries_for_wid("tok", "w1", limit=2)
+        assert [r["ts"] for r in result] == [121, 181]
+        assert result[0]["wid"] == "w1"
+        assert result[0]["cid"] == "c1"
+        assert result[0]["probe"]["http_status"] == 204
+        window = reports.timeseries_for_wid("tok", "w1", since=60, until=130)
+        assert [r["probe"]["ts"] for r in window] == [60, 120]
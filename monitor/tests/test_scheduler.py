@@ -0,0 +1,979 @@
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+from aiohttp import web
+
+from monitor import (
+    adaptive,
+    balances,
+    db,
+    hostlimit,
+    logwriter,
+    overload,
+    persist,
+    scheduler,
+    sharding,
+    stats,
+    store,
+)
+
+
+def add_target(conn, cid, url, next_run=None, wid=None, token="tok", enabled=1):
+    ts = time.time()
+    conn.execute(
+        "insert or ignore into sessions(token,credits,created,last_used) values(?,?,?,?)",
+        (token, 100, ts, ts),
+    )
+    conn.execute(
+        "insert or ignore into canonical_targets(cid,url,last_ok,next_run) values(?,?,?,?)",
+        (cid, url, 0, next_run),
+    )
+    if wid:
+        conn.execute(
+            "insert into watchers(wid,cid,token,interval,enabled,created) values(?,?,?,?,?,?)",
+            (wid, cid, token, 60, enabled, ts),
+        )
+    conn.commit()
+
+
+class TestTargetQueue:
+    """Test cases for the in-memory min-heap of canonical targets"""
+
+    @pytest.fixture
+    def temp_db(self):
+        """Create a temporary database for testing"""
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".db") as f:
+            temp_path = f.name
+
+        original_path = db.DB_PATH
+        db.DB_PATH = Path(temp_path)
+        db.init_db()
+
+        yield temp_path
+
+        db.DB_PATH = original_path
+        os.unlink(temp_path)
+
+    def test_pop_due_in_next_run_order(self):
+        """Test that due targets come out ordered by next_run"""
+        q = scheduler.TargetQueue()
+        q.schedule("c", "http://c", 30)
+        q.schedule("a", "http://a", 10)
+        q.schedule("b", "http://b", 20)
+        q.schedule("late", "http://late", 100)
+
+        due = q.pop_due(50)
+        assert [d[0] for d in due] == ["a", "b", "c"]
+        assert q.next_run() == 100
+        assert len(q) == 1
+
+    def test_reschedule_replaces_entry(self):
+        """Test that rescheduling a target invalidates its old heap entry"""
+        q = scheduler.TargetQueue()
+        q.schedule("a", "http://a", 10)
+        q.schedule("a", "http://a", 40)
+
+        assert q.pop_due(20) == []
+        assert q.next_run() == 40
+        assert [d[0] for d in q.pop_due(40)] == ["a"]
+
+    def test_in_flight_target_not_popped_twice(self):
+        """Test that a target is in flight until done() is called"""
+        q = scheduler.TargetQueue()
+        q.schedule("a", "http://a", 10)
+        q.pop_due(10)
+
+        assert "a" in q
+        assert q.pop_due(1000) == []
+        q.done("a", "http://a", 70)
+        assert q.next_run() == 70
+
+    def test_unschedule_in_flight_target(self):
+        """Test that a target removed while in flight is not requeued"""
+        q = scheduler.TargetQueue()
+        q.schedule("a", "http://a", 10)
+        q.pop_due(10)
+        q.unschedule("a")
+        q.done("a", "http://a", 70)
+
+        assert "a" not in q
+        assert q.next_run() is None
+
+    def test_load_only_watched_targets(self, temp_db):
+        """Test that load() only queues targets with enabled watchers"""
+        with db.get_conn() as conn:
+            add_target(conn, "watched", "http://w", 5, wid="w1")
+            add_target(conn, "disabled", "http://d", 5, wid="w2", enabled=0)
+            add_target(conn, "orphan", "http://o", 5)
+
+            q = scheduler.TargetQueue()
+            assert q.load(conn) == 1
+        assert "watched" in q
+        assert "disabled" not in q
+        assert "orphan" not in q
+
+    def test_sync_picks_up_new_watchers(self, temp_db):
+        """Test that a sync only reads watchers created since the last one"""
+        with db.get_conn() as conn:
+            add_target(conn, "a", "http://a", 5, wid="w1")
+            q = scheduler.TargetQueue()
+            q.load(conn)
+
+            add_target(conn, "b", "http://b", None, wid="w2")
+            add_target(conn, "a", "http://a", 5, wid="w3")
+            assert q.add_watchers(scheduler.new_watchers(conn, q.watcher_rowid)) == 1
+            assert q.add_watchers(scheduler.new_watchers(conn, q.watcher_rowid)) == 0
+        assert "b" in q
+
+    def test_new_watcher_brings_long_interval_target_forward(self, temp_db):
+        """Test that a short watcher on an hourly target is probed without waiting"""
+        now = time.time()
+        with db.get_conn() as conn:
+            add_target(conn, "a", "http://a", now + 3600, wid="w1")
+            add_target(conn, "b", "http://b", now - 1, wid="w2")
+            q = scheduler.TargetQueue()
+            q.load(conn)
+            [(cid, url, _)] = q.pop_due(now + scheduler.START_JITTER)
+            assert cid == "b"
+            assert q.next_run() == now + 3600
+
+            # a second watcher registers on each target, "b" while in flight
+            add_target(conn, "a", "http://a", wid="w3")
+            add_target(conn, "b", "http://b", wid="w4")
+            assert q.add_watchers(scheduler.new_watchers(conn, q.watcher_rowid)) == 0
+            assert q.next_run() < time.time() + scheduler.START_JITTER
+            assert q.take_dirty() == []
+
+            q.done(cid, url, time.time() + 3600)
+            [entry] = [e for e in q._heap if e[1] == "b" and e[-1]]
+            assert entry[0] <= time.time() + scheduler.MIN_INTERVAL
+
+    def test_due_targets_are_spread_at_start(self, temp_db):
+        """Test that overdue and new targets get a stable start offset"""
+        now = time.time()
+        with db.get_conn() as conn:
+            for i in range(20):
+                add_target(conn, f"c{i}", f"http://same-host/{i}", 5, wid=f"w{i}")
+            add_target(conn, "later", "http://other/", now + 3600, wid="wl")
+            q = scheduler.TargetQueue()
+            q.load(conn)
+
+        starts = sorted(e[0] for e in q._entries.values())
+        assert starts[-1] == now + 3600
+        spread = starts[:-1]
+        assert now <= spread[0] and spread[-1] < time.time() + scheduler.START_JITTER
+        assert spread[-1] - spread[0] > scheduler.START_JITTER / 2
+        row = {"cid": "c1", "next_run": None}
+        assert scheduler.start_at(row, 100) == scheduler.start_at(row, 100)
+
+    def test_owns_filters_load_and_sync(self, temp_db):
+        """Test that a sharded queue only takes the targets it owns"""
+        with db.get_conn() as conn:
+            add_target(conn, "mine", "http://m", 5, wid="w1")
+            add_target(conn, "theirs", "http://t", 5, wid="w2")
+            q = scheduler.TargetQueue(owns=lambda cid: cid.startswith("mine"))
+            assert q.load(conn) == 1
+
+            add_target(conn, "mine2", "http://m2", None, wid="w3")
+            add_target(conn, "theirs2", "http://t2", None, wid="w4")
+            assert q.add_watchers(scheduler.new_watchers(conn, q.watcher_rowid)) == 1
+        assert "mine" in q and "mine2" in q
+        assert "theirs" not in q and "theirs2" not in q
+
+    def test_drop_keeps_pending_writes(self):
+        """Test that dropped targets leave the queue but keep their next_run"""
+        q = scheduler.TargetQueue()
+        q.schedule("a", "http://a", 10)
+        q.schedule("b", "http://b", 10)
+        q.schedule("c", "http://c", 20)
+        q.pop_due(10)
+
+        assert q.drop(lambda cid: cid == "a") == 2
+        q.done("a", "http://a", 30)
+        q.done("b", "http://b", 30)
+        assert "a" in q and "b" not in q and "c" not in q
+        assert dict((cid, t) for t, cid in q.take_dirty()) == {
+            "a": 30,
+            "b": 10,
+            "c": 20,
+        }
+
+    def test_defer_does_not_persist(self):
+        """Test that a deferred target is requeued without a next_run write"""
+        q = scheduler.TargetQueue()
+        q.schedule("a", "http://a", 10, persist=False)
+        q.pop_due(10)
+        q.defer("a", "http://a", 12)
+
+        assert q.take_dirty() == []
+        assert q.pop_due(11) == []
+        assert [d[0] for d in q.pop_due(12)] == ["a"]
+
+    def test_deferred_target_keeps_its_lag(self, monkeypatch):
+        """Test that lag is measured from when a deferred target first fell due"""
+
+        async def fake_handle(cid, url, **kwargs):
+            return time.time(), False
+
+        monkeypatch.setattr(scheduler, "handle_canonical", fake_handle)
+        now = time.time()
+        q = scheduler.TargetQueue()
+        q.schedule("a", "http://a", now - 30, persist=False)
+        [(cid, url, due_at)] = q.pop_due(now)
+        # throttled by its host twice
+        q.defer(cid, url, now + 1)
+        [(cid, url, due_at)] = q.pop_due(now + 1)
+        q.defer(cid, url, now + 2)
+        [(cid, url, due_at)] = q.pop_due(now + 2)
+        assert due_at == now - 30
+
+        lags = overload.LagMonitor()
+
+        async def run():
+            work = asyncio.Queue()
+            work.put_nowait((cid, url, due_at))
+            worker = asyncio.create_task(
+                scheduler.probe_worker(q, work, None, False, lags=lags)
+            )
+            await work.join()
+            worker.cancel()
+
+        asyncio.run(run())
+        assert lags.total == 1
+        assert lags.sum >= 30
+
+    def test_shed_targets_do_not_bring_overload_back(self, monkeypatch):
+        """Test that shed targets running after recovery keep it recovered"""
+        clock = [1000.0]
+        monkeypatch.setattr(time, "time", lambda: clock[0])
+
+        async def fake_handle(cid, url, **kwargs):
+            return time.time() + 3600, False
+
+        monkeypatch.setattr(scheduler, "handle_canonical", fake_handle)
+        q = scheduler.TargetQueue()
+        for i in range(10):
+            q.schedule(f"low{i}", f"http://low{i}", 0, persist=False)
+        for cid, url, _ in q.pop_due(0):
+            q.done(cid, url, 1000, low_priority=True)
+        for i in range(10):
+            q.schedule(f"high{i}", f"http://high{i}", 1000, persist=False)
+        hosts = hostlimit.HostLimiter()
+        lags = overload.LagMonitor()
+        for _ in range(20):
+            lags.record(20, 940)
+        assert lags.update(1000)["event"] == "overload"
+
+        async def run(now):
+            clock[0] = now
+            work = asyncio.Queue()
+            scheduler.dispatch(q, q.pop_due(now), work, hosts, lags, now)
+            worker = asyncio.create_task(
+                scheduler.probe_worker(q, work, None, False, hosts=hosts, lags=lags)
+            )
+            await work.join()
+            worker.cancel()
+            return lags.update(now)
+
+        # only the high-priority targets run, on time, and the lag recovers
+        assert asyncio.run(run(1000)) is None
+        assert lags.shed == 10
+        assert lags.update(1010)["event"] == "recovered"
+        # the shed targets come back once their backoff ends
+        assert asyncio.run(run(1040)) is None
+        assert lags.total == 40
+        assert not lags.overloaded
+
+    def test_flush_writes_next_run_in_one_batch(self, temp_db):
+        """Test that rescheduled next_run values are written back in one batch"""
+        with db.get_conn() as conn:
+            add_target(conn, "a", "http://a", 5, wid="w1")
+            add_target(conn, "b", "http://b", 5, wid="w2")
+            q = scheduler.TargetQueue()
+            q.load(conn)
+            assert scheduler.write_next_run(conn, q.take_dirty()) == 0
+
+            for cid, url, _ in q.pop_due(time.time() + scheduler.START_JITTER):
+                q.done(cid, url, 500)
+            assert scheduler.write_next_run(conn, q.take_dirty()) == 2
+            conn.commit()
+
+            rows = conn.execute("select next_run from canonical_targets").fetchall()
+        assert [r["next_run"] for r in rows] == [500, 500]
+
+
+class TestSchedulerLoop:
+    """Test cases for the worker pool fed by the target queue"""
+
+    @pytest.fixture
+    def temp_db(self, tmp_path, monkeypatch):
+        """Create a temporary database and keep the loop unpaused"""
+        original_path = db.DB_PATH
+        db.DB_PATH = tmp_path / "test.db"
+        db.init_db()
+        monkeypatch.setattr(scheduler, "PAUSE", tmp_path / "EMERGENCY_PAUSE")
+        monkeypatch.setattr(scheduler, "START_JITTER", 0)
+        monkeypatch.setattr(scheduler, "METRICS", tmp_path / "metrics.json")
+        monkeypatch.setattr(scheduler, "WATCHERS", scheduler.WatcherClock())
+        monkeypatch.setattr(scheduler, "BALANCES", balances.BalanceService())
+
+        yield db.DB_PATH
+
+        db.DB_PATH = original_path
+
+    def test_slow_target_does_not_block_others(self, temp_db, monkeypatch):
+        """Test that workers keep probing while one target is slow"""
+        with db.get_conn() as conn:
+            add_target(conn, "slow", "http://slow", 0, wid="w1")
+            add_target(conn, "fast", "http://fast", 0, wid="w2")
+
+        calls = []
+
+        async def fake_handle(cid, url, **kwargs):
+            calls.append(cid)
+            if cid == "slow":
+                await asyncio.sleep(10)
+            return time.time(), False
+
+        monkeypatch.setattr(scheduler, "handle_canonical", fake_handle)
+        monkeypatch.setattr(scheduler, "MIN_INTERVAL", 0.05)
+
+        async def run():
+            task = asyncio.create_task(scheduler.scheduler_loop())
+            await asyncio.sleep(0.5)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+        assert calls.count("slow") == 1
+        assert calls.count("fast") > 3
+
+    def test_hosts_are_throttled(self, temp_db, monkeypatch):
+        """Test that targets on one host respect its concurrency cap"""
+        with db.get_conn() as conn:
+            for i in range(6):
+                add_target(conn, f"c{i}", f"http://api/{i}", 0, wid=f"w{i}")
+            add_target(conn, "other", "http://other/", 0, wid="wo")
+
+        active = {"api": 0}
+        peak = {"api": 0}
+        calls = []
+
+        async def fake_handle(cid, url, **kwargs):
+            calls.append(cid)
+            if cid != "other":
+                active["api"] += 1
+                peak["api"] = max(peak["api"], active["api"])
+                await asyncio.sleep(0.05)
+                active["api"] -= 1
+            return time.time() + 3600, False
+
+        monkeypatch.setattr(scheduler, "handle_canonical", fake_handle)
+        monkeypatch.setattr(scheduler, "CONCURRENCY", 8)
+        monkeypatch.setattr(scheduler, "CONFIG", temp_db.parent / "config.json")
+        (temp_db.parent / "config.json").write_text(
+            '{"host_concurrency": 2, "host_rate": 100, "host_burst": 100}'
+        )
+        monkeypatch.setattr(hostlimit, "BUSY_RETRY", 0.01)
+
+        async def run():
+            task = asyncio.create_task(scheduler.scheduler_loop())
+            await asyncio.sleep(0.6)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+        assert sorted(calls) == sorted([f"c{i}" for i in range(6)] + ["other"])
+        assert peak["api"] == 2
+
+    def test_concurrency_metrics_published(self, temp_db, monkeypatch):
+        """Test that the limit respects max_concurrency and is published"""
+        with db.get_conn() as conn:
+            for i in range(10):
+                add_target(conn, f"c{i}", f"http://h{i}/", 0, wid=f"w{i}")
+
+        async def fake_handle(cid, url, **kwargs):
+            await asyncio.sleep(0.3)
+            return time.time() + 3600, False
+
+        monkeypatch.setattr(scheduler, "handle_canonical", fake_handle)
+        monkeypatch.setattr(scheduler, "CONCURRENCY", 2)
+        monkeypatch.setattr(scheduler, "CONFIG", temp_db.parent / "config.json")
+        (temp_db.parent / "config.json").write_text('{"max_concurrency": 3}')
+        monkeypatch.setattr(adaptive, "ADJUST_INTERVAL", 0.05)
+
+        async def run():
+            task = asyncio.create_task(scheduler.scheduler_loop())
+            await asyncio.sleep(0.5)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+        metrics = json.loads(scheduler.METRICS.read_text())["concurrency"]
+        assert metrics["limit"] == 3
+        assert metrics["increases"] == 1
+
+    def test_overload_defers_low_priority_targets(self, temp_db, monkeypatch):
+        """Test that lagging probes shed low-priority work and emit events"""
+        with db.get_conn() as conn:
+            add_target(conn, "blocker", "http://b/", 0, wid="w0")
+            add_target(conn, "low", "http://low/", 0, wid="w1")
+            add_target(conn, "high", "http://high/", 0, wid="w2")
+
+        calls = []
+
+        async def fake_handle(cid, url, **kwargs):
+            calls.append(cid)
+            if cid == "blocker":
+                # hold the only permit so everything else starts late
+                await asyncio.sleep(0.3)
+            return time.time(), cid == "low"
+
+        monkeypatch.setattr(scheduler, "handle_canonical", fake_handle)
+        monkeypatch.setattr(scheduler, "CONCURRENCY", 1)
+        monkeypatch.setattr(scheduler, "MIN_INTERVAL", 0.01)
+        monkeypatch.setattr(scheduler, "CONFIG", temp_db.parent / "config.json")
+        (temp_db.parent / "config.json").write_text(
+            '{"max_concurrency": 1, "overload_lag": 0.1, "recover_lag": 0.01,'
+            ' "host_rate": 1000, "host_burst": 1000}'
+        )
+        monkeypatch.setattr(adaptive, "ADJUST_INTERVAL", 0.05)
+
+        async def run():
+            task = asyncio.create_task(scheduler.scheduler_loop())
+            await asyncio.sleep(2.5)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+        lag = json.loads(scheduler.METRICS.read_text())["lag"]
+        # metrics are published periodically, so may trail the last probes
+        assert 0 < lag["count"] <= len(calls)
+        assert lag["histogram"]["+Inf"] == lag["count"]
+        assert lag["shed"] > 0
+        assert lag["events"][0]["event"] == "overload"
+        assert calls.count("low") < calls.count("high")
+
+    def test_unwatched_target_is_dropped(self, temp_db, monkeypatch):
+        """Test that a target with no watchers left is not probed again"""
+        with db.get_conn() as conn:
+            add_target(conn, "a", "http://a", 0, wid="w1")
+
+        calls = []
+
+        async def fake_handle(cid, url, **kwargs):
+            calls.append(cid)
+            return None, False
+
+        monkeypatch.setattr(scheduler, "handle_canonical", fake_handle)
+        monkeypatch.setattr(scheduler, "MIN_INTERVAL", 0.01)
+
+        async def run():
+            task = asyncio.create_task(scheduler.scheduler_loop())
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+        assert calls == ["a"]
+
+    def test_sharded_loop_probes_only_owned_targets(self, temp_db, monkeypatch):
+        """Test that a member hands shards to a peer and probes only its own"""
+        with db.get_conn() as conn:
+            for i in range(40):
+                add_target(conn, f"c{i}", f"http://h{i}/", 0, wid=f"w{i}")
+        peer = sharding.ShardManager("peer")
+        with db.get_conn() as conn:
+            peer.heartbeat(conn, time.time())
+            conn.commit()
+
+        calls = []
+
+        async def fake_handle(cid, url, **kwargs):
+            calls.append(cid)
+            return time.time(), False
+
+        monkeypatch.setattr(scheduler, "handle_canonical", fake_handle)
+        monkeypatch.setattr(scheduler, "MIN_INTERVAL", 0.05)
+        monkeypatch.setattr(sharding, "HEARTBEAT", 0.05)
+
+        async def run():
+            task = asyncio.create_task(scheduler.scheduler_loop(member="me"))
+            await asyncio.sleep(0.2)
+            # the peer notices the new member and releases its shards
+            with db.get_conn() as conn:
+                _, lost = peer.heartbeat(conn, time.time())
+                peer.release(conn, lost)
+                conn.commit()
+            await asyncio.sleep(0.5)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+        assert calls
+        assert not any(peer.owns(cid) for cid in calls)
+        with db.get_conn() as conn:
+            owners = {r[0] for r in conn.execute("select owner from shard_leases")}
+            members = conn.execute("select member from scheduler_members").fetchall()
+        assert owners == {"peer"}
+        assert [r[0] for r in members] == ["peer"]
+
+    def test_shard_moving_away_and_back(self, temp_db, monkeypatch):
+        """Test that a shard moved A->B->A keeps every record, error and stat"""
+        root = temp_db.parent
+        monkeypatch.setattr(store, "SEGMENT_RECORDS", 4)
+        # two processes sharing the results and analytics directories
+        members = {
+            name: (
+                sharding.ShardManager(name, num_shards=64),
+                store.ProbeStore(root / "results", logwriter.LogWriter()),
+                stats.AnalyticsStore(root / "analytics"),
+            )
+            for name in "ab"
+        }
+        (root / "analytics").mkdir()
+        a, b = members["a"][0], members["b"][0]
+        cid = next(
+            f"c{i}"
+            for i in range(1000)
+            if sharding.shard_of(f"c{i}", 64) in b.assignment(["a", "b"])
+        )
+
+        def act(name):
+            monkeypatch.setattr(scheduler, "STORE", members[name][1])
+            monkeypatch.setattr(scheduler, "STATS", members[name][2])
+            return members[name][0]
+
+        def probe(ts, error=None):
+            rec = {"ts": ts, "status": "ok", "http_status": 200, "latency_ms": 1}
+            if error:
+                rec = {"ts": ts, "status": "error", "error": error}
+            scheduler.STORE.append(cid, rec)
+            scheduler.STATS.record(cid, rec)
+
+        def beat(name, now):
+            manager = act(name)
+            with db.get_conn() as conn:
+                gained, lost = manager.heartbeat(conn, now)
+                if lost:
+                    scheduler.hand_over(conn, manager, lost, [], now)
+                if gained:
+                    scheduler.take_over(conn, manager, gained)
+                conn.commit()
+
+        beat("a", 100)
+        for ts in range(1, 7):
+            probe(ts, "refused" if ts == 2 else None)
+        beat("b", 101)
+        beat("a", 102)
+        beat("b", 103)
+        assert b.owns(cid) and not a.owns(cid)
+        for ts in (7, 8):
+            probe(ts, "dns failure")
+        # b shuts down cleanly and a takes the shard back
+        manager = act("b")
+        with db.get_conn() as conn:
+            scheduler.hand_over(conn, manager, manager.owned, [], 104)
+            manager.leave(conn)
+            conn.commit()
+        beat("a", 105)
+        assert a.owns(cid)
+        for ts in (9, 10):
+            probe(ts, "timeout" if ts == 10 else None)
+        scheduler.STATS.checkpoint()
+        for _, probes, _ in members.values():
+            probes.writer.close()
+
+        records = store.tail(root / "results", cid)
+        assert [r["ts"] for r in records] == list(range(1, 11))
+        errors = {r["ts"]: r["error"] for r in records if r["status"] == "error"}
+        assert errors == {
+            2: "refused",
+            7: "dns failure",
+            8: "dns failure",
+            10: "timeout",
+        }
+        saved = json.loads((root / "analytics" / f"{cid}.json").read_text())
+        assert (saved["checks_total"], saved["checks_ok"]) == (10, 6)
+
+    def test_buffered_results_flushed_on_shutdown(self, temp_db, monkeypatch):
+        """Test that results written through the log writer survive a stop"""
+        root = temp_db.parent
+        with db.get_conn() as conn:
+            add_target(conn, "a", "http://127.0.0.1:9/", 0, wid="w1")
+        monkeypatch.setattr(scheduler, "BASE", root)
+        monkeypatch.setattr(scheduler, "STORE", store.ProbeStore(root))
+        monkeypatch.setattr(scheduler, "STATS", stats.AnalyticsStore(root))
+        monkeypatch.setattr(scheduler, "MIN_INTERVAL", 3600)
+
+        async def run():
+            task = asyncio.create_task(scheduler.scheduler_loop(simulate=True))
+            await asyncio.sleep(0.3)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+        assert len(store.tail(root, "a")) == 1
+        assert len(store.tail_refs(root / "customers/tok/watchers/w1.ref")[1]) == 1
+        assert isinstance(scheduler.STORE.writer, store.FileWriter)
+
+    def test_probes_in_worker_processes(self, temp_db, monkeypatch):
+        """Test that probe results from worker processes are stored by the parent"""
+        root = temp_db.parent
+        with db.get_conn() as conn:
+            for cid in ("a", "b", "c"):
+                add_target(conn, cid, "http://127.0.0.1:9/", 0, wid=f"w{cid}")
+        monkeypatch.setattr(scheduler, "BASE", root)
+        monkeypatch.setattr(scheduler, "STORE", store.ProbeStore(root))
+        monkeypatch.setattr(scheduler, "STATS", stats.AnalyticsStore(root))
+        monkeypatch.setattr(scheduler, "MIN_INTERVAL", 3600)
+
+        async def run():
+            task = asyncio.create_task(
+                scheduler.scheduler_loop(simulate=True, processes=2)
+            )
+            await asyncio.sleep(3)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+        for cid in ("a", "b", "c"):
+            [rec] = store.tail(root, cid)
+            assert rec["status"] == "error"
+
+
+class TestProbeSession:
+    """Test cases for the shared, pooled probe session"""
+
+    def test_make_session_applies_config(self):
+        """Test that connector limits come from config with defaults"""
+
+        async def run():
+            session = scheduler.make_session(
+                {"http_connection_limit": 7, "dns_cache_ttl": 42}
+            )
+            try:
+                conn = session.connector
+                return conn.limit, conn.limit_per_host, conn.use_dns_cache
+            finally:
+                await session.close()
+
+        limit, per_host, dns_cache = asyncio.run(run())
+        assert limit == 7
+        assert per_host == scheduler.HTTP_DEFAULTS["http_connections_per_host"]
+        assert dns_cache
+
+    def test_load_config_missing_file(self, tmp_path, monkeypatch):
+        """Test that a missing config file yields an empty config"""
+        monkeypatch.setattr(scheduler, "CONFIG", tmp_path / "config.json")
+        assert scheduler.load_config() == {}
+
+    def test_probes_reuse_connections(self, tmp_path, monkeypatch):
+        """Test that repeated probes through one session share a connection"""
+        monkeypatch.setattr(scheduler, "STORE", store.ProbeStore(tmp_path))
+        peers = []
+
+        async def hello(request):
+            peers.append(request.transport.get_extra_info("peername"))
+            return web.Response(text="hello")
+
+        async def run():
+            app = web.Application()
+            app.router.add_get("/", hello)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            session = scheduler.make_session()
+            try:
+                recs = [
+                    await scheduler.probe_target(
+                        session, "cid", f"http://127.0.0.1:{port}/"
+                    )
+                    for _ in range(3)
+                ]
+            finally:
+                await session.close()
+                await runner.cleanup()
+            return recs
+
+        recs = asyncio.run(run())
+        assert [r["status"] for r in recs] == ["ok"] * 3
+        assert recs[0]["size"] == 5
+        assert len(peers) == 3
+        assert len(set(peers)) == 1
+
+    def test_body_is_streamed_with_cap_and_hash(self):
+        """Test that bodies are counted, hashed and cut off at the byte cap"""
+        body = b"x" * 300_000
+
+        async def big(request):
+            return web.Response(body=body)
+
+        async def endless(request):
+            resp = web.StreamResponse()
+            await resp.prepare(request)
+            while True:
+                await resp.write(b"y" * 65536)
+
+        async def run():
+            app = web.Application()
+            app.router.add_get("/big", big)
+            app.router.add_get("/endless", endless)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+            session = scheduler.make_session()
+            try:
+                full = await scheduler.probe_target(
+                    session, "c", f"{base}/big", hash_name="sha256"
+                )
+                capped = await scheduler.probe_target(
+                    session, "c", f"{base}/endless", max_bytes=100_000
+                )
+                head = await scheduler.probe_target(
+                    session, "c", f"{base}/big", headers_only=True
+                )
+            finally:
+                await session.close()
+                await runner.cleanup()
+            return full, capped, head
+
+        full, capped, head = asyncio.run(run())
+        assert full["size"] == len(body)
+        assert full["hash"] == hashlib.sha256(body).hexdigest()
+        assert "truncated" not in full
+        assert capped["status"] == "ok"
+        assert capped["size"] == 100_000 and capped["truncated"]
+        assert "hash" not in capped
+        assert head["size"] == len(body)
+
+    def test_probe_options_from_config(self):
+        """Test that probe options default and can be overridden"""
+        opts = scheduler.probe_options({"probe_hash": "sha1"})
+        assert opts["hash_name"] == "sha1"
+        assert opts["max_bytes"] == scheduler.PROBE_DEFAULTS["probe_max_bytes"]
+        assert not opts["headers_only"]
+
+
+class TestHandleCanonical:
+    """Test cases for probe fan-out to watchers"""
+
+    @pytest.fixture
+    def temp_env(self, tmp_path, monkeypatch):
+        """Point the database and output directories at a temp dir"""
+        original_path = db.DB_PATH
+        db.DB_PATH = tmp_path / "test.db"
+        db.init_db()
+        for name in ("BASE", "RESULTS", "ANALYTICS"):
+            monkeypatch.setattr(scheduler, name, tmp_path)
+        monkeypatch.setattr(scheduler, "STORE", store.ProbeStore(tmp_path))
+        monkeypatch.setattr(scheduler, "STATS", stats.AnalyticsStore(tmp_path))
+        monkeypatch.setattr(scheduler, "WATCHERS", scheduler.WatcherClock())
+        monkeypatch.setattr(scheduler, "BALANCES", balances.BalanceService())
+
+        yield tmp_path
+
+        db.DB_PATH = original_path
+
+    def test_charges_all_watchers_in_one_batch(self, temp_env):
+        """Test that every watcher of a probed target is charged once"""
+        with db.get_conn() as conn:
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="w1", token="rich")
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="w2", token="broke")
+            conn.execute("update sessions set credits=0 where token='broke'")
+            conn.commit()
+
+        start = time.time()
+        next_due, low_priority = asyncio.run(
+            scheduler.handle_canonical("c1", "http://127.0.0.1:9/")
+        )
+
+        assert start + 60 <= next_due <= time.time() + 60
+        assert not low_priority
+        with db.get_conn() as conn:
+            rows = conn.execute(
+                "select action, wid, balance from ledger order by wid"
+            ).fetchall()
+        assert [tuple(r) for r in rows] == [
+            ("CONSUME", "w1", 99),
+            ("CHECK_FAILED_CHARGE", "w2", 0),
+        ]
+        ref = temp_env / "customers" / "rich" / "watchers" / "w1.ref"
+        cid, refs = store.tail_refs(ref)
+        assert cid == "c1" and len(refs) == 1
+        assert store.tail(temp_env, "c1")[0]["ts"] == refs[0][1]
+
+    def test_results_applied_by_persister(self, temp_env):
+        """Test that a handed-off probe result is stored and charged"""
+        with db.get_conn() as conn:
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="w1")
+
+        persister = persist.Persister()
+
+        async def run():
+            return await scheduler.handle_canonical(
+                "c1", "http://127.0.0.1:9/", persister=persister
+            )
+
+        assert asyncio.run(run())[0] is not None
+        persister.close()
+        with db.get_conn() as conn:
+            row = conn.execute(
+                "select last_probe, last_ok from canonical_targets"
+            ).fetchone()
+            ledger = conn.execute("select action, wid from ledger").fetchall()
+        assert row["last_probe"] and row["last_ok"] == 0
+        assert [tuple(r) for r in ledger] == [("CONSUME", "w1")]
+        assert len(store.tail(temp_env, "c1")) == 1
+
+    def test_only_due_watchers_are_charged(self, temp_env):
+        """Test that each watcher is charged on its own interval"""
+        with db.get_conn() as conn:
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="fast")
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="slow")
+            conn.execute("update watchers set interval=300 where wid='slow'")
+            conn.commit()
+
+        rec = {"ts": 0, "status": "ok", "latency_ms": 1}
+        charged = []
+        with db.get_conn() as conn:
+            for now in (1000, 1061, 1122, 1183, 1244, 1305):
+                next_due, _ = scheduler.record_probe(conn, "c1", rec, now)
+                charged.append(
+                    [
+                        r["wid"]
+                        for r in conn.execute(
+                            "select wid from ledger where ts=? order by wid", (now,)
+                        )
+                    ]
+                )
+            conn.commit()
+
+        assert charged == [
+            ["fast", "slow"],
+            ["fast"],
+            ["fast"],
+            ["fast"],
+            ["fast"],
+            ["fast", "slow"],
+        ]
+        assert next_due == 1305 + 60
+        # last_probe is only written back by a flush
+        with db.get_conn() as conn:
+            row = conn.execute("select last_probe from watchers").fetchone()
+            assert row[0] is None
+            assert scheduler.WATCHERS.flush(conn) == 2
+            conn.commit()
+            rows = conn.execute("select last_probe from watchers").fetchall()
+        assert [r[0] for r in rows] == [1305, 1305]
+
+    def test_newer_last_probe_from_another_scheduler_wins(self, temp_env):
+        """Test that a stale in-memory clock does not charge a watcher twice"""
+        with db.get_conn() as conn:
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="w1")
+            rec = {"ts": 0, "status": "ok", "latency_ms": 1}
+            scheduler.record_probe(conn, "c1", rec, 1000)
+            # another member owned the shard for a while and probed at 1100
+            conn.execute("update watchers set last_probe=1100")
+            next_due, _ = scheduler.record_probe(conn, "c1", rec, 1120)
+            charges = conn.execute("select count(*) from ledger").fetchone()[0]
+            conn.commit()
+        assert charges == 1
+        assert next_due == 1160
+
+    def test_next_run_follows_shortest_interval(self, temp_env):
+        """Test that the next run is when the earliest watcher is due"""
+        with db.get_conn() as conn:
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="w1")
+            conn.execute("update watchers set interval=3600, last_probe=500")
+            conn.commit()
+            rec = {"ts": 0, "status": "error", "error": "x"}
+            assert scheduler.record_probe(conn, "c1", rec, 1000) == (4100, True)
+            conn.execute("update watchers set enabled=0")
+            assert scheduler.record_probe(conn, "c1", rec, 1000) == (None, False)
+            assert conn.execute("select count(*) from ledger").fetchone()[0] == 0
+
+    def test_unfunded_target_is_low_priority(self, temp_env):
+        """Test that a target nobody could pay for may be deferred"""
+        with db.get_conn() as conn:
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="w1")
+            conn.execute("update sessions set credits=0")
+            rec = {"ts": 0, "status": "ok", "latency_ms": 1}
+            assert scheduler.record_probe(conn, "c1", rec, 1000) == (1060, True)
+            assert scheduler.record_probe(conn, "c1", rec, 1060, simulate=True) == (
+                1120,
+                False,
+            )
+
+    def test_content_changes_are_recorded(self, temp_env):
+        """Test that the fingerprint is stored and changes become events"""
+        with db.get_conn() as conn:
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="w1")
+            for now, digest in ((1000, "aa"), (1060, "aa"), (1120, "bb")):
+                rec = {"ts": now, "status": "ok", "latency_ms": 1, "hash": digest}
+                scheduler.record_probe(conn, "c1", rec, now)
+            scheduler.record_probe(conn, "c1", {"ts": 1180, "status": "error"}, 1180)
+            conn.commit()
+            row = conn.execute("select fingerprint from canonical_targets").fetchone()
+            changes = conn.execute("select cid,ts,fingerprint from content_changes")
+            changes = [tuple(r) for r in changes]
+        assert row["fingerprint"] == "bb"
+        assert changes == [("c1", 1120, "bb")]
+
+    def test_on_change_watchers_charged_only_on_change(self, temp_env):
+        """Test that on_change watchers pay only for probes with new content"""
+        with db.get_conn() as conn:
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="every")
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="change")
+            conn.execute("update watchers set on_change=1 where wid='change'")
+            conn.commit()
+            digests = ["aa", "aa", "bb", "bb", None, "cc"]
+            for i, digest in enumerate(digests):
+                now = 1000 + 60 * i
+                rec = {"ts": now, "status": "ok", "latency_ms": 1}
+                if digest:
+                    rec["hash"] = digest
+                scheduler.record_probe(conn, "c1", rec, now)
+            conn.commit()
+            charged = conn.execute(
+                "select wid, count(*) from ledger group by wid order by wid"
+            ).fetchall()
+            seen = conn.execute(
+                "select fingerprint from watchers where wid='change'"
+            ).fetchone()[0]
+        assert [tuple(r) for r in charged] == [("change", 2), ("every", 6)]
+        assert seen == "cc"
+        _, refs = store.tail_refs(temp_env / "customers/tok/watchers/change.ref")
+        assert [probe_ts for _, probe_ts in refs] == [1120, 1300]
+
+    def test_changed_for_baseline(self):
+        """Test that an on_change watcher's first fingerprint is not a change"""
+        w = {"wid": "w1", "on_change": 1, "fingerprint": None}
+        assert scheduler.changed_for([w], "aa") == ([], [("aa", "w1")])
+        assert scheduler.changed_for([w], None) == ([], [])
+
+    def test_analytics_recorded_in_memory(self, temp_env):
+        """Test that probes update in-memory stats and only checkpoints write"""
+        with db.get_conn() as conn:
+            add_target(conn, "c1", "http://127.0.0.1:9/", 0, wid="w1")
+
+        asyncio.run(scheduler.handle_canonical("c1", "http://127.0.0.1:9/"))
+
+        assert not (temp_env / "c1.json").exists()
+        assert scheduler.STATS.get("c1").checks_total == 1
+        assert scheduler.STATS.checkpoint() == 1
+        assert stats.read_summary(temp_env / "c1.json")["checks_ok"] == 0
@@ -0,0 +1,172 @@
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import db
+import sharding
+
+MONITOR = Path(__file__).parent.parent
+
+WORKER = textwrap.dedent("""
+    import sys, time
+    from pathlib import Path
+    import db, sharding
+
+    db.DB_PATH = Path(sys.argv[1])
+    m = sharding.ShardManager(sys.argv[2], num_shards=64, ttl=1)
+    end = time.time() + float(sys.argv[3])
+    with db.get_conn() as conn:
+        while time.time() < end:
+            _, lost = m.heartbeat(conn, time.time())
+            m.release(conn, lost)
+            conn.commit()
+            time.sleep(0.05)
+    print(" ".join(map(str, sorted(m.owned))))
+    """)
+
+
+class TestHashRing:
+    """Test cases for shard hashing and the consistent-hash ring"""
+
+    def test_shard_of_is_stable(self):
+        """Test that a cid always maps to the same shard in range"""
+        assert sharding.shard_of("abc", 64) == sharding.shard_of("abc", 64)
+        assert all(0 <= sharding.shard_of(f"c{i}", 64) < 64 for i in range(100))
+
+    def test_empty_ring(self):
+        """Test that a ring without members owns nothing"""
+        assert sharding.HashRing([]).owner("shard-1") is None
+
+    def test_leaving_member_only_moves_its_shards(self):
+        """Test that removing a member keeps everyone else's shards in place"""
+        keys = [f"shard-{s}" for s in range(256)]
+        before = sharding.HashRing(["a", "b", "c"])
+        after = sharding.HashRing(["a", "b"])
+        for key in keys:
+            if before.owner(key) != "c":
+                assert after.owner(key) == before.owner(key)
+        owners = {before.owner(key) for key in keys}
+        assert owners == {"a", "b", "c"}
+
+
+class TestShardManager:
+    """Test cases for shard leases shared through SQLite"""
+
+    @pytest.fixture
+    def temp_db(self, tmp_path, monkeypatch):
+        """Create a temporary database with the lease tables"""
+        monkeypatch.setattr(db, "DB_PATH", tmp_path / "test.db")
+        db.init_db()
+        yield db.DB_PATH
+        db.close_conns()
+
+    def beat(self, managers, now, release=True):
+        with db.get_conn() as conn:
+            results = [m.heartbeat(conn, now) for m in managers]
+            if release:
+                for m, (_, lost) in zip(managers, results):
+                    m.release(conn, lost)
+            conn.commit()
+        return results
+
+    def leases(self):
+        with db.get_conn() as conn:
+            return dict(conn.execute("select shard, owner from shard_leases"))
+
+    def test_single_member_owns_everything(self, temp_db):
+        """Test that a lone member leases every shard"""
+        m = sharding.ShardManager("a", num_shards=16)
+        [(gained, lost)] = self.beat([m], 100)
+        assert gained == set(range(16)) and not lost
+        assert m.owns("anything")
+        assert set(self.leases().values()) == {"a"}
+
+    def test_members_split_shards(self, temp_db):
+        """Test that members end up with disjoint leases covering all shards"""
+        managers = [sharding.ShardManager(n, num_shards=64) for n in "abc"]
+        for t in range(3):
+            self.beat(managers, 100 + t)
+        owned = [m.owned for m in managers]
+        assert all(owned)
+        assert set().union(*owned) == set(range(64))
+        assert sum(len(o) for o in owned) == 64
+        leases = self.leases()
+        for m in managers:
+            assert {s for s, o in leases.items() if o == m.member} == m.owned
+
+    def test_joining_member_waits_for_release(self, temp_db):
+        """Test that a new member only takes shards once their owner lets go"""
+        a = sharding.ShardManager("a", num_shards=64)
+        b = sharding.ShardManager("b", num_shards=64)
+        self.beat([a], 100)
+        [(gained, _)] = self.beat([b], 101)
+        assert not gained
+        [(_, lost)] = self.beat([a], 102, release=False)
+        assert lost == b.assignment(["a", "b"])
+        assert not lost & a.owned
+        # lost leases stay with a until it has handed them over
+        [(gained, _)] = self.beat([b], 103)
+        assert not gained
+        with db.get_conn() as conn:
+            a.release(conn, lost)
+            conn.commit()
+        [(gained, _)] = self.beat([b], 104)
+        assert gained == lost
+        assert not a.owned & b.owned
+
+    def test_dead_member_shards_are_taken_over(self, temp_db):
+        """Test that shards of a member that stopped heartbeating move on"""
+        a = sharding.ShardManager("a", num_shards=64, ttl=30)
+        b = sharding.ShardManager("b", num_shards=64, ttl=30)
+        for t in range(3):
+            self.beat([a, b], 100 + t)
+        assert a.owned and b.owned
+        self.beat([a], 120)
+        assert a.owned != set(range(64))
+        self.beat([a], 140)
+        assert a.owned == set(range(64))
+        assert not b.valid(140)
+
+    def test_leave_releases_immediately(self, temp_db):
+        """Test that leave() frees shards for the remaining members"""
+        a = sharding.ShardManager("a", num_shards=64)
+        b = sharding.ShardManager("b", num_shards=64)
+        for t in range(3):
+            self.beat([a, b], 100 + t)
+        with db.get_conn() as conn:
+            lost = b.leave(conn)
+            conn.commit()
+        assert lost and not b.owned
+        self.beat([a], 104)
+        assert a.owned == set(range(64))
+
+    def test_valid_until_ttl(self, temp_db):
+        """Test that leases are only trusted until a heartbeat is overdue"""
+        m = sharding.ShardManager("a", num_shards=4, ttl=30)
+        assert not m.valid(100)
+        self.beat([m], 100)
+        assert m.valid(129)
+        assert not m.valid(130)
+
+    def test_processes_share_shards(self, temp_db):
+        """Test that separate processes split shards and absorb a dead one"""
+
+        def spawn(member, seconds):
+            return subprocess.Popen(
+                [sys.executable, "-c", WORKER, str(temp_db), member, str(seconds)],
+                cwd=MONITOR,
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+
+        procs = [spawn("a", 3), spawn("b", 3), spawn("c", 0.5)]
+        out = [p.communicate(timeout=30)[0] for p in procs]
+        assert all(p.returncode == 0 for p in procs)
+        a, b = ({int(s) for s in o.split()} for o in out[:2])
+        assert a and b and not a & b
+        assert a | b == set(range(64))
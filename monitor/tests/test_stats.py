@@ -0,0 +1,134 @@
+import json
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import stats
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+class TestSketch:
+    """Test cases for the quantile sketch"""
+
+    def test_quantiles_within_relative_error(self):
+        """Test that quantiles are within ALPHA of the exact values"""
+        rng = random.Random(7)
+        values = [rng.lognormvariate(4, 1) for _ in range(20000)]
+        sketch = stats.Sketch()
+        for v in values:
+            sketch.add(v)
+
+        for q in (0.5, 0.95, 0.99):
+            exact = exact_quantile(values, q)
+            assert sketch.quantile(q) == pytest.approx(exact, rel=stats.ALPHA * 1.01)
+        assert len(sketch.bins) < 1000
+
+    def test_empty_and_zero_values(self):
+        """Test empty sketches and latencies that round to zero"""
+        sketch = stats.Sketch()
+        assert sketch.quantile(0.5) is None
+        sketch.add(0)
+        sketch.add(0)
+        sketch.add(100)
+        assert sketch.quantile(0.5) == 0.0
+        assert sketch.quantile(1) == pytest.approx(100, rel=stats.ALPHA)
+
+    def test_merge_and_round_trip(self):
+        """Test that merged and reloaded sketches answer like the original"""
+        a, b, both = stats.Sketch(), stats.Sketch(), stats.Sketch()
+        for i in range(1, 1001):
+            (a if i % 2 else b).add(i)
+            both.add(i)
+        merged = stats.Sketch().merge(a).merge(b)
+        reloaded = stats.Sketch.from_dict(json.loads(json.dumps(merged.to_dict())))
+
+        for q in (0.5, 0.95, 0.99):
+            assert merged.quantile(q) == both.quantile(q)
+            assert reloaded.quantile(q) == both.quantile(q)
+
+
+class TestRollingWindows:
+    """Test cases for rolling uptime and latency windows"""
+
+    def test_old_probes_leave_the_window(self):
+        """Test that a window only covers its span"""
+        t = stats.TargetStats()
+        now = 10 * 86400.0
+        t.record({"ts": now - 7200, "status": "ok", "latency_ms": 1000})
+        t.record({"ts": now - 60, "status": "ok", "latency_ms": 10})
+        t.record({"ts": now - 30, "status": "error", "error": "boom"})
+
+        summary = t.summary(now)
+        hour = summary["windows"]["1h"]
+        assert (hour["checks"], hour["checks_ok"], hour["uptime"]) == (2, 1, 0.5)
+        assert hour["p99_ms"] == pytest.approx(10, rel=stats.ALPHA)
+        assert summary["windows"]["24h"]["checks"] == 3
+        assert summary["checks_total"] == 3
+        assert summary["avg_latency_ms"] == 505
+
+        later = t.summary(now + 3 * 3600)["windows"]["1h"]
+        assert later["checks"] == 0 and later["uptime"] is None
+
+    def test_buckets_are_pruned(self):
+        """Test that expired buckets are dropped as new ones are opened"""
+        window = stats.RollingWindow(3600, 300)
+        for i in range(100):
+            window.add(i * 300.0, True, 5)
+        assert len(window.buckets) <= 3600 // 300 + 1
+
+
+class TestAnalyticsStore:
+    """Test cases for checkpointing stats"""
+
+    def test_checkpoint_and_read_summary(self, tmp_path):
+        """Test that readers rebuild windows from a checkpoint"""
+        store = stats.AnalyticsStore(tmp_path)
+        now = 1000000.0
+        for i in range(50):
+            store.record("c1", {"ts": now - i, "status": "ok", "latency_ms": i + 1})
+
+        assert store.checkpoint(now) == 1
+        assert store.checkpoint(now) == 0
+        summary = stats.read_summary(tmp_path / "c1.json", now)
+        assert summary["windows"]["1h"]["checks"] == 50
+        assert summary["p50_ms"] == pytest.approx(25, rel=0.05)
+        # windows are recomputed for the reader's clock
+        assert (
+            stats.read_summary(tmp_path / "c1.json", now + 7200)["windows"]["1h"][
+                "checks"
+            ]
+            == 0
+        )
+
+    def test_resumes_from_checkpoint(self, tmp_path):
+        """Test that a restarted scheduler continues from its checkpoint"""
+        first = stats.AnalyticsStore(tmp_path)
+        first.record("c1", {"ts": 100.0, "status": "ok", "latency_ms": 20})
+        first.checkpoint(100.0)
+
+        second = stats.AnalyticsStore(tmp_path)
+        second.record("c1", {"ts": 110.0, "status": "ok", "latency_ms": 40})
+        summary = second.get("c1").summary(120.0)
+        assert summary["checks_total"] == 2
+        assert summary["avg_latency_ms"] == 30
+        assert summary["windows"]["1h"]["checks"] == 2
+
+    def test_legacy_counters(self, tmp_path):
+        """Test that plain counter files are read and carried over"""
+        legacy = {"checks_total": 4, "checks_ok": 3, "avg_latency_ms": 12.5}
+        (tmp_path / "c1.json").write_text(json.dumps(legacy))
+
+        assert stats.read_summary(tmp_path / "c1.json") == legacy
+        store = stats.AnalyticsStore(tmp_path)
+        store.record("c1", {"ts": 1.0, "status": "ok", "latency_ms": 12.5})
+        assert store.get("c1").checks_total == 5
+        assert store.get("c1").avg_latency_ms == 12.5
+        assert stats.read_summary(tmp_path / "missing.json") == {}
@@ -0,0 +1,162 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import store
+
+
+def ok(ts, latency=10.0, size=100):
+    return {
+        "ts": ts,
+        "status": "ok",
+        "http_status": 200,
+        "latency_ms": latency,
+        "size": size,
+    }
+
+
+class TestProbeStore:
+    """Test cases for the compact probe result store"""
+
+    @pytest.fixture
+    def small_segments(self, monkeypatch):
+        """Compact after a handful of records so tests cross segments"""
+        monkeypatch.setattr(store, "SEGMENT_RECORDS", 4)
+
+    def test_append_and_tail(self, tmp_path):
+        """Test that appended records come back in order with their fields"""
+        s = store.ProbeStore(tmp_path)
+        for i in range(3):
+            s.append("c1", ok(100 + i, latency=1.5 + i, size=i))
+
+        result = store.tail(tmp_path, "c1", n=2)
+        assert result == [
+            {
+                "ts": 101.0,
+                "cid": "c1",
+                "status": "ok",
+                "http_status": 200,
+                "latency_ms": 2.5,
+                "size": 1,
+            },
+            {
+                "ts": 102.0,
+                "cid": "c1",
+                "status": "ok",
+                "http_status": 200,
+                "latency_ms": 3.5,
+                "size": 2,
+            },
+        ]
+        assert (tmp_path / "c1" / "000000.rows").stat().st_size == 3 * store.ROW.size
+
+    def test_errors_are_interned(self, tmp_path):
+        """Test that each distinct error message is stored once"""
+        s = store.ProbeStore(tmp_path)
+        s.append("c1", {"ts": 1, "status": "error", "error": "timeout"})
+        s.append("c1", {"ts": 2, "status": "error", "error": "line\nbreak"})
+        s.append("c1", {"ts": 3, "status": "error", "error": "timeout"})
+
+        assert (tmp_path / "c1" / "errors.txt").read_text() == "timeout\nline break\n"
+        result = store.tail(tmp_path, "c1")
+        assert [r["error"] for r in result] == ["timeout", "line break", "timeout"]
+        assert all(r["status"] == "error" for r in result)
+
+        # a new writer picks up the existing table
+        store.ProbeStore(tmp_path).append(
+            "c1", {"ts": 4, "status": "error", "error": "timeout"}
+        )
+        assert (tmp_path / "c1" / "errors.txt").read_text().count("timeout") == 1
+
+    def test_compaction_to_columnar_segments(self, tmp_path, small_segments):
+        """Test that full row segments are rewritten as columnar segments"""
+        s = store.ProbeStore(tmp_path)
+        for i in range(10):
+            s.append("c1", ok(i))
+
+        names = sorted(p.name for p in (tmp_path / "c1").iterdir())
+        assert names == ["000000.col", "000001.col", "000002.rows"]
+        assert [r["ts"] for r in store.tail(tmp_path, "c1", n=6)] == [4, 5, 6, 7, 8, 9]
+        assert len(store.tail(tmp_path, "c1", n=100)) == 10
+
+        # a restarted writer continues the active segment
+        store.ProbeStore(tmp_path).append("c1", ok(10))
+        assert (tmp_path / "c1" / "000002.rows").stat().st_size == 3 * store.ROW.size
+
+    def test_read_range_across_segments(self, tmp_path, small_segments):
+        """Test since/until windows over columnar and row segments"""
+        s = store.ProbeStore(tmp_path)
+        for i in range(10):
+            s.append("c1", ok(i * 60))
+
+        window = store.read_range(tmp_path, "c1", since=180, until=420)
+        assert [r["ts"] for r in window] == [180, 240, 300, 360, 420]
+        page = store.read_range(tmp_path, "c1", since=120, limit=2)
+        assert [r["ts"] for r in page] == [120, 180]
+        latest = store.read_range(tmp_path, "c1", until=300, limit=2)
+        assert [r["ts"] for r in latest] == [240, 300]
+        assert store.read_range(tmp_path, "missing", since=0) == []
+
+    def test_lookup(self, tmp_path, small_segments):
+        """Test resolving records by their probe timestamps"""
+        s = store.ProbeStore(tmp_path)
+        for i in range(10):
+            s.append("c1", ok(i))
+
+        found = store.lookup(tmp_path, "c1", [1, 8, 42])
+        assert sorted(found) == [1, 8]
+        assert found[8]["ts"] == 8
+
+    def test_torn_row_and_interrupted_compaction(self, tmp_path, small_segments):
+        """Test that partial writes and leftover row files are ignored"""
+        s = store.ProbeStore(tmp_path)
+        for i in range(4):
+            s.append("c1", ok(i))
+        # simulate a crash after writing the .col but before removing the .rows
+        (tmp_path / "c1" / "000000.rows").write_bytes(
+            b"".join(store.ROW.pack(i, 200, 1.0, 1, 0) for i in range(4))
+        )
+        with open(tmp_path / "c1" / "000001.rows", "ab") as f:
+            f.write(store.ROW.pack(4, 200, 1.0, 1, 0) + b"\x00\x01")
+
+        assert [r["ts"] for r in store.tail(tmp_path, "c1")] == [0, 1, 2, 3, 4]
+
+
+class TestWatcherRefs:
+    """Test cases for watcher history references"""
+
+    def test_tail_refs(self, tmp_path):
+        """Test that references keep their target and come back in order"""
+        path = tmp_path / "w" / "w1.ref"
+        s = store.ProbeStore(tmp_path)
+        for i in range(5):
+            s.append_ref(path, "c1", 100 + i, 99 + i)
+
+        cid, refs = store.tail_refs(path, n=2)
+        assert cid == "c1"
+        assert refs == [(103.0, 102.0), (104.0, 103.0)]
+        assert path.stat().st_size == store.REF_HEADER.size + 5 * store.REF.size
+
+    def test_range_refs(self, tmp_path):
+        """Test since/until windows over references"""
+        path = tmp_path / "w1.ref"
+        s = store.ProbeStore(tmp_path)
+        for i in range(10):
+            s.append_ref(path, "c1", i * 60, i * 60 - 1)
+
+        _, refs = store.range_refs(path, since=120, until=240)
+        assert [r[0] for r in refs] == [120, 180, 240]
+        _, refs = store.range_refs(path, until=240, limit=2)
+        assert [r[0] for r in refs] == [180, 240]
+        _, refs = store.range_refs(path, since=10**6)
+        assert refs == []
+
+    def test_rejects_foreign_file(self, tmp_path):
+        """Test that a non-reference file is not misread"""
+        path = tmp_path / "w1.ref"
+        path.write_bytes(b"x" * 100)
+        with pytest.raises(ValueError):
+            store.tail_refs(path)